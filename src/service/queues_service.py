@@ -1,6 +1,8 @@
 from src.config.configuration import queues_configuration
 from src.utils.managers import QueueManager, SharedResultsManager, start_server
 from src.utils.queues import queues_setup
+from src.utils.cluster import ClusterMap, cluster_members, is_cluster
+from src.utils.replication import start_replicas, replica_addresses
 from src.logging.dsys_logger_client import get_logger
 import argparse
 
@@ -19,22 +21,66 @@ class ServerSetup(object):
         return "< ServerSetup address={} port={} passkey={}>".format(self.address, self.port, self.passkey)
 
 
-def start_jobserver(queues_conf, queue_type='priority'):
-
-    conf = ServerSetup(address=queues_conf['jobs_queue']['address'],
-                       port=queues_conf['jobs_queue']['port'],
-                       passkey=queues_conf['jobs_queue']['auth'])
-
-    return start_server(QueueManager(address=conf.address, port=conf.port,
-                                     authkey=conf.passkey, queues={'tasks_queue': queues_setup[queue_type]()}))
+def flow_control_options(jobs_conf):
+    """
+    @return: flow_control() keyword arguments of the job queue configuration, None without high_water
+    """
+    if not jobs_conf.get('high_water'):
+        return None
+    return dict(high_water=jobs_conf['high_water'], low_water=jobs_conf.get('low_water'),
+                overflow=jobs_conf.get('overflow', 'block'), timeout=jobs_conf.get('overflow_timeout'))
+
+
+def start_jobserver(queues_conf, queue_type='priority', serve=None):
+    """
+    Start the job server partitions of this node (see cluster), every one with its job queue and its copy of the
+    cluster map. With replication, dict(replicas, root directory, sync (bool), lag_timeout), the job server is a
+    replica group on consecutive ports instead (see replication.Replica)
+    @param serve: indexes of the cluster members served here, None serves all of them (single node cluster)
+    @return: list of server processes
+    """
+    jobs_conf = queues_conf['jobs_queue']
+    replication = jobs_conf.get('replication')
+    if replication:
+        if is_cluster(jobs_conf):
+            raise ValueError("A replicated job server is a single partition")
+        return start_replicas(replica_addresses(jobs_conf), jobs_conf['auth'], replication['root'],
+                              sync_replicas=replication.get('sync', True),
+                              lag_timeout=replication.get('lag_timeout', 1.),
+                              flow_control=flow_control_options(jobs_conf))
+
+    members = cluster_members(jobs_conf)
+    servers = []
+    for n, (address, port) in enumerate(members):
+        if serve is not None and n not in serve:
+            continue
+        queue = queues_setup[queue_type]()
+        flow_control = flow_control_options(jobs_conf)
+        if flow_control:
+            queue.flow_control(**flow_control)
+        servers.append(start_server(QueueManager(address=address, port=port, authkey=jobs_conf['auth'],
+                                                 queues={'tasks_queue': queue,
+                                                         'cluster_map': ClusterMap(members)})))
+    return servers
 
 
 def start_results_server(queues_conf):
+    """
+    Start one SharedResultsManager per shard, on consecutive ports. max_bytes is the global budget,
+    split evenly between the shards
+    @return: list of server processes
+    """
     conf = ServerSetup(address=queues_conf['results_queue']['address'],
                        port=queues_conf['results_queue']['port'],
                        passkey=queues_conf['results_queue']['auth'])
+    shards = queues_conf['results_queue'].get('shards', 1)
+    max_bytes = queues_conf['results_queue'].get('max_bytes')
 
-    return start_server(SharedResultsManager(address=conf.address, port=conf.port, authkey=conf.passkey))
+    return [start_server(SharedResultsManager(address=conf.address, port=conf.port + shard, authkey=conf.passkey,
+                                              ttl=queues_conf['results_queue'].get('ttl'),
+                                              max_bytes=max_bytes // shards if max_bytes else None,
+                                              pop_on_read=queues_conf['results_queue'].get('pop_on_read', False)))
+            for shard in range(shards)]
 
 
 def parse_commandline_args():
@@ -43,18 +89,24 @@ def parse_commandline_args():
     parser.add_argument(
         '--queue_type',
         default='priority',
-        help='queue type',
+        help='queue type: {}'.format(', '.join(sorted(queues_setup))),
         dest='queue_type',
     )
+    parser.add_argument(
+        '--serve',
+        default=None,
+        type=lambda value: [int(n) for n in value.split(',')],
+        help='comma separated indexes of the job server partitions (jobs_queue members) served by this node, '
+             'default all',
+        dest='serve',
+    )
     parsed_args = parser.parse_args()
     return parsed_args
 
 
 def main(args):
-    servers = [
-        start_jobserver(queues_configuration, args.queue_type),
+    servers = start_jobserver(queues_configuration, args.queue_type, args.serve) + \
         start_results_server(queues_configuration)
-    ]
 
     for server in servers:
         log.info(server)
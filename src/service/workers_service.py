@@ -1,16 +1,26 @@
 from src.config.configuration import queues_configuration
-from src.utils.managers import ClientManager
+from src.utils.managers import ClientManager, ShardedClientManager, PartitionedClientManager
+from src.utils.cluster import cluster_members, is_cluster
+from src.utils.replication import FailoverClientManager, replica_addresses
 import argparse
 import collections
-from src.utils.workers import Worker
+import errno
+from src.utils.workers import Worker, WarmPool
+from src.utils.autoscaler import Autoscaler
+from src.utils.agent import HostAgent
+from src.utils.tasks import Task
+from src.utils import shm
 from src.logging.dsys_logger_client import get_logger
 from multiprocessing import Process
 import time
 import os
 import signal
+import socket
 
 log = get_logger(__name__)
 
+SHM_SWEEP = 60.  # seconds between two sweeps of the shared memory segments left behind
+
 
 class ServerSetup(object):
 
@@ -27,7 +37,18 @@ class ServerSetup(object):
 
 class Watchdog(Process):
     def __init__(self, current_workers, jobs_queue, results_queue, rate, initial_workers, max_workers, sample_time,
-                 poison_pill, logger):
+                 poison_pill, logger, worker_options=None, autoscaler_options=None, reserve=2, worker_queue=None,
+                 drain_timeout=30., shm_max_age=3600.):
+        """
+        @param reserve: warmed up idle workers kept ready for the scale ups, 0 cold starts them
+        @param worker_queue: queue the workers get their jobs from, the local queue of a HostAgent, defaults to
+        jobs_queue. Stats and poison pills go to jobs_queue
+        @param drain_timeout: seconds a worker removed by a scale down has to finish its jobs, it is then stopped
+        hard (its jobs given back to the queue), and killed after as long again
+        @param shm_max_age: seconds after which the shared memory segments of the host are unlinked: results
+        evicted from the store unread, args of the jobs dead-lettered. Longer than the results ttl and than a
+        job may wait in the queue
+        """
         super(Watchdog, self).__init__()
         self.current_workers = current_workers
         self.jobs_queue = jobs_queue
@@ -38,55 +59,81 @@ class Watchdog(Process):
         self.sample_time = sample_time
         self.poison_pill = poison_pill
         self.logger = logger
+        self.drain_timeout = drain_timeout
+        self.shm_max_age = shm_max_age
+        self.swept = 0.  # time of the last shared memory sweep
+        self.draining = {}  # worker -> [deadline, stopped hard]
+        self.worker_options = worker_options or {}
+        self.autoscaler = Autoscaler(initial_workers, max_workers, worker_rate=rate, **(autoscaler_options or {}))
+        self.warm_pool = WarmPool(worker_queue or jobs_queue, results_queue, reserve=reserve, wait=False,
+                                  poison_pill=poison_pill, **self.worker_options)
 
     def serve_forever(self):
         self.run()
 
     def run(self):
+        self.warm_pool.fill()
         while True:
             self.current_workers = collections.deque([w for w in self.current_workers if w.is_alive()])
-            delta = analyze(self.jobs_queue, self.rate, self.current_workers,
-                            self.initial_workers, self.max_workers, self.sample_time)
-            if delta > 0 and len(self.current_workers) < self.max_workers:
-
-                self.logger.info("====> Creating new worker: delta={}, threshold={}".format(delta, self.rate))
-                worker = Worker(self.jobs_queue, self.results_queue, wait=False, poison_pill=self.poison_pill)
-                worker.deamon = True
-                worker.start()
-                self.current_workers.append(worker)
-                self.logger.info('{} - delta={}'.format(str(self), delta))
-
-            elif delta < 0 and len(self.current_workers) > self.initial_workers:
-
-                self.logger.info("====> Killing worker: delta={}, threshold={}".format(delta, self.rate))
-
-                stop_worker(jobs_queue=self.jobs_queue,
-                            poison_pill=self.poison_pill,
-                            current_workers=self.current_workers,
-                            workers_to_kill=1)
-
-                self.current_workers = collections.deque([w for w in self.current_workers if w.is_alive()])
-                self.logger.info('{} - delta={}'.format(str(self), delta))
-
-            elif delta == self.rate and len(self.current_workers) > self.initial_workers:
-
-                self.logger.info("====> Killing worker: delta={}, threshold={}".format(delta, self.rate))
-
-                stop_worker(jobs_queue=self.jobs_queue,
-                            poison_pill=self.poison_pill,
-                            current_workers=self.current_workers,
-                            workers_to_kill=len(self.current_workers) - self.initial_workers)
-
-                self.current_workers = collections.deque([w for w in self.current_workers if w.is_alive()])
-                self.logger.info('{} - delta={}'.format(str(self), delta))
-
-            else:
-                self.logger.info('{} - delta={}'.format(str(self), delta))
-
-            time.sleep(1)
+            delta = self.autoscaler.step(self.jobs_queue.stats(), len(self.current_workers))
+
+            if delta > 0:
+                self.current_workers.extend(self.warm_pool.activate(delta))
+                self.logger.info("====> Created {} workers: {}".format(delta, self.autoscaler))
+
+            elif delta < 0:
+                self.logger.info("====> Draining {} workers: {}".format(-delta, self.autoscaler))
+                deadline = time.time() + self.drain_timeout
+                for worker in stop_worker(self.current_workers, -delta):
+                    self.draining[worker] = [deadline, False]
+
+            self._reap()
+            self._sweep()
+            self.warm_pool.fill()
+            self.logger.info('{} - {}'.format(str(self), self.autoscaler))
+            time.sleep(self.sample_time)
+
+    def _reap(self):
+        """
+        Draining workers past their deadline are stopped hard, then killed
+        """
+        now = time.time()
+        for worker, state in list(self.draining.items()):
+            if not worker.is_alive():
+                worker.join()
+                del self.draining[worker]
+            elif now >= state[0]:
+                if state[1]:
+                    self.logger.error("====> Killing worker {}: not stopped".format(worker.pid))
+                    signum = signal.SIGKILL
+                else:
+                    self.logger.warning("====> Stopping worker {}: not drained after {}s".format(
+                        worker.pid, self.drain_timeout))
+                    signum = signal.SIGUSR1
+                try:
+                    os.kill(worker.pid, signum)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+                    # exited since is_alive(): reaped
+                    worker.join()
+                    del self.draining[worker]
+                    continue
+                state[:] = [now + self.drain_timeout, True]
+
+    def _sweep(self):
+        now = time.time()
+        if now - self.swept < SHM_SWEEP:
+            return
+        self.swept = now
+        removed = shm.cleanup(self.shm_max_age)
+        if removed:
+            self.logger.info("====> Unlinked {} shared memory segments older than {}s".format(removed,
+                                                                                            self.shm_max_age))
 
     def __repr__(self):
-        return "< WatchDog - Running: {} Max: {}>".format(len(self.current_workers), self.max_workers)
+        return "< WatchDog - Running: {} Draining: {} Max: {}>".format(len(self.current_workers), len(self.draining),
+                                                                       self.max_workers)
 
 
 def init_job_client(queues_conf):
@@ -94,7 +141,23 @@ def init_job_client(queues_conf):
                        port=queues_conf['jobs_queue']['port'],
                        passkey=queues_conf['jobs_queue']['auth'])
 
-    return ClientManager(address=(conf.address, conf.port), authkey=conf.passkey, queues=['tasks_queue'])
+    # producers of this client move large task args through shared memory
+    Task.shm_threshold = queues_conf['jobs_queue'].get('shm_threshold')
+
+    if queues_conf['jobs_queue'].get('replication'):
+        return FailoverClientManager(replica_addresses(queues_conf['jobs_queue']), authkey=conf.passkey,
+                                     codec=queues_conf['jobs_queue'].get('codec'),
+                                     pool_size=queues_conf['jobs_queue'].get('pool_size'),
+                                     failover_timeout=queues_conf['jobs_queue']['replication'].get('failover_timeout',
+                                                                                                   30.))
+    if is_cluster(queues_conf['jobs_queue']):
+        return PartitionedClientManager(cluster_members(queues_conf['jobs_queue']), authkey=conf.passkey,
+                                        codec=queues_conf['jobs_queue'].get('codec'),
+                                        pool_size=queues_conf['jobs_queue'].get('pool_size'),
+                                        refresh=queues_conf['jobs_queue'].get('cluster_refresh', 1.))
+    return ClientManager(address=(conf.address, conf.port), authkey=conf.passkey, queues=['tasks_queue'],
+                         codec=queues_conf['jobs_queue'].get('codec'),
+                         pool_size=queues_conf['jobs_queue'].get('pool_size'))
 
 
 def init_result_client(queues_conf):
@@ -102,20 +165,36 @@ def init_result_client(queues_conf):
                        port=queues_conf['results_queue']['port'],
                        passkey=queues_conf['results_queue']['auth'])
 
-    return ClientManager(address=(conf.address, conf.port), authkey=conf.passkey, queues=['results_queue'])
+    return ShardedClientManager(addresses=[(conf.address, conf.port + shard)
+                                           for shard in range(queues_conf['results_queue'].get('shards', 1))],
+                                authkey=conf.passkey,
+                                codec=queues_conf['results_queue'].get('codec'),
+                                pool_size=queues_conf['results_queue'].get('pool_size'))
 
 
 def get_queues(job_client, results_client):
     return job_client.get_tasks_queue(), results_client.get_results()
 
 
-def workerpool(jobs, results, initial_workers=2, max_workers=8, poison_pill='-STOP-', consume_rate=10., sample_time=1):
+def workerpool(jobs, results, initial_workers=2, max_workers=8, poison_pill='-STOP-', consume_rate=10., sample_time=1,
+               worker_options=None, autoscaler_options=None, reserve=2, worker_queue=None, drain_timeout=30.,
+               shm_max_age=3600.):
+    """
+    @param consume_rate: tasks/s of a worker assumed by the autoscaler until it measures it
+    @param worker_options: extra Worker keyword arguments (batch_size, mode, codecs, shm_threshold...)
+    @param autoscaler_options: extra Autoscaler keyword arguments (target_age, cool-downs, max_step...)
+    @param reserve: warmed up idle workers the Watchdog scales up from
+    @param worker_queue: see Watchdog
+    @param drain_timeout: see Watchdog
+    @param shm_max_age: see Watchdog
+    """
+    worker_options = worker_options or {}
 
     current_workers = collections.deque()
 
     def inner(_current_workers):
         for _ in range(initial_workers):
-            worker = Worker(jobs, results, wait=False, poison_pill=poison_pill)
+            worker = Worker(worker_queue or jobs, results, wait=False, poison_pill=poison_pill, **worker_options)
             worker.deamon = True
             worker.start()
             _current_workers.append(worker)
@@ -130,46 +209,67 @@ def workerpool(jobs, results, initial_workers=2, max_workers=8, poison_pill='-ST
                         max_workers=max_workers,
                         sample_time=sample_time,
                         poison_pill=poison_pill,
-                        logger=get_logger())
+                        logger=get_logger(),
+                        worker_options=worker_options,
+                        autoscaler_options=autoscaler_options,
+                        reserve=reserve,
+                        worker_queue=worker_queue,
+                        drain_timeout=drain_timeout,
+                        shm_max_age=shm_max_age)
 
     return inner(current_workers)
 
 
-def analyze(jobs, consume_rate_setpoint, current_workers, initial_workers, max_workers, sample_time=1. / 15.):
-
-    size_t0 = jobs.qsize()
-    time.sleep(sample_time)
-    size_t1 = jobs.qsize()
-
-    rate = size_t0 - size_t1 / len(current_workers)
-
-    if len(current_workers) < initial_workers:
-        return 1
-
-    if len(current_workers) > max_workers:
-        return -1
-
-    return rate - consume_rate_setpoint
-
-
-def stop_worker(jobs_queue, poison_pill, current_workers, workers_to_kill=1):
-
-    if poison_pill is not None:
-
-        _ = [jobs_queue.put(poison_pill, 1) for _ in range(workers_to_kill)]
-
-    else:
-
-        workers = [w.stats for w in current_workers]
-        workers = [w for w in workers if w['cpu_percent'] == 0.]
-        workers = sorted(workers, key=lambda x: x['memory_percent'])
-        _ = [os.kill(workers[i * -1]['pid'], signal.SIGTERM) for i in range(workers_to_kill)]
-
-
-def start_workers(queues_conf, initial_workers=2, max_workers=8, consume_rate=10., sample_time=1, poison_pill='-STOP-'):
+def stop_worker(current_workers, workers_to_kill=1):
+    """
+    Ask the last started workers to drain: they stop fetching, finish and report the jobs they hold, then exit
+    @return: the draining workers, removed from current_workers
+    """
+    workers = [current_workers.pop() for _ in range(min(workers_to_kill, len(current_workers)))]
+    for worker in workers:
+        worker.drain()
+    return workers
+
+
+def start_workers(queues_conf, initial_workers=2, max_workers=8, consume_rate=10., sample_time=1, poison_pill='-STOP-',
+                  batch_size=1, target_age=5., reserve=2, mode='process', prefetch=None, credits=0,
+                  drain_timeout=30., preload=()):
+    """
+    @param prefetch: jobs waiting on the host per worker, fed by a HostAgent: the workers do not talk to the job
+    server. None gets the jobs from the job server in every worker
+    @param credits: jobs a worker asks for beyond its free slots, an int or 'auto' (see workers.Credits)
+    @param drain_timeout: seconds a worker removed by a scale down has to finish its jobs
+    @param preload: task modules imported by every worker, the warm ones included, on top of the 'preload' of the
+    jobs_queue configuration
+    """
     jobs, results = get_queues(init_job_client(queues_conf), init_result_client(queues_conf))
+    host = queues_conf['jobs_queue'].get('host') or socket.gethostname()
+    visibility = queues_conf['jobs_queue'].get('visibility_timeout')
+    max_attempts = queues_conf['jobs_queue'].get('max_attempts', 5)
+    # the task modules, jobs name their functions and a worker resolves them in its own registry
+    preload = tuple(queues_conf['jobs_queue'].get('preload', ())) + tuple(preload)
+    agent = None
+    if prefetch:
+        agent = HostAgent(jobs, slots=max_workers + reserve, prefetch=prefetch, host=host, visibility=visibility,
+                          max_attempts=max_attempts)
+        agent.start()
     pool = workerpool(jobs, results, initial_workers, max_workers, poison_pill,
-                      consume_rate=consume_rate, sample_time=sample_time)
+                      consume_rate=consume_rate, sample_time=sample_time,
+                      worker_options=dict(batch_size=batch_size,
+                                          mode=mode,
+                                          codec=queues_conf['jobs_queue'].get('codec', 'pickle'),
+                                          results_codec=queues_conf['results_queue'].get('codec', 'json'),
+                                          shm_threshold=queues_conf['results_queue'].get('shm_threshold'),
+                                          visibility=visibility,
+                                          max_attempts=max_attempts,
+                                          host=host,
+                                          credits=credits,
+                                          preload=preload),
+                      autoscaler_options=dict(target_age=target_age),
+                      reserve=reserve,
+                      worker_queue=agent.queue if agent is not None else None,
+                      drain_timeout=drain_timeout,
+                      shm_max_age=max(queues_conf['results_queue'].get('ttl') or 0, shm.MAX_AGE))
     pool.serve_forever()
 
 
@@ -194,9 +294,23 @@ def parse_commandline_args():
         '--rate',
         default=10.,
         type=float,
-        help='consuming rate threshold',
+        help='tasks/s of a worker, until measured by the autoscaler',
         dest='consume_rate',
     )
+    parser.add_argument(
+        '--target_age',
+        default=5.,
+        type=float,
+        help='seconds the autoscaler lets the backlog take to drain',
+        dest='target_age',
+    )
+    parser.add_argument(
+        '--reserve',
+        default=2,
+        type=int,
+        help='warmed up idle workers kept ready for the scale ups',
+        dest='reserve',
+    )
     parser.add_argument(
         '--sample_time',
         default=1.,
@@ -211,6 +325,48 @@ def parse_commandline_args():
         help='message for stop',
         dest='poison_pill',
     )
+    parser.add_argument(
+        '--batch_size',
+        default=16,
+        type=int,
+        help='tasks fetched per round-trip',
+        dest='batch_size',
+    )
+    parser.add_argument(
+        '--mode',
+        default='process',
+        type=str,
+        help='execution mode of a worker: process or threads:N, N concurrent I/O bound jobs',
+        dest='mode',
+    )
+    parser.add_argument(
+        '--prefetch',
+        default=None,
+        type=int,
+        help='jobs waiting on the host per worker: a host agent alone talks to the job server for the workers',
+        dest='prefetch',
+    )
+    parser.add_argument(
+        '--credits',
+        default='0',
+        type=str,
+        help="jobs a worker asks for beyond its free slots, or 'auto' to cover the job server round-trip",
+        dest='credits',
+    )
+    parser.add_argument(
+        '--drain_timeout',
+        default=30.,
+        type=float,
+        help='seconds a worker removed by a scale down has to finish its jobs before it is stopped hard',
+        dest='drain_timeout',
+    )
+    parser.add_argument(
+        '--preload',
+        default=[],
+        action='append',
+        help='task module imported by the workers before their first job, repeat for several modules',
+        dest='preload',
+    )
     parsed_args = parser.parse_args()
     return parsed_args
 
@@ -218,7 +374,9 @@ def parse_commandline_args():
 def main():
     args = parse_commandline_args()
     start_workers(queues_configuration, args.initial_workers, args.max_workers,
-                  args.consume_rate, args.sample_time, args.poison_pill)
+                  args.consume_rate, args.sample_time, args.poison_pill, args.batch_size, args.target_age,
+                  args.reserve, args.mode, args.prefetch,
+                  args.credits if args.credits == 'auto' else int(args.credits), args.drain_timeout, args.preload)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+from __future__ import print_function
+import argparse
+from Queue import Empty
+import threading
+import time
+import uuid
+from src.utils.agent import HostAgent
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.utils.workers import Worker
+from src.tests.bench_utils import connect, stop_workers
+
+
+class CountingQueue(TasksPriorityQueue):
+    """
+    Job queue counting the calls of the workers (or of the agent)
+    """
+
+    def __init__(self):
+        TasksPriorityQueue.__init__(self)
+        self.counts = dict(get_many=0, task_done_many=0)
+
+    def get_many(self, *args, **kwargs):
+        self.counts['get_many'] += 1
+        return TasksPriorityQueue.get_many(self, *args, **kwargs)
+
+    def task_done_many(self, *args, **kwargs):
+        self.counts['task_done_many'] += 1
+        return TasksPriorityQueue.task_done_many(self, *args, **kwargs)
+
+    def calls(self):
+        return sum(self.counts.values())
+
+
+@task(name='noop')
+def noop(n):
+    return n
+
+
+def probe(jobs, stop, latencies):
+    """
+    Another client of the job server, its round-trip time shows the server load
+    """
+    while not stop.is_set():
+        t0 = time.time()
+        jobs.qsize()
+        latencies.append(time.time() - t0)
+        time.sleep(0.01)
+
+
+def run(jobs, results, count, args, prefetch=None):
+    """
+    @return: tasks/s, job server calls per task, probe median round-trip ms, jobs stolen between local workers
+    """
+    agent = None
+    if prefetch:
+        agent = HostAgent(jobs, slots=count, prefetch=prefetch)
+        agent.start()
+    workers = [Worker(agent.queue if agent else jobs, results, wait=False, poison_pill='-STOP-')
+               for _ in range(count)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    time.sleep(1. + count * 0.05)
+
+    ids = [str(uuid.uuid4()) for _ in range(args.tasks)]
+    tasks = [Task(_id, noop, (n,)) for n, _id in enumerate(ids)]
+    stop, latencies = threading.Event(), []
+    prober = threading.Thread(target=probe, args=(jobs, stop, latencies))
+    calls = jobs.calls()
+    t0 = time.time()
+    prober.start()
+    for i in range(0, len(tasks), 500):
+        jobs.put_many(tasks[i:i + 500], 1)
+    for _id in ids:
+        results.wait_result(_id, timeout=120, pop=True)
+    elapsed = time.time() - t0
+    stop.set()
+    prober.join()
+    calls = jobs.calls() - calls
+    stolen = agent.queue.stats()['stolen'] if agent else None
+
+    stop_workers(jobs, workers)
+    if agent is not None:
+        agent.stop()
+        agent.join()
+    # pills given back by the agent
+    try:
+        jobs.task_done_many(len(jobs.get_many(args.tasks, timeout=0)))
+    except Empty:
+        pass
+    return args.tasks / elapsed, calls / float(args.tasks), sorted(latencies)[len(latencies) // 2] * 1000, stolen
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Host agent: job server calls and throughput by local workers')
+    parser.add_argument('--tasks', default=3000, type=int, dest='tasks')
+    parser.add_argument('--prefetch', default=4, type=int, dest='prefetch', help='jobs waiting per local worker')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': CountingQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+        print("{} noop tasks, agent prefetch {} per worker".format(args.tasks, args.prefetch))
+        print("{:>8} {:>8} {:>10} {:>16} {:>16} {:>8}".format('workers', 'mode', 'tasks/s', 'server calls/task',
+                                                               'probe p50 ms', 'stolen'))
+        for count in (2, 8, 32):
+            for mode, prefetch in (('direct', None), ('agent', args.prefetch)):
+                rate, calls, latency, stolen = run(jobs, results, count, args, prefetch)
+                print("{:>8} {:>8} {:>10.0f} {:>16.3f} {:>16.2f} {:>8}".format(
+                    count, mode, rate, calls, latency, '-' if stolen is None else stolen))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
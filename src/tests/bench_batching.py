@@ -0,0 +1,59 @@
+from __future__ import print_function
+import argparse
+import time
+from src.utils.managers import QueueManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.register_task import factorial_function
+from src.utils.tasks import Task
+from src.tests.bench_utils import connect
+
+
+def bench(jobs, batch_size, n_tasks):
+    tasks = [Task(str(n), factorial_function, n) for n in range(n_tasks)]
+
+    t0 = time.time()
+    if batch_size == 1:
+        for t in tasks:
+            jobs.put(t, 500)
+    else:
+        for i in range(0, n_tasks, batch_size):
+            jobs.put_many(tasks[i:i + batch_size], 500)
+    t1 = time.time()
+
+    fetched = 0
+    while fetched < n_tasks:
+        if batch_size == 1:
+            jobs.get()
+            fetched += 1
+        else:
+            fetched += len(jobs.get_many(batch_size))
+    t2 = time.time()
+
+    return n_tasks / (t1 - t0), n_tasks / (t2 - t1)
+
+
+def run(port, authkey, args):
+    jobs = connect(('localhost', port), authkey, ['tasks_queue']).get_tasks_queue()
+    print("{:>10} {:>14} {:>14}".format('batch', 'put tasks/s', 'get tasks/s'))
+    for batch_size in args.batch_sizes:
+        put_rate, get_rate = bench(jobs, batch_size, args.tasks)
+        print("{:>10} {:>14.0f} {:>14.0f}".format(batch_size, put_rate, get_rate))
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Batched put/get benchmark')
+    parser.add_argument('--tasks', default=10000, type=int, dest='tasks')
+    parser.add_argument('--batch_sizes', default=[1, 16, 256], type=int, nargs='+', dest='batch_sizes')
+    args = parser.parse_args()
+
+    port, authkey = HostUtils.get_port(), 'bench'
+    server = start_server(QueueManager(address='localhost', port=port, authkey=authkey,
+                                       queues={'tasks_queue': TasksPriorityQueue()}))
+    try:
+        run(port, authkey, args)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
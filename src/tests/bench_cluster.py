@@ -0,0 +1,171 @@
+from __future__ import print_function
+import argparse
+import threading
+import time
+import uuid
+import zlib
+from src.utils.cluster import ClusterMap, HashRing, partition_key
+from src.utils.managers import (QueueManager, SharedResultsManager, PartitionedClientManager, HostUtils,
+                                start_server)
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+
+@task(name='noop')
+def noop(n):
+    return n
+
+
+def start_partitions(members, authkey, spares=0):
+    """
+    Job servers of members, every one with the cluster map of members, and spares servers outside of the map
+    @return: server processes, spare addresses
+    """
+    spare = [('localhost', HostUtils.get_port()) for _ in range(spares)]
+    servers = [start_server(QueueManager(address=address, port=port, authkey=authkey,
+                                         queues={'tasks_queue': TasksPriorityQueue(),
+                                                 'cluster_map': ClusterMap(members)}))
+               for address, port in list(members) + spare]
+    return servers, spare
+
+
+def cluster_queue(members, authkey, codec):
+    client = PartitionedClientManager(members, authkey, codec=codec, refresh=0.5)
+    for member in members:
+        connect(member, authkey, [])
+    return client.get_tasks_queue()
+
+
+def produce(jobs, tasks, batch, errors):
+    """
+    Encoded tasks, partitioned by the keys of the tasks
+    """
+    try:
+        for i in range(0, len(tasks), batch):
+            jobs.put_many([t.encode(jobs.codec) for t in tasks[i:i + batch]], 1,
+                          keys=[partition_key(t) for t in tasks[i:i + batch]])
+    except Exception as e:
+        errors.append(e)
+
+
+def wait_results(results, ids, timeout):
+    found, deadline = set(), time.time() + timeout
+    while len(found) < len(ids) and time.time() < deadline:
+        found.update(results.get_many([_id for _id in ids if _id not in found], pop=True))
+        time.sleep(0.05)
+    return len(ids) - len(found)
+
+
+def scaling(jobs, results, args):
+    """
+    @return: tasks/s of producers and workers going through the partitions, busiest partition share of the tasks
+    """
+    workers = start_workers(jobs, results, args.workers, batch_size=args.worker_batch, codec=jobs.codec)
+    time.sleep(1. + args.workers * 0.05)
+    before = jobs.partition_stats()
+    tasks = [Task(str(uuid.uuid4()), noop, (n,)) for n in range(args.tasks)]
+    share = len(tasks) // args.producers
+    producers = [threading.Thread(target=produce, args=(jobs, tasks[n * share:(n + 1) * share], args.batch, []))
+                 for n in range(args.producers)]
+    t0 = time.time()
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    lost = wait_results(results, [t.id for t in tasks[:share * args.producers]], 120)
+    elapsed = time.time() - t0
+    after = jobs.partition_stats()
+    stop_workers(jobs, workers)
+    put = [after[m]['submitted'] - before[m]['submitted'] for m in after]
+    return share * args.producers / elapsed, max(put) / float(sum(put)), lost
+
+
+def rebalance(jobs, results, spare, args):
+    """
+    A partition joins while half of the tasks wait for the workers, another one leaves while the producer puts
+    the other half. Half of the tasks have a routing key
+    @return: items moved on join, on leave, tasks without a result
+    """
+    tasks = [Task(str(uuid.uuid4()), noop, (n,), routing_key='key{}'.format(n % 50) if n % 2 else None)
+             for n in range(args.tasks)]
+    half, errors = len(tasks) // 2, []
+    produce(jobs, tasks[:half], 100, errors)
+    joined = jobs.add_partition(spare)
+    workers = start_workers(jobs, results, args.workers, batch_size=args.worker_batch, codec=jobs.codec)
+    producer = threading.Thread(target=produce, args=(jobs, tasks[half:], 20, errors))
+    producer.start()
+    time.sleep(0.2)
+    left = jobs.remove_partition(jobs.ring.members[0])
+    producer.join()
+    lost = wait_results(results, [t.id for t in tasks], 120)
+    stop_workers(jobs, workers)
+    if errors:
+        raise errors[0]
+    return joined, left, lost
+
+
+def moved_fraction(keys, before, after):
+    """
+    @return: fraction of keys changing partition from before to after partitions, by consistent and by modulo hash
+    """
+    ring = HashRing([('localhost', 10000 + n) for n in range(before)])
+    owners = [ring.owner(k) for k in keys]
+    ring.add(('localhost', 10000 + before))
+    consistent = sum(owner != ring.owner(k) for owner, k in zip(owners, keys))
+    modulo = sum(zlib.crc32(k) % before != zlib.crc32(k) % after for k in keys)
+    return consistent / float(len(keys)), modulo / float(len(keys))
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Job server cluster: throughput by partitions and rebalancing')
+    parser.add_argument('--tasks', default=6000, type=int, dest='tasks')
+    parser.add_argument('--producers', default=4, type=int, dest='producers')
+    parser.add_argument('--batch', default=10, type=int, dest='batch', help='tasks per put_many')
+    parser.add_argument('--workers', default=8, type=int, dest='workers')
+    parser.add_argument('--worker_batch', default=4, type=int, dest='worker_batch', help='Worker batch_size')
+    parser.add_argument('--codec', default='pickle', type=str, dest='codec', help='codec the tasks are put with')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    # every server up front: a server forked later from this process can take seconds to come up
+    clusters, servers = [], []
+    for partitions in (1, 2, 4):
+        members = [('localhost', HostUtils.get_port()) for _ in range(partitions)]
+        started, _ = start_partitions(members, authkey)
+        servers.extend(started)
+        clusters.append(members)
+    members = [('localhost', HostUtils.get_port()) for _ in range(3)]
+    started, spare = start_partitions(members, authkey, spares=1)
+    servers.extend(started)
+    results_address = ('localhost', HostUtils.get_port())
+    servers.append(start_server(SharedResultsManager(address=results_address[0], port=results_address[1],
+                                                     authkey=authkey)))
+    try:
+        results = connect(results_address, authkey, []).get_results()
+        print("{} noop tasks put {} at a time by {} producers ({}), {} workers getting {} at a time".format(
+            args.tasks, args.batch, args.producers, args.codec, args.workers, args.worker_batch))
+        print("{:>11} {:>10} {:>16} {:>6}".format('partitions', 'tasks/s', 'busiest share', 'lost'))
+        for cluster in clusters:
+            rate, busiest, lost = scaling(cluster_queue(cluster, authkey, args.codec), results, args)
+            print("{:>11} {:>10.0f} {:>16.2f} {:>6}".format(len(cluster), rate, busiest, lost))
+
+        keys = [str(uuid.uuid4()) for _ in range(20000)]
+        print("keys changing partition when one is added")
+        print("{:>11} {:>12} {:>8}".format('partitions', 'consistent', 'modulo'))
+        for before in (1, 2, 4, 8):
+            consistent, modulo = moved_fraction(keys, before, before + 1)
+            print("{:>11} {:>12.3f} {:>8.3f}".format('{}->{}'.format(before, before + 1), consistent, modulo))
+
+        for address in spare:
+            connect(address, authkey, [])
+        joined, left, lost = rebalance(cluster_queue(members, authkey, args.codec), results, spare[0], args)
+        print("rebalance, {} tasks: 3->4 partitions with {} waiting moved {}, 4->3 under load moved {}, "
+              "lost {}".format(args.tasks, args.tasks // 2, joined, left, lost))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
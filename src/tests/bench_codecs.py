@@ -0,0 +1,40 @@
+from __future__ import print_function
+import argparse
+import time
+from src.utils.register_task import factorial_function
+from src.utils.serializers import codecs_setup, get_codec
+from src.utils.tasks import Task
+
+
+def bench(codec, tasks):
+    t0 = time.time()
+    payloads = [t.encode(codec) for t in tasks]
+    t1 = time.time()
+    for p in payloads:
+        Task.decode(p, codec)
+    t2 = time.time()
+
+    n = float(len(tasks))
+    return (t1 - t0) / n * 1e6, (t2 - t1) / n * 1e6, sum(len(p) for p in payloads) / n
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Task codecs micro-benchmark')
+    parser.add_argument('--tasks', default=10000, type=int, dest='tasks')
+    parser.add_argument('--codecs', default=sorted(codecs_setup), nargs='+', dest='codecs')
+    args = parser.parse_args()
+
+    tasks = [Task(str(n), factorial_function, [n, {'attempt': 1}]) for n in range(args.tasks)]
+
+    print("{:>10} {:>14} {:>14} {:>14}".format('codec', 'encode us/task', 'decode us/task', 'bytes/task'))
+    for name in args.codecs:
+        try:
+            codec = get_codec(name)
+        except ImportError as e:
+            print("{:>10} skipped: {}".format(name, e))
+            continue
+        print("{:>10} {:>14.2f} {:>14.2f} {:>14.1f}".format(name, *bench(codec, tasks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task, delayed_task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+DELAY = 1.
+
+
+@task(name='sleep_then_run')
+def sleep_then_run(n):
+    """
+    The former @delayed_task: the delay slept inside the worker
+    """
+    time.sleep(DELAY)
+    return n
+
+
+@delayed_task(name='run_later', wait=DELAY)
+def run_later(n):
+    return n
+
+
+def run(jobs, results, tasks, use_eta):
+    """
+    @return: seconds until every task ran, worst lateness past the requested delay
+    """
+    t0 = time.time()
+    for t in tasks:
+        if use_eta:
+            jobs.put(t, 1, eta=t.eta)
+        else:
+            jobs.put(t, 1)
+    for t in tasks:
+        results.wait_result(t.id, timeout=600, pop=True)
+    elapsed = time.time() - t0
+    return elapsed, elapsed - DELAY
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Delayed tasks: sleeping workers vs queue side eta')
+    parser.add_argument('--tasks', default=20, type=int, dest='tasks')
+    parser.add_argument('--workers', default=2, type=int, dest='workers')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+        workers = start_workers(jobs, results, args.workers)
+
+        print("{} tasks delayed {}s, {} workers".format(args.tasks, DELAY, args.workers))
+        print("{:>26} {:>12} {:>14}".format('mode', 'total s', 'max late s'))
+        modes = [('sleep in worker', sleep_then_run, False), ('eta, put without it', run_later, False),
+                 ('eta, held by the queue', run_later, True)]
+        for name, func, use_eta in modes:
+            tasks = [Task(str(uuid.uuid4()), func, (n,)) for n in range(args.tasks)]
+            elapsed, late = run(jobs, results, tasks, use_eta)
+            print("{:>26} {:>12.3f} {:>14.3f}".format(name, elapsed, late))
+
+        stop_workers(jobs, workers, 0)
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+from __future__ import print_function
+import argparse
+import os
+import random
+import signal
+import threading
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.utils.workers import Worker
+from src.tests.bench_utils import connect
+
+
+@task(name='soak')
+def soak(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def produce(jobs, ids, args):
+    rng = random.Random(5)
+    for i in range(0, len(ids), args.batch):
+        jobs.put_many([Task(_id, soak, [rng.uniform(0.005, args.max_job)]) for _id in ids[i:i + args.batch]], 1)
+        time.sleep(args.batch / args.rate)
+
+
+def retire(worker, how):
+    if how == 'drain':
+        worker.drain()
+    elif how == 'hard stop':
+        os.kill(worker.pid, signal.SIGUSR1)
+    else:
+        os.kill(worker.pid, signal.SIGKILL)
+
+
+def soak_run(jobs, results, args, how, options):
+    """
+    Workers are retired (how) and replaced every args.churn seconds while a producer keeps putting tasks
+    @return: workers retired, tasks without a result, seconds
+    """
+    start = lambda: Worker(jobs, results, wait=False, poison_pill='-STOP-', **options)
+    workers = [start() for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    ids = [str(uuid.uuid4()) for _ in range(args.tasks)]
+    producer = threading.Thread(target=produce, args=(jobs, ids, args))
+    t0 = time.time()
+    producer.start()
+    rng, retired, gone = random.Random(7), 0, []
+    while producer.is_alive():
+        time.sleep(args.churn)
+        victim = workers.pop(rng.randrange(len(workers)))
+        retire(victim, how)
+        gone.append(victim)
+        retired += 1
+        workers.append(start())
+        workers[-1].start()
+    producer.join()
+
+    found, deadline = {}, time.time() + args.settle
+    while len(found) < len(ids) and time.time() < deadline:
+        found.update(results.get_many([_id for _id in ids if _id not in found], pop=True))
+        time.sleep(0.2)
+    elapsed = time.time() - t0
+    for _ in workers:
+        jobs.put('-STOP-', 1)
+    for worker in workers + gone:
+        worker.join()
+    return retired, len(ids) - len(found), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Scale down soak: tasks lost by retired workers')
+    parser.add_argument('--tasks', default=2000, type=int, dest='tasks')
+    parser.add_argument('--rate', default=200., type=float, dest='rate', help='tasks/s put by the producer')
+    parser.add_argument('--batch', default=20, type=int, dest='batch')
+    parser.add_argument('--max_job', default=0.05, type=float, dest='max_job', help='seconds, job time upper bound')
+    parser.add_argument('--workers', default=4, type=int, dest='workers')
+    parser.add_argument('--churn', default=0.5, type=float, dest='churn', help='seconds between two retirements')
+    parser.add_argument('--settle', default=20., type=float, dest='settle',
+                        help='seconds waited for the last results, leased jobs come back after their visibility')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    setups = [(how, name, options) for how in ('drain', 'hard stop', 'kill -9')
+              for name, options in (('process', dict(batch_size=4)), ('threads:4', dict(mode='threads:4')),
+                                    ('leased', dict(batch_size=4, visibility=5.)))]
+    # every server up front: a server forked later from this process can take seconds to come up
+    addresses, servers = [], []
+    for _ in setups:
+        jobs_address, results_address = ('localhost', HostUtils.get_port()), ('localhost', HostUtils.get_port())
+        servers.append(start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                                 queues={'tasks_queue': TasksPriorityQueue()})))
+        servers.append(start_server(SharedResultsManager(address=results_address[0], port=results_address[1],
+                                                         authkey=authkey)))
+        addresses.append((jobs_address, results_address))
+    try:
+        print("{} tasks at {}/s, {} workers, one retired and replaced every {}s".format(
+            args.tasks, args.rate, args.workers, args.churn))
+        print("{:>10} {:>10} {:>9} {:>6} {:>9}".format('retire', 'workers', 'retired', 'lost', 'total s'))
+        for (how, name, options), (jobs_address, results_address) in zip(setups, addresses):
+            jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+            results = connect(results_address, authkey, []).get_results()
+            retired, lost, elapsed = soak_run(jobs, results, args, how, options)
+            print("{:>10} {:>10} {:>9} {:>6} {:>9.1f}".format(how, name, retired, lost, elapsed))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import PersistentPriorityQueue
+from src.utils.replication import FailoverClientManager, Replica, start_replicas
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+
+@task(name='noop')
+def noop(n):
+    return n
+
+
+class Group(object):
+    """
+    Replica group under test, its processes by address
+    """
+
+    def __init__(self, name, count, sync, authkey):
+        self.name, self.root = name, tempfile.mkdtemp(prefix='dsys-bench-failover-')
+        self.replicas = [('localhost', HostUtils.get_port()) for _ in range(count)]
+        self.processes = dict(zip(self.replicas, start_replicas(self.replicas, authkey, self.root,
+                                                                sync_replicas=sync)))
+        self.client = FailoverClientManager(self.replicas, authkey, failover_timeout=60.)
+
+    def ready(self, timeout=60.):
+        """
+        @return: job queue, once the leader has every follower in sync
+        """
+        jobs, deadline = self.client.get_tasks_queue(), time.time() + timeout
+        while time.time() < deadline:
+            followers = jobs.replication_stats()['followers']
+            if len([f for f in followers.values() if f['in_sync']]) == len(self.replicas) - 1:
+                return jobs
+            time.sleep(0.1)
+        raise RuntimeError("{} followers not in sync after {}s".format(self.name, timeout))
+
+    def leader(self):
+        with open(os.path.join(self.root, Replica.LEADER_FILE)) as f:
+            return self.processes[tuple(json.load(f)['address'])]
+
+    def close(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def produce(jobs, tasks, batch, rate, puts):
+    """
+    puts: (time the put returned, ids put)
+    """
+    for i in range(0, len(tasks), batch):
+        jobs.put_many(tasks[i:i + batch], 1)
+        puts.append((time.time(), [t.id for t in tasks[i:i + batch]]))
+        if rate:
+            time.sleep(batch / rate)
+
+
+def wait_results(results, ids, timeout):
+    found, deadline = set(), time.time() + timeout
+    while len(found) < len(ids) and time.time() < deadline:
+        found.update(results.get_many([_id for _id in ids if _id not in found], pop=True))
+        time.sleep(0.05)
+    return len(ids) - len(found)
+
+
+def throughput(jobs, results, args):
+    """
+    @return: put_many calls/s of a single producer, end to end tasks/s through the workers
+    """
+    tasks = [Task(str(uuid.uuid4()), noop, (n,)) for n in range(args.tasks)]
+    puts = []
+    t0 = time.time()
+    produce(jobs, tasks[:args.tasks // 2], args.batch, None, puts)
+    put_rate = len(puts) / (time.time() - t0)
+    workers = start_workers(jobs, results, args.workers, batch_size=4)
+    t0 = time.time()
+    produce(jobs, tasks[args.tasks // 2:], args.batch, None, puts)
+    lost = wait_results(results, [t.id for t in tasks], 120)
+    rate = args.tasks / (time.time() - t0)
+    stop_workers(jobs, workers)
+    assert not lost, "{} tasks lost".format(lost)
+    return put_rate, rate
+
+
+def failover(group, jobs, results, args):
+    """
+    The leader is killed halfway through a producer putting at args.rate
+    @return: longest put gap around the kill (s), seconds until the workers completed tasks again, puts returned
+    without a result
+    """
+    workers = start_workers(jobs, results, args.workers, batch_size=4)
+    tasks = [Task(str(uuid.uuid4()), noop, (n,)) for n in range(args.tasks)]
+    puts = []
+    producer = threading.Thread(target=produce, args=(jobs, tasks, args.batch, args.rate, puts))
+    producer.start()
+    time.sleep(args.tasks / args.rate / 2.)
+    term, killed = jobs.term, time.time()
+    os.kill(group.leader().pid, signal.SIGKILL)
+    # completed counts the tasks done on the new leader only
+    while jobs.term == term or not jobs.stats()['completed']:
+        jobs.stats()
+        time.sleep(0.01)
+    resumed = time.time()
+    producer.join()
+    ids = [_id for _, batch in puts for _id in batch]
+    lost = wait_results(results, ids, 60)
+    stop_workers(jobs, workers)
+    times = [killed] + sorted(t for t, _ in puts if t > killed)
+    return times[1] - times[0] if len(times) > 1 else None, resumed - killed, lost
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Replicated job queue: replication cost and leader failover')
+    parser.add_argument('--tasks', default=4000, type=int, dest='tasks')
+    parser.add_argument('--batch', default=10, type=int, dest='batch', help='tasks per put_many')
+    parser.add_argument('--workers', default=4, type=int, dest='workers')
+    parser.add_argument('--rate', default=1000., type=float, dest='rate', help='tasks/s put in the failover runs')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    # every server up front: a server forked later from this process can take seconds to come up
+    storage = tempfile.mkdtemp(prefix='dsys-bench-failover-')
+    persistent_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [start_server(QueueManager(address=persistent_address[0], port=persistent_address[1], authkey=authkey,
+                                         queues={'tasks_queue': PersistentPriorityQueue(storage)})),
+               start_server(SharedResultsManager(address=results_address[0], port=results_address[1],
+                                                 authkey=authkey))]
+    groups = [Group('async x2', 2, False, authkey), Group('sync x2', 2, True, authkey),
+              Group('sync x3', 3, True, authkey)]
+    failovers = [Group('async x3', 3, False, authkey), Group('sync x3', 3, True, authkey)]
+    try:
+        results = connect(results_address, authkey, []).get_results()
+        print("{} noop tasks put {} at a time, {} workers".format(args.tasks, args.batch, args.workers))
+        print("{:>12} {:>11} {:>10}".format('replicas', 'puts/s', 'tasks/s'))
+        jobs = connect(persistent_address, authkey, ['tasks_queue']).get_tasks_queue()
+        print("{:>12} {:>11.0f} {:>10.0f}".format('none', *throughput(jobs, results, args)))
+        for group in groups:
+            print("{:>12} {:>11.0f} {:>10.0f}".format(group.name, *throughput(group.ready(), results, args)))
+
+        print("leader killed halfway through {} tasks put at {}/s".format(args.tasks, args.rate))
+        print("{:>12} {:>14} {:>20} {:>6}".format('replicas', 'put gap s', 'workers resumed s', 'lost'))
+        for group in failovers:
+            gap, resumed, lost = failover(group, group.ready(), results, args)
+            print("{:>12} {:>14.3f} {:>20.3f} {:>6}".format(group.name, gap, resumed, lost))
+    finally:
+        for server in servers:
+            server.terminate()
+        for group in groups + failovers:
+            group.close()
+        shutil.rmtree(storage, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+from __future__ import print_function
+import argparse
+import time
+from src.utils.queues import TasksPriorityQueue, FairQueue
+
+
+def starvation(queue, args):
+    """
+    The src/tests/test.py load: a backlog of priority-500 tasks, then priority-200 tasks keep arriving a bit
+    faster than the consumers get. Rounds of arrivals then gets, in process
+    @return: priority-500 tasks served, priority-200 tasks served
+    """
+    queue.put_many([('low', n) for n in range(args.backlog)], 500)
+    served = {'low': 0, 'high': 0}
+    for _ in range(args.rounds):
+        queue.put_many([('high', n) for n in range(args.arrivals)], 200)
+        for kind, _ in queue.get_many(args.gets):
+            served[kind] += 1
+    return served['low'], served['high']
+
+
+def op_cost(queue_type, size, ops=20000):
+    """
+    @return: microseconds per put + get pair at the given queue size, over mixed priorities
+    """
+    queue = queue_type()
+    for n in range(size):
+        queue.put(n, n % 7 * 100)
+    t0 = time.time()
+    for n in range(ops):
+        queue.put(n, n % 7 * 100)
+        queue.get()
+    return (time.time() - t0) / ops * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Fair scheduler queue vs priority heap')
+    parser.add_argument('--backlog', default=10000, type=int, dest='backlog', help='priority-500 tasks queued')
+    parser.add_argument('--rounds', default=2000, type=int, dest='rounds')
+    parser.add_argument('--arrivals', default=11, type=int, dest='arrivals', help='priority-200 tasks per round')
+    parser.add_argument('--gets', default=10, type=int, dest='gets', help='tasks consumed per round')
+    parser.add_argument('--max_wait', default=60., type=float, dest='max_wait')
+    args = parser.parse_args()
+
+    print("{:>14} {:>14} {:>14}".format('queue', '500 served', '200 served'))
+    for name, queue in (('priority heap', TasksPriorityQueue()), ('fair', FairQueue(max_wait=args.max_wait))):
+        low, high = starvation(queue, args)
+        print("{:>14} {:>14} {:>14}".format(name, low, high))
+        if isinstance(queue, FairQueue):
+            for priority, stats in sorted(queue.wait_stats().items()):
+                print("  priority {}: weight {weight:.3f} served {served} p50 {p50:.4f}s p95 {p95:.4f}s "
+                      "p99 {p99:.4f}s oldest {oldest:.2f}s".format(priority, **stats))
+
+    print("{:>14} {:>10} {:>14}".format('queue', 'size', 'put+get us'))
+    for name, queue_type in (('priority heap', TasksPriorityQueue), ('fair', FairQueue)):
+        for size in (1000, 100000, 1000000):
+            print("{:>14} {:>10} {:>14.1f}".format(name, size, op_cost(queue_type, size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+from __future__ import print_function
+import argparse
+import threading
+import time
+import uuid
+import psutil
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue, Backpressure
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+JOB_TIME = 0.002
+
+
+@task(name='ingest')
+def ingest(record):
+    time.sleep(JOB_TIME)
+    return len(record)
+
+
+@task(name='noop')
+def noop(n):
+    return n
+
+
+def sample(server, jobs, stop, samples):
+    """
+    Job server resident memory and queue depth, every 50ms
+    """
+    proc = psutil.Process(server.pid)
+    while not stop.is_set():
+        samples.append((proc.memory_info().rss, jobs.stats()['depth']))
+        time.sleep(0.05)
+
+
+def wait_completed(jobs, expected, timeout=300):
+    deadline = time.time() + timeout
+    while jobs.stats()['completed'] < expected:
+        if time.time() > deadline:
+            raise RuntimeError("{} tasks not completed after {}s".format(expected, timeout))
+        time.sleep(0.02)
+
+
+def flood(jobs, server, args):
+    """
+    The producer puts every task as fast as the job server lets it, refused batches are retried after a backoff
+    @return: producer seconds, total seconds, peak server RSS growth in MB, peak depth, retries
+    """
+    payload = 'x' * args.payload
+    tasks = [Task(str(uuid.uuid4()), ingest, [payload]) for _ in range(args.tasks)]
+    base = psutil.Process(server.pid).memory_info().rss
+    completed = jobs.stats()['completed']
+    stop, samples = threading.Event(), []
+    sampler = threading.Thread(target=sample, args=(server, jobs, stop, samples))
+    sampler.start()
+    retries = 0
+    t0 = time.time()
+    for i in range(0, len(tasks), args.batch):
+        while True:
+            try:
+                jobs.put_many(tasks[i:i + args.batch], 1)
+                break
+            except Backpressure:
+                retries += 1
+                time.sleep(0.01)
+    produced = time.time() - t0
+    wait_completed(jobs, completed + args.tasks)
+    elapsed = time.time() - t0
+    stop.set()
+    sampler.join()
+    return produced, elapsed, (max(rss for rss, _ in samples) - base) / 2. ** 20, max(d for _, d in samples), retries
+
+
+def throughput(jobs, results, args, credits):
+    """
+    @return: noop tasks/s of the workers asking for credits jobs beyond their free slot
+    """
+    workers = start_workers(jobs, results, args.workers, credits=credits)
+    time.sleep(1. + args.workers * 0.05)
+    completed = jobs.stats()['completed']
+    t0 = time.time()
+    tasks = [Task(str(uuid.uuid4()), noop, (n,)) for n in range(args.noops)]
+    for i in range(0, len(tasks), 500):
+        jobs.put_many(tasks[i:i + 500], 1)
+    wait_completed(jobs, completed + args.noops)
+    elapsed = time.time() - t0
+    stop_workers(jobs, workers)
+    return args.noops / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Producer flood: job server memory with and without backpressure')
+    parser.add_argument('--tasks', default=20000, type=int, dest='tasks')
+    parser.add_argument('--payload', default=2048, type=int, dest='payload', help='bytes per task')
+    parser.add_argument('--batch', default=100, type=int, dest='batch', help='tasks per put_many')
+    parser.add_argument('--workers', default=4, type=int, dest='workers')
+    parser.add_argument('--high_water', default=1000, type=int, dest='high_water')
+    parser.add_argument('--noops', default=5000, type=int, dest='noops', help='tasks of the credits comparison')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    setups = []
+    for name, high_water, overflow in (('unbounded', None, None), ('block', args.high_water, 'block'),
+                                       ('reject', args.high_water, 'reject')):
+        queue = TasksPriorityQueue()
+        if high_water:
+            queue.flow_control(high_water, overflow=overflow)
+        address = ('localhost', HostUtils.get_port())
+        setups.append((name, address, queue))
+    results_address = ('localhost', HostUtils.get_port())
+    # every server up front: a server forked later from this process can take seconds to come up
+    servers = [start_server(QueueManager(address=address[0], port=address[1], authkey=authkey,
+                                         queues={'tasks_queue': queue})) for _, address, queue in setups]
+    servers.append(start_server(SharedResultsManager(address=results_address[0], port=results_address[1],
+                                                     authkey=authkey)))
+    try:
+        results = connect(results_address, authkey, []).get_results()
+        print("{} tasks of {} bytes put {} at a time, {} workers at {}ms a task, high water mark {}".format(
+            args.tasks, args.payload, args.batch, args.workers, JOB_TIME * 1000, args.high_water))
+        print("{:>10} {:>11} {:>9} {:>15} {:>11} {:>9} {:>10} {:>10}".format(
+            'overflow', 'producer s', 'total s', 'server +RSS MB', 'peak depth', 'retries', 'throttled', 'refused'))
+        for (name, address, _), server in zip(setups, servers):
+            jobs = connect(address, authkey, ['tasks_queue']).get_tasks_queue()
+            workers = start_workers(jobs, results, args.workers)
+            produced, elapsed, rss, depth, retries = flood(jobs, server, args)
+            stats = jobs.stats()
+            print("{:>10} {:>11.2f} {:>9.2f} {:>15.1f} {:>11} {:>9} {:>10} {:>10}".format(
+                name, produced, elapsed, rss, depth, retries, stats['throttled'], stats['refused']))
+            stop_workers(jobs, workers)
+
+        jobs = connect(setups[0][1], authkey, ['tasks_queue']).get_tasks_queue()
+        print("{} noop tasks, {} workers".format(args.noops, args.workers))
+        print("{:>8} {:>10}".format('credits', 'tasks/s'))
+        for credits in (0, 'auto'):
+            print("{:>8} {:>10.0f}".format(credits, throughput(jobs, results, args, credits)))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.serializers import get_codec
+from src.utils.tasks import Task, task
+from src.utils.graphs import chain, group, chord
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+FETCH_LATENCY = 0.02
+STORE_LATENCY = 0.005
+
+codec = get_codec('json')
+
+
+@task(name='figi_fetch')
+def figi_fetch(ticker):
+    """
+    Stands for OpenFigiApi.fetch_data: a network round-trip
+    """
+    time.sleep(FETCH_LATENCY)
+    return {'ticker': ticker, 'figi': 'BBG{:09d}'.format(abs(hash(ticker)) % 10 ** 9), 'prices': range(50)}
+
+
+@task(name='figi_transform')
+def figi_transform(record):
+    return dict(record, mean=sum(record['prices']) / float(len(record['prices'])), prices=None)
+
+
+@task(name='figi_store')
+def figi_store(record):
+    time.sleep(STORE_LATENCY)
+    return record['figi']
+
+
+@task(name='figi_merge')
+def figi_merge(records):
+    return sorted(r['figi'] for r in records)
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+
+def client_driven(jobs, results, tickers):
+    """
+    Today: the client waits for every stage and enqueues the next one with the results
+    @return: final results, client calls
+    """
+    values = tickers
+    for func in (figi_fetch, figi_transform, figi_store):
+        stage = [Task(new_id(), func, [v]) for v in values]
+        jobs.put_many(stage, 1)
+        values = [codec.loads(results.wait_result(t.id, timeout=60, pop=True)) for t in stage]
+    return values, 3 + 3 * len(tickers)
+
+
+def graph_driven(jobs, results, tickers):
+    """
+    One chain per ticker, all submitted in one call, the job queue releases each stage
+    @return: final results, client calls
+    """
+    leaves = group(*[chain(Task(new_id(), figi_fetch, [ticker]), Task(new_id(), figi_transform, []),
+                           Task(new_id(), figi_store, [])) for ticker in tickers]).submit(jobs)
+    return [codec.loads(results.wait_result(leaf, timeout=60, pop=True)) for leaf in leaves], 1 + len(leaves)
+
+
+def fan_in(jobs, results, tickers):
+    merge = chord([chain(Task(new_id(), figi_fetch, [t]), Task(new_id(), figi_transform, [])) for t in tickers],
+                  Task(new_id(), figi_merge, []))
+    leaf, = merge.submit(jobs)
+    return codec.loads(results.wait_result(leaf, timeout=60, pop=True))
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Task graphs: fetch -> transform -> store pipelines')
+    parser.add_argument('--pipelines', default=200, type=int, dest='pipelines')
+    parser.add_argument('--workers', default=8, type=int, dest='workers')
+    parser.add_argument('--rounds', default=5, type=int, dest='rounds')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+        workers = start_workers(jobs, results, args.workers)
+
+        print("{} workers, fetch {}s, store {}s, best of {}".format(args.workers, FETCH_LATENCY, STORE_LATENCY,
+                                                                     args.rounds))
+        print("{:>14} {:>10} {:>12} {:>12} {:>13}".format('driver', 'pipelines', 'total s', 'pipelines/s',
+                                                           'client calls'))
+        for size in (1, args.pipelines):
+            tickers = ['T{:04d}'.format(n) for n in range(size)]
+            expected = None
+            for name, run in (('client stages', client_driven), ('graph', graph_driven)):
+                best = None
+                for _ in range(args.rounds):
+                    t0 = time.time()
+                    out, calls = run(jobs, results, tickers)
+                    elapsed = time.time() - t0
+                    best = elapsed if best is None else min(best, elapsed)
+                    assert expected is None or out == expected, "{} results differ".format(name)
+                    expected = out
+                print("{:>14} {:>10} {:>12.3f} {:>12.0f} {:>13}".format(name, size, best, size / best, calls))
+
+        t0 = time.time()
+        merged = fan_in(jobs, results, ['T{:04d}'.format(n) for n in range(args.pipelines)])
+        print("chord of {} fetch -> transform chains into one merge: {:.3f}s, {} figis, queue stats {}".format(
+            args.pipelines, time.time() - t0, len(merged),
+            {k: v for k, v in jobs.stats().items() if k in ('blocked', 'size', 'in_flight')}))
+
+        stop_workers(jobs, workers, 0)
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
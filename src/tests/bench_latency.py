@@ -0,0 +1,81 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.register_task import factorial_function
+from src.utils.tasks import Task
+from src.utils.workers import Worker
+from src.tests.bench_utils import connect
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100.), len(samples) - 1)]
+
+
+def polling_roundtrip(jobs, results, poll_interval):
+    _id = str(uuid.uuid4())
+    t0 = time.time()
+    jobs.put(Task(_id, factorial_function, 5), 1)
+    while True:
+        try:
+            results.pop(_id)
+            return time.time() - t0
+        except KeyError:
+            time.sleep(poll_interval)
+
+
+def waiting_roundtrip(jobs, results):
+    _id = str(uuid.uuid4())
+    t0 = time.time()
+    jobs.put(Task(_id, factorial_function, 5), 1)
+    results.wait_result(_id, timeout=10, pop=True)
+    return time.time() - t0
+
+
+def run(jobs_address, results_address, authkey, args):
+    jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+    results = connect(results_address, authkey, []).get_results()
+    worker = Worker(jobs, results, wait=False, poison_pill='-STOP-')
+    worker.start()
+
+    try:
+        modes = [('wait_result', lambda: waiting_roundtrip(jobs, results))]
+        modes += [('poll {}s'.format(p), lambda p=p: polling_roundtrip(jobs, results, p)) for p in args.poll]
+
+        print("{:>14} {:>12} {:>12}".format('mode', 'p50 ms', 'p99 ms'))
+        for name, roundtrip in modes:
+            samples = [roundtrip() for _ in range(args.tasks)]
+            print("{:>14} {:>12.3f} {:>12.3f}".format(name, percentile(samples, 50) * 1000,
+                                                      percentile(samples, 99) * 1000))
+    finally:
+        jobs.put('-STOP-', 0)
+        worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] End-to-end task latency benchmark')
+    parser.add_argument('--tasks', default=500, type=int, dest='tasks')
+    parser.add_argument('--poll', default=[0.01, 0.1], type=float, nargs='+', dest='poll',
+                        help='polling intervals compared to wait_result')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        run(jobs_address, results_address, authkey, args)
+    finally:
+        for s in servers:
+            s.terminate()
+
+
+if __name__ == '__main__':
+    main()
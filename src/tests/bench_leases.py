@@ -0,0 +1,152 @@
+from __future__ import print_function
+import argparse
+import os
+import signal
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+
+@task(name='noop')
+def noop(n):
+    return n
+
+
+@task(name='slow')
+def slow(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+@task(name='poison')
+def poison(n):
+    """
+    Takes its worker down, a failing task would only log its error and return None
+    """
+    os._exit(1)
+
+
+def throughput(jobs, results, args, **options):
+    """
+    @return: tasks/s of noop tasks through the workers
+    """
+    workers = start_workers(jobs, results, args.workers, **options)
+    ids = [str(uuid.uuid4()) for _ in range(args.tasks)]
+    t0 = time.time()
+    jobs.put_many([Task(_id, noop, (n,)) for n, _id in enumerate(ids)], 1)
+    for _id in ids:
+        results.wait_result(_id, timeout=60, pop=True)
+    elapsed = time.time() - t0
+    stop_workers(jobs, workers, 0)
+    return args.tasks / elapsed
+
+
+def round_trips(jobs, batch_size, leased, items=20000):
+    """
+    The queue calls alone, from one client: get_many + task_done_many or lease_many + ack_many
+    @return: items/s
+    """
+    jobs.put_many(range(items), 1)
+    t0 = time.time()
+    for _ in range(items // batch_size):
+        if leased:
+            jobs.ack_many([lease for lease, _, _ in jobs.lease_many(batch_size)])
+        else:
+            jobs.task_done_many(len(jobs.get_many(batch_size)))
+    return items // batch_size * batch_size / (time.time() - t0)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def killed_mid_task(jobs, results, sig, visibility):
+    """
+    A worker is killed while it runs a task, a second worker is idle
+    @return: seconds from the kill to the result, None if the task was lost
+    """
+    victim = start_workers(jobs, results, 1, visibility=visibility)[0]
+    time.sleep(0.5)
+    _id = str(uuid.uuid4())
+    jobs.put(Task(_id, slow, (1.,)), 1)
+    time.sleep(0.3)
+    os.kill(victim._popen.pid, sig)
+    victim.join()
+    killed = time.time()
+    survivor = start_workers(jobs, results, 1, visibility=visibility)
+    try:
+        results.wait_result(_id, timeout=visibility + 5 if visibility else 5, pop=True)
+        recovered = time.time() - killed
+    except Exception:
+        recovered = None
+    stop_workers(jobs, survivor, 0)
+    # without leases the lost task stays counted as unfinished
+    jobs.task_done_many(jobs.stats()['in_flight'])
+    return recovered
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Leased deliveries: ack path cost, killed workers, dead letters')
+    parser.add_argument('--tasks', default=5000, type=int, dest='tasks')
+    parser.add_argument('--workers', default=4, type=int, dest='workers')
+    parser.add_argument('--rounds', default=9, type=int, dest='rounds', help='alternated rounds per setup, median')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+
+        print("queue calls from one client, median of {}".format(args.rounds))
+        print("{:>8} {:>16} {:>16} {:>10}".format('batch', 'get+done it/s', 'lease+ack it/s', 'cost'))
+        for batch_size in (1, 16):
+            rates = [(round_trips(jobs, batch_size, False), round_trips(jobs, batch_size, True))
+                     for _ in range(args.rounds)]
+            plain, leased = median([r[0] for r in rates]), median([r[1] for r in rates])
+            print("{:>8} {:>16.0f} {:>16.0f} {:>9.1f}%".format(batch_size, plain, leased,
+                                                               (plain - leased) / plain * 100))
+
+        print("{} noop tasks through {} workers, median of {}".format(args.tasks, args.workers, args.rounds))
+        print("{:>8} {:>16} {:>16} {:>10}".format('batch', 'get+done t/s', 'lease+ack t/s', 'cost'))
+        for batch_size in (1, 16):
+            rates = [(throughput(jobs, results, args, batch_size=batch_size),
+                      throughput(jobs, results, args, batch_size=batch_size, visibility=30.))
+                     for _ in range(args.rounds)]
+            plain, leased = median([r[0] for r in rates]), median([r[1] for r in rates])
+            print("{:>8} {:>16.0f} {:>16.0f} {:>9.1f}%".format(batch_size, plain, leased,
+                                                               (plain - leased) / plain * 100))
+
+        print("worker killed during a 1s task: seconds from the kill to the result")
+        for name, sig, visibility in (('SIGTERM, no lease', signal.SIGTERM, None),
+                                      ('SIGTERM, leased', signal.SIGTERM, 2.),
+                                      ('SIGKILL, leased', signal.SIGKILL, 2.)):
+            recovered = killed_mid_task(jobs, results, sig, visibility)
+            print("{:>20} {:>12}".format(name, 'lost' if recovered is None else '{:.2f}'.format(recovered)))
+
+        before = jobs.stats()
+        workers = start_workers(jobs, results, 4, visibility=0.2, max_attempts=3)
+        jobs.put(Task(str(uuid.uuid4()), poison, (0,)), 1)
+        time.sleep(2.)
+        stop_workers(jobs, [w for w in workers if w.is_alive()], 0)
+        dead, after = jobs.dead_letters(), jobs.stats()
+        print("poison task, 3 attempts, 4 workers: {} dead letters, {} redelivered, {} in flight".format(
+            len(dead), after['redelivered'] - before['redelivered'], after['in_flight']))
+        for letter in dead:
+            print("  attempts {attempts} reason {reason}".format(**letter))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
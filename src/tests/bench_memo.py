@@ -0,0 +1,100 @@
+from __future__ import print_function
+import argparse
+import random
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+
+def work(n):
+    """
+    Stands for factorial_function / a FIGI lookup: the same args always give the same result
+    """
+    return sum(i * i for i in xrange(n))
+
+
+@task(name='work')
+def plain_work(n):
+    return work(n)
+
+
+@task(name='work_cached', cache=True, ttl=600)
+def cached_work(n):
+    return work(n)
+
+
+@task(name='slow_cached', cache=True)
+def slow_cached(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def run(jobs, results, func, calls):
+    """
+    @return: seconds until every result landed
+    """
+    ids = [str(uuid.uuid4()) for _ in calls]
+    t0 = time.time()
+    jobs.put_many([Task(_id, func, n) for _id, n in zip(ids, calls)], 1)
+    for _id in ids:
+        results.wait_result(_id, timeout=600, pop=True)
+    return time.time() - t0
+
+
+def cache_stats(results):
+    return {k: v for k, v in results.stats().items() if k.startswith('cache_')}
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Memoized tasks: repeated calls with identical args')
+    parser.add_argument('--tasks', default=2000, type=int, dest='tasks')
+    parser.add_argument('--distinct', default=100, type=int, dest='distinct', help='distinct args among the tasks')
+    parser.add_argument('--size', default=50000, type=int, dest='size', help='work per call')
+    parser.add_argument('--workers', default=4, type=int, dest='workers')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+        workers = start_workers(jobs, results, args.workers)
+
+        # skewed reuse: a few args come back often, as the tickers of the FIGI lookups
+        rng = random.Random(7)
+        calls = [args.size + int(rng.paretovariate(1.2)) % args.distinct for _ in range(args.tasks)]
+        print("{} tasks, {} distinct args, {} workers".format(args.tasks, len(set(calls)), args.workers))
+        print("{:>10} {:>10} {:>10} {:>10} {:>12}".format('mode', 'total s', 'tasks/s', 'hit rate', 'saved s'))
+        for name, func in (('plain', plain_work), ('cached', cached_work)):
+            before = cache_stats(results)
+            elapsed = run(jobs, results, func, calls)
+            after = cache_stats(results)
+            hits, misses = [after[k] - before[k] for k in ('cache_hits', 'cache_misses')]
+            print("{:>10} {:>10.2f} {:>10.0f} {:>10.3f} {:>12.2f}".format(
+                name, elapsed, args.tasks / elapsed, float(hits) / max(hits + misses, 1),
+                after['cache_saved'] - before['cache_saved']))
+
+        before = cache_stats(results)
+        elapsed = run(jobs, results, slow_cached, [1.] * args.workers * 2)
+        after = cache_stats(results)
+        print("{} identical 1s tasks at once: {:.2f}s, computed {} time(s), {} coalesced".format(
+            args.workers * 2, elapsed, after['cache_misses'] - before['cache_misses'],
+            after['cache_coalesced'] - before['cache_coalesced']))
+
+        stop_workers(jobs, workers, 0)
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+import psutil
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+
+@task(name='io_wait')
+def io_wait(seconds):
+    """
+    Stands for a network call (OpenFigiApi.fetch_data, scrapers): the worker idles until the reply
+    """
+    time.sleep(seconds)
+    return seconds
+
+
+def memory_mb(workers):
+    """
+    Unique set size of the worker processes: the pages each one does not share with the others
+    """
+    return sum(psutil.Process(w._popen.pid).memory_full_info().uss for w in workers) / 1024. / 1024.
+
+
+def run_mode(jobs, results, processes, mode, args):
+    workers = start_workers(jobs, results, processes, mode=mode)
+    ids = [str(uuid.uuid4()) for _ in range(args.tasks)]
+
+    t0 = time.time()
+    for _id in ids:
+        jobs.put(Task(_id, io_wait, (args.latency,)), 1)
+    for _id in ids:
+        results.wait_result(_id, timeout=60, pop=True)
+    elapsed = time.time() - t0
+
+    memory = memory_mb(workers)
+    stop_workers(jobs, workers, 0)
+    return args.tasks / elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Worker execution modes on I/O bound tasks')
+    parser.add_argument('--tasks', default=1000, type=int, dest='tasks')
+    parser.add_argument('--latency', default=0.02, type=float, dest='latency', help='seconds each task waits on I/O')
+    parser.add_argument('--concurrency', default=32, type=int, dest='concurrency')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    try:
+        jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+        results = connect(results_address, authkey, []).get_results()
+        n = args.concurrency
+        setups = [(1, 'process'), (n // 4, 'process'), (n, 'process'),
+                  (1, 'threads:{}'.format(n)), (4, 'threads:{}'.format(n // 4))]
+
+        print("{:>10} {:>14} {:>12} {:>12}".format('processes', 'mode', 'tasks/s', 'USS MB'))
+        for processes, mode in setups:
+            rate, memory = run_mode(jobs, results, processes, mode, args)
+            print("{:>10} {:>14} {:>12.0f} {:>12.1f}".format(processes, mode, rate, memory))
+    finally:
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+from __future__ import print_function
+import argparse
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from src.utils.managers import QueueManager, ClientManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.rpc import get_server, get_client, add, RPCProxy
+from src.tests.bench_utils import retry
+
+
+class PlainClientManager(BaseManager):
+    """
+    Stock proxies, one connection per proxy and thread
+    """
+
+
+PlainClientManager.register('get_tasks_queue')
+
+
+def run_threads(target, n_threads, rounds):
+    """
+    rounds of n_threads short lived threads, as spawned per request by e.g. ShardedResults.wait_any
+    """
+    t0 = time.time()
+    for _ in range(rounds):
+        threads = [threading.Thread(target=target) for _ in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return time.time() - t0
+
+
+def bench_manager(address, authkey, args):
+    plain = retry(lambda: PlainClientManager(address=address, authkey=authkey), address)
+    plain.connect()
+    pooled = retry(lambda: ClientManager(address=address, authkey=authkey, queues=['tasks_queue'],
+                                         pool_size=args.pool_size), address)
+
+    print("{:>24} {:>12}".format('manager proxy', 'calls/s'))
+    for name, client in (('thread local', plain), ('pooled', pooled)):
+        queue = client.get_tasks_queue()
+
+        def calls():
+            for _ in range(args.calls):
+                queue.qsize()
+
+        elapsed = run_threads(calls, args.threads, args.rounds)
+        print("{:>24} {:>12.0f}".format(name, args.threads * args.rounds * args.calls / elapsed))
+    return pooled.pool_stats()
+
+
+def bench_rpc(port, authkey, args):
+    shared, lock = retry(lambda: RPCProxy(('localhost', port), authkey=authkey), port), threading.Lock()
+    pooled = get_client(port=port, authkey=authkey, pool_size=args.pool_size)
+
+    def shared_calls():
+        for n in range(args.calls):
+            with lock:
+                shared.add(n, 1)
+
+    def pooled_calls():
+        for n in range(args.calls):
+            pooled.add(n, 1)
+
+    print("{:>24} {:>12}".format('rpc proxy', 'calls/s'))
+    for name, calls in (('shared + lock', shared_calls), ('pooled', pooled_calls)):
+        elapsed = run_threads(calls, args.threads, args.rounds)
+        print("{:>24} {:>12.0f}".format(name, args.threads * args.rounds * args.calls / elapsed))
+    return pooled.pool_stats()
+
+
+def print_stats(stats):
+    print("  hits={hits} misses={misses} waits={waits} wait_time={wait_time:.3f}s max_wait={max_wait:.4f}s "
+          "discarded={discarded} reconnects={reconnects}".format(**stats))
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Connection pool benchmark')
+    parser.add_argument('--threads', default=16, type=int, dest='threads')
+    parser.add_argument('--rounds', default=20, type=int, dest='rounds')
+    parser.add_argument('--calls', default=50, type=int, dest='calls', help='calls per thread')
+    parser.add_argument('--pool_size', default=8, type=int, dest='pool_size')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    address = ('localhost', HostUtils.get_port())
+    rpc_port = HostUtils.get_port()
+    manager = start_server(QueueManager(address=address[0], port=address[1], authkey=authkey,
+                                        queues={'tasks_queue': TasksPriorityQueue()}))
+    rpc_server = get_server(port=rpc_port, authkey=authkey)
+    rpc_server.register_function(add)
+    rpc_server.start()
+    try:
+        print_stats(bench_manager(address, authkey, args))
+        print_stats(bench_rpc(rpc_port, authkey, args))
+    finally:
+        manager.terminate()
+        rpc_server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+from multiprocessing import Process, Queue
+from src.utils.managers import SharedResultsManager, ShardedClientManager, HostUtils, start_server
+from src.tests.bench_utils import retry
+
+
+def connect(addresses, authkey):
+    return retry(lambda: ShardedClientManager(addresses=addresses, authkey=authkey), addresses)
+
+
+def writer(addresses, authkey, n_results, batch_size, out):
+    results = connect(addresses, authkey).get_results()
+    payload = 'x' * 64
+    keys = [str(uuid.uuid4()) for _ in range(n_results)]
+    t0 = time.time()
+    for i in range(0, n_results, batch_size):
+        results.set_many({k: payload for k in keys[i:i + batch_size]})
+    out.put(time.time() - t0)
+
+
+def bench(n_shards, n_writers, n_results, batch_size):
+    authkey = 'bench'
+    addresses, servers = [], []
+    for _ in range(n_shards):
+        address = ('localhost', HostUtils.get_port())
+        servers.append(start_server(SharedResultsManager(address=address[0], port=address[1], authkey=authkey)))
+        addresses.append(address)
+
+    try:
+        connect(addresses, authkey)
+        out = Queue()
+        writers = [Process(target=writer, args=(addresses, authkey, n_results, batch_size, out))
+                   for _ in range(n_writers)]
+        for w in writers:
+            w.start()
+        elapsed = max(out.get() for _ in writers)
+        for w in writers:
+            w.join()
+        return n_writers * n_results / elapsed
+    finally:
+        for s in servers:
+            s.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Sharded results store benchmark')
+    parser.add_argument('--writers', default=16, type=int, dest='writers')
+    parser.add_argument('--results', default=20000, type=int, dest='results', help='results per writer')
+    parser.add_argument('--batch_size', default=64, type=int, dest='batch_size')
+    parser.add_argument('--shards', default=[1, 2, 4, 8], type=int, nargs='+', dest='shards')
+    args = parser.parse_args()
+
+    print("{:>8} {:>16}".format('shards', 'writes/s'))
+    for n_shards in args.shards:
+        print("{:>8} {:>16.0f}".format(n_shards, bench(n_shards, args.writers, args.results, args.batch_size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+from __future__ import print_function
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue, RoutedQueue
+from src.utils.routing import put_tasks
+from src.utils.serializers import get_codec
+from src.utils.tasks import Task, task
+from src.tests.bench_utils import connect, start_workers, stop_workers
+
+CACHE_ROOT = os.path.join(tempfile.gettempdir(), 'dsys-bench-routing')
+HOST_ENV = 'DSYS_BENCH_HOST'
+BANDWIDTH = 50 * 1024 * 1024  # bytes/s from the origin to a host
+
+codec = get_codec('json')
+
+
+@task(name='read_dataset')
+def read_dataset(key, size, capacity):
+    """
+    Reads dataset key through the local cache of the worker host (a directory per simulated host, shared by its
+    workers, LRU of capacity datasets). A miss fetches it from the origin: the cross-host bytes
+    """
+    cache = os.path.join(CACHE_ROOT, os.environ[HOST_ENV])
+    path = os.path.join(cache, key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path, None)
+        fetched = 0
+    except IOError:
+        time.sleep(size / float(BANDWIDTH))
+        data = b'x' * size
+        with open(path, 'wb') as f:
+            f.write(data)
+        fetched = size
+        evict(cache, capacity)
+    return {'host': os.environ[HOST_ENV], 'fetched': fetched, 'size': len(data)}
+
+
+def evict(cache, capacity):
+    """
+    Drop the least recently used datasets past capacity, the other workers of the host may be evicting too
+    """
+    cached = []
+    for name in os.listdir(cache):
+        try:
+            cached.append((os.path.getmtime(os.path.join(cache, name)), name))
+        except OSError:
+            pass
+    for _, name in sorted(cached)[:max(len(cached) - capacity, 0)]:
+        try:
+            os.unlink(os.path.join(cache, name))
+        except OSError:
+            pass
+
+
+def start_host_workers(jobs, results, hosts, per_host):
+    workers = []
+    for host in hosts:
+        os.environ[HOST_ENV] = host
+        workers.extend(start_workers(jobs, results, per_host, host=host))
+    return workers
+
+
+def reset_caches(hosts):
+    shutil.rmtree(CACHE_ROOT, ignore_errors=True)
+    for host in hosts:
+        os.makedirs(os.path.join(CACHE_ROOT, host))
+
+
+def run(jobs, results, keys, args, routed):
+    """
+    @return: seconds, bytes fetched from the origin, {host: tasks run}
+    """
+    tasks = [Task(str(uuid.uuid4()), read_dataset, [key, args.size, args.capacity], routing_key=key if routed else None)
+             for key in keys]
+    t0 = time.time()
+    if routed:
+        put_tasks(jobs, tasks, 1)
+    else:
+        jobs.put_many(tasks, 1)
+    fetched, ran = 0, {}
+    for t in tasks:
+        out = codec.loads(results.wait_result(t.id, timeout=120, pop=True))
+        fetched += out['fetched']
+        ran[out['host']] = ran.get(out['host'], 0) + 1
+    return time.time() - t0, fetched, ran
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Locality routing: cross-host bytes of cached dataset reads')
+    parser.add_argument('--hosts', default=4, type=int, dest='hosts')
+    parser.add_argument('--per_host', default=2, type=int, dest='per_host', help='workers per simulated host')
+    parser.add_argument('--tasks', default=1200, type=int, dest='tasks')
+    parser.add_argument('--keys', default=64, type=int, dest='keys', help='distinct datasets')
+    parser.add_argument('--size', default=256 * 1024, type=int, dest='size', help='bytes per dataset')
+    parser.add_argument('--capacity', default=24, type=int, dest='capacity', help='datasets cached per host')
+    parser.add_argument('--rounds', default=2, type=int, dest='rounds', help='rounds per setup, the first one cold')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    hosts = ['host-{}'.format(n) for n in range(args.hosts)]
+    rng = random.Random(11)
+    workloads = [('uniform', ['ds{:03d}'.format(rng.randrange(args.keys)) for _ in range(args.tasks)]),
+                 ('skewed', ['ds{:03d}'.format(int(rng.paretovariate(1.)) % args.keys) for _ in range(args.tasks)])]
+
+    print("{} hosts x {} workers, {} datasets of {} KB, {} cached per host, origin at {} MB/s".format(
+        args.hosts, args.per_host, args.keys, args.size // 1024, args.capacity, BANDWIDTH // 2 ** 20))
+    print("{:>8} {:>9} {:>6} {:>9} {:>12} {:>9} {:>22} {:>10}".format(
+        'workload', 'queue', 'round', 'total s', 'origin MB', 'misses', 'local/shared/stolen', 'max host'))
+    # every server up front: a server forked later from this process can take seconds to come up
+    setups, servers = [], []
+    for queue_name, queue, routed in (('priority', TasksPriorityQueue(), False), ('routed', RoutedQueue(), True)):
+        jobs_address = ('localhost', HostUtils.get_port())
+        results_address = ('localhost', HostUtils.get_port())
+        servers.append(start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                                 queues={'tasks_queue': queue})))
+        servers.append(start_server(SharedResultsManager(address=results_address[0], port=results_address[1],
+                                                         authkey=authkey)))
+        setups.append((queue_name, routed, jobs_address, results_address))
+    try:
+        for queue_name, routed, jobs_address, results_address in setups:
+            jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+            results = connect(results_address, authkey, []).get_results()
+            workers = start_host_workers(jobs, results, hosts, args.per_host)
+            while routed and len(jobs.routing_stats()['hosts']) < len(hosts):
+                time.sleep(0.1)
+            for workload, keys in workloads:
+                reset_caches(hosts)
+                for n in range(args.rounds):
+                    before = jobs.routing_stats() if routed else None
+                    elapsed, fetched, ran = run(jobs, results, keys, args, routed)
+                    if routed:
+                        after = jobs.routing_stats()
+                        gets = '/'.join(str(after[k] - before[k]) for k in ('local', 'shared', 'stolen'))
+                    else:
+                        gets = '-'
+                    print("{:>8} {:>9} {:>6} {:>9.2f} {:>12.1f} {:>9} {:>22} {:>10}".format(
+                        workload, queue_name, 'cold' if n == 0 else 'warm', elapsed, fetched / 2. ** 20,
+                        fetched // args.size, gets, max(ran.values())))
+
+            stop_workers(jobs, workers, 0)
+    finally:
+        for server in servers:
+            server.terminate()
+    shutil.rmtree(CACHE_ROOT, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
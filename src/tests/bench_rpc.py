@@ -0,0 +1,87 @@
+from __future__ import print_function
+import argparse
+import time
+import psutil
+from multiprocessing.connection import Client
+from src.utils.managers import HostUtils
+from src.utils.rpc import get_server, get_client, add, RPCProxy, AsyncRPCProxy
+from src.tests.bench_utils import retry
+
+
+def rss_mb(pid):
+    return psutil.Process(pid).memory_info().rss / 1024. / 1024.
+
+
+def bench_clients(server, port, authkey, n_clients, step):
+    """
+    Open n_clients idle connections, report server threads and memory along the way
+    """
+    print("{:>10} {:>10} {:>10} {:>16}".format('clients', 'threads', 'rss MB', 'ping 1 each s'))
+    proc, clients, base = psutil.Process(server.pid), [], rss_mb(server.pid)
+    while len(clients) < n_clients:
+        clients.extend(Client(('localhost', port), authkey=authkey) for _ in range(step))
+        t0 = time.time()
+        for c in clients:
+            c.send(('add', (1, 2), {}))
+        for c in clients:
+            c.recv()
+        print("{:>10} {:>10} {:>10.1f} {:>16.3f}".format(len(clients), proc.num_threads(), rss_mb(server.pid),
+                                                        time.time() - t0))
+    print("server memory per client: {:.1f} KB".format((rss_mb(server.pid) - base) * 1024 / len(clients)))
+    for c in clients:
+        c.close()
+
+
+def sync_calls(proxy, n_calls, batch_size):
+    for n in range(n_calls):
+        proxy.call('add', n, 1)
+
+
+def pipelined_calls(proxy, n_calls, batch_size):
+    futures = [proxy.call_async('add', n, 1) for n in range(n_calls)]
+    for f in futures:
+        f.result()
+
+
+def batched_calls(proxy, n_calls, batch_size):
+    futures = []
+    for i in range(0, n_calls, batch_size):
+        with proxy.batch():
+            futures.extend(proxy.call_async('add', n, 1) for n in range(i, min(i + batch_size, n_calls)))
+    for f in futures:
+        f.result()
+
+
+def bench_calls(port, authkey, n_calls, batch_size):
+    print("{:>10} {:>14} {:>14}".format('mode', 'proxy', 'calls/s'))
+    for proxy_type in (RPCProxy, AsyncRPCProxy):
+        for mode, calls in (('sync', sync_calls), ('pipelined', pipelined_calls), ('batched', batched_calls)):
+            proxy = proxy_type(('localhost', port), authkey=authkey)
+            t0 = time.time()
+            calls(proxy, n_calls, batch_size)
+            print("{:>10} {:>14} {:>14.0f}".format(mode, proxy_type.__name__, n_calls / (time.time() - t0)))
+            proxy.close()
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] RPC server benchmark')
+    parser.add_argument('--clients', default=10000, type=int, dest='clients')
+    parser.add_argument('--step', default=2500, type=int, dest='step')
+    parser.add_argument('--calls', default=20000, type=int, dest='calls')
+    parser.add_argument('--batch_size', default=100, type=int, dest='batch_size')
+    args = parser.parse_args()
+
+    port, authkey = HostUtils.get_port(), 'bench'
+    server = get_server(port=port, authkey=authkey)
+    server.register_function(add)
+    server.start()
+    try:
+        retry(lambda: get_client(port=port, authkey=authkey), port).close()
+        bench_calls(port, authkey, args.calls, args.batch_size)
+        bench_clients(server, port, authkey, args.clients, args.step)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+from __future__ import print_function
+import argparse
+import time
+import numpy
+from src.utils.managers import QueueManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.shm import SharedPayload, resolve
+from src.tests.bench_utils import connect
+
+
+def pickled_roundtrip(jobs, array):
+    t0 = time.time()
+    jobs.put(array, 1)
+    received = jobs.get()
+    received.sum()
+    return time.time() - t0
+
+
+def shared_roundtrip(jobs, array):
+    t0 = time.time()
+    jobs.put(SharedPayload.create(array), 1)
+    received = resolve(jobs.get())
+    received.sum()
+    return time.time() - t0
+
+
+def run(port, authkey, args):
+    jobs = connect(('localhost', port), authkey, ['tasks_queue']).get_tasks_queue()
+    print("{:>10} {:>16} {:>16}".format('MB', 'pickled ms', 'shared ms'))
+    for mb in args.sizes:
+        array = numpy.random.random_sample(mb * 1024 * 1024 // 8)
+        pickled = min(pickled_roundtrip(jobs, array) for _ in range(args.repeat))
+        shared = min(shared_roundtrip(jobs, array) for _ in range(args.repeat))
+        print("{:>10} {:>16.2f} {:>16.2f}".format(mb, pickled * 1000, shared * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Shared memory payload benchmark')
+    parser.add_argument('--sizes', default=[1, 10, 100], type=int, nargs='+', dest='sizes', help='payload MB')
+    parser.add_argument('--repeat', default=5, type=int, dest='repeat')
+    args = parser.parse_args()
+
+    port, authkey = HostUtils.get_port(), 'bench'
+    server = start_server(QueueManager(address='localhost', port=port, authkey=authkey,
+                                       queues={'tasks_queue': TasksPriorityQueue()}))
+    try:
+        run(port, authkey, args)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
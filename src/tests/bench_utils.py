@@ -0,0 +1,48 @@
+import time
+from src.utils.managers import ClientManager
+from src.utils.workers import Worker
+
+__doc__ = """
+Helpers shared by the bench scripts: connecting to a bench server still starting, starting workers and stopping
+them with poison pills
+"""
+
+STOP = '-STOP-'
+
+
+def retry(factory, what, retries=50):
+    """
+    @param factory: () -> client, raising until the server listens
+    @param what: the server, for the error
+    """
+    for _ in range(retries):
+        try:
+            return factory()
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError("Unable to connect to {}".format(what))
+
+
+def connect(address, authkey, queues, retries=50):
+    return retry(lambda: ClientManager(address=address, authkey=authkey, queues=queues), address, retries)
+
+
+def start_workers(jobs, results, count, **options):
+    """
+    @param options: Worker keyword arguments
+    """
+    workers = [Worker(jobs, results, wait=False, poison_pill=STOP, **options) for _ in range(count)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    return workers
+
+
+def stop_workers(jobs, workers, priority=1):
+    """
+    A poison pill per worker, then wait for them
+    """
+    for _ in workers:
+        jobs.put(STOP, priority)
+    for worker in workers:
+        worker.join()
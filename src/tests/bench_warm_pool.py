@@ -0,0 +1,107 @@
+from __future__ import print_function
+import argparse
+import time
+import uuid
+from src.utils.managers import QueueManager, SharedResultsManager, HostUtils, start_server
+from src.utils.queues import TasksPriorityQueue
+from src.utils.serializers import get_codec
+from src.utils.tasks import Task, task
+from src.utils.workers import Worker, WarmPool
+from src.tests.bench_utils import connect, stop_workers
+
+
+@task(name='started_at')
+def started_at(hold):
+    """
+    @return: when the worker began the task, held so that each task of a scale up lands on its own worker
+    """
+    started = time.time()
+    time.sleep(hold)
+    return started
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100.), len(samples) - 1)]
+
+
+def cold_start(jobs, results, count, options):
+    workers = []
+    for _ in range(count):
+        worker = Worker(jobs, results, **options)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def scale_up(jobs, results, count, hold, start):
+    """
+    Queue count tasks, take the scale decision and start count workers
+    @return: seconds from the decision to the first task started, to the count-th task started
+    """
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    for _id in ids:
+        jobs.put(Task(_id, started_at, (hold,)), 1)
+    decision = time.time()
+    workers = start(count)
+    codec = get_codec('json')
+    started = sorted(codec.loads(results.wait_result(_id, timeout=30, pop=True)) for _id in ids)
+    stop_workers(jobs, workers, 0)
+    return started[0] - decision, started[-1] - decision
+
+
+def run(jobs_address, results_address, authkey, args):
+    jobs = connect(jobs_address, authkey, ['tasks_queue']).get_tasks_queue()
+    results = connect(results_address, authkey, []).get_results()
+    options = dict(wait=False, poison_pill='-STOP-')
+    pool = WarmPool(jobs, results, reserve=args.workers, **options)
+    modes = [('cold start', lambda count: cold_start(jobs, results, count, options)), ('warm pool', pool.activate)]
+    print("{:>12} {:>8} {:>14} {:>14} {:>14} {:>14}".format(
+        'mode', 'workers', 'first p50 ms', 'first p99 ms', 'last p50 ms', 'last p99 ms'))
+    try:
+        for name, start in modes:
+            for count in sorted({1, args.workers}):
+                first, last = [], []
+                for _ in range(args.repeat):
+                    pool.fill()
+                    time.sleep(args.idle)  # scale ups happen sample_time apart, the reserve is warm by then
+                    f, l = scale_up(jobs, results, count, args.hold, start)
+                    first.append(f)
+                    last.append(l)
+                print("{:>12} {:>8} {:>14.2f} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+                    name, count, percentile(first, 50) * 1000, percentile(first, 99) * 1000,
+                    percentile(last, 50) * 1000, percentile(last, 99) * 1000))
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Scale decision to first task latency, cold start vs warm pool')
+    parser.add_argument('--workers', default=4, type=int, dest='workers', help='workers added per scale up')
+    parser.add_argument('--repeat', default=30, type=int, dest='repeat')
+    parser.add_argument('--hold', default=0.05, type=float, dest='hold', help='seconds each task keeps its worker')
+    parser.add_argument('--idle', default=0.5, type=float, dest='idle', help='seconds between scale ups')
+    parser.add_argument('--ballast_mb', default=200, type=int, dest='ballast_mb',
+                        help='memory held by the scaling process, forked by every cold start')
+    args = parser.parse_args()
+
+    authkey = 'bench'
+    jobs_address = ('localhost', HostUtils.get_port())
+    results_address = ('localhost', HostUtils.get_port())
+    servers = [
+        start_server(QueueManager(address=jobs_address[0], port=jobs_address[1], authkey=authkey,
+                                  queues={'tasks_queue': TasksPriorityQueue()})),
+        start_server(SharedResultsManager(address=results_address[0], port=results_address[1], authkey=authkey))
+    ]
+    ballast = bytearray(args.ballast_mb * 1024 * 1024)
+    try:
+        run(jobs_address, results_address, authkey, args)
+    finally:
+        del ballast
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
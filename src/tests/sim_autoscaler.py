@@ -0,0 +1,147 @@
+from __future__ import print_function, division
+import argparse
+import random
+from bisect import bisect_left
+from src.utils.autoscaler import Autoscaler
+
+
+class LegacyController(object):
+    """
+    The former Watchdog/analyze() loop: qsize sampled sample_time apart, `size_t0 - size_t1 / workers` compared
+    with the rate setpoint, one worker per decision, a decision every sample_time + 1s
+    """
+
+    def __init__(self, min_workers, max_workers, rate):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.rate = rate
+        self._calls = 0
+        self._size_t0 = None
+
+    def step(self, stats, workers, now=None):
+        self._calls += 1
+        if self._calls % 2:
+            self._size_t0 = stats['size']
+            return 0
+        delta = self._size_t0 - stats['size'] / max(workers, 1) - self.rate
+        if workers < self.min_workers:
+            return 1
+        if delta > 0 and workers < self.max_workers:
+            return 1
+        if delta < 0 and workers > self.min_workers:
+            return -1
+        return 0
+
+
+class FixedController(object):
+    def __init__(self, workers):
+        self.workers = workers
+
+    def step(self, stats, workers, now=None):
+        return self.workers - workers
+
+
+def bursty_load(t, base, burst, period, burst_length):
+    return burst if t % period < burst_length else base
+
+
+def simulate(controller, args, seed=0):
+    """
+    Fluid FIFO queue: arrivals follow the bursty load with Poisson noise, every worker completes worker_rate
+    tasks/s once started, the controller is sampled every sample_time on the queue stats() counters
+    @return: metrics dict
+    """
+    rnd = random.Random(seed)
+    dt, now = args.dt, 0.
+    backlog = submitted = completed = 0.
+    starting = []  # activation times of the workers being spawned
+    active = args.min_workers
+    arrivals_t, arrivals_total = [0.], [0.]
+    waits, worker_seconds, backlog_sum, max_backlog, steps = [], 0., 0., 0., 0
+    next_sample = 0.
+
+    while now < args.duration:
+        rate = bursty_load(now, args.base, args.burst, args.period, args.burst_length)
+        arrived = rnd.gauss(rate * dt, (rate * dt) ** 0.5) if rate else 0.
+        arrived = max(arrived, 0.)
+        backlog += arrived
+        submitted += arrived
+        arrivals_t.append(now + dt)
+        arrivals_total.append(submitted)
+
+        active += sum(1 for t in starting if t <= now)
+        starting = [t for t in starting if t > now]
+        done = min(backlog, active * args.worker_rate * dt)
+        backlog -= done
+        completed += done
+        if done:
+            # FIFO: the last task completed arrived when the arrivals reached the completed total
+            arrived_at = arrivals_t[min(bisect_left(arrivals_total, completed), len(arrivals_t) - 1)]
+            waits.append((now + dt - arrived_at, done))
+
+        workers = active + len(starting)
+        worker_seconds += workers * dt
+        backlog_sum += backlog * dt
+        max_backlog = max(max_backlog, backlog)
+
+        if now >= next_sample:
+            stats = dict(size=int(backlog), in_flight=0, submitted=submitted, completed=completed, time=now)
+            delta = controller.step(stats, workers, now)
+            if delta > 0:
+                starting.extend([now + args.spawn_time] * delta)
+            elif delta < 0:
+                removed = min(-delta, len(starting))
+                starting = starting[removed:]
+                active = max(active - (-delta - removed), 0)
+            steps += bool(delta)
+            next_sample += args.sample_time
+        now += dt
+
+    waits.sort()
+    total = sum(w for _, w in waits)
+    acc, p95 = 0., 0.
+    for wait, weight in waits:
+        acc += weight
+        if acc >= 0.95 * total:
+            p95 = wait
+            break
+    return dict(mean_backlog=backlog_sum / args.duration, max_backlog=max_backlog,
+                mean_wait=sum(wait * w for wait, w in waits) / total, p95_wait=p95,
+                worker_seconds=worker_seconds, steps=steps)
+
+
+def main():
+    parser = argparse.ArgumentParser('[dsys] Autoscaler simulation on bursty synthetic load')
+    parser.add_argument('--duration', default=600., type=float, dest='duration')
+    parser.add_argument('--dt', default=0.05, type=float, dest='dt')
+    parser.add_argument('--base', default=20., type=float, dest='base', help='tasks/s between bursts')
+    parser.add_argument('--burst', default=150., type=float, dest='burst', help='tasks/s during bursts')
+    parser.add_argument('--period', default=60., type=float, dest='period')
+    parser.add_argument('--burst_length', default=15., type=float, dest='burst_length')
+    parser.add_argument('--worker_rate', default=10., type=float, dest='worker_rate', help='tasks/s per worker')
+    parser.add_argument('--spawn_time', default=1., type=float, dest='spawn_time')
+    parser.add_argument('--sample_time', default=1., type=float, dest='sample_time')
+    parser.add_argument('--min_workers', default=2, type=int, dest='min_workers')
+    parser.add_argument('--max_workers', default=20, type=int, dest='max_workers')
+    parser.add_argument('--target_age', default=5., type=float, dest='target_age')
+    args = parser.parse_args()
+
+    controllers = [
+        ('autoscaler', lambda: Autoscaler(args.min_workers, args.max_workers, worker_rate=args.worker_rate / 2.,
+                                          target_age=args.target_age)),
+        ('legacy', lambda: LegacyController(args.min_workers, args.max_workers, args.worker_rate)),
+        ('fixed min', lambda: FixedController(args.min_workers)),
+        ('fixed max', lambda: FixedController(args.max_workers)),
+    ]
+
+    print("{:>12} {:>12} {:>12} {:>10} {:>10} {:>10} {:>8}".format(
+        'controller', 'mean backlog', 'max backlog', 'mean wait', 'p95 wait', 'worker-s', 'steps'))
+    for name, factory in controllers:
+        m = simulate(factory(), args)
+        print("{:>12} {:>12.1f} {:>12.0f} {:>10.2f} {:>10.2f} {:>10.0f} {:>8}".format(
+            name, m['mean_backlog'], m['max_backlog'], m['mean_wait'], m['p95_wait'], m['worker_seconds'],
+            m['steps']))
+
+
+if __name__ == '__main__':
+    main()
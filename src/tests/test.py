@@ -5,36 +5,41 @@ from src.utils.register_task import print_function, d_print_function, factorial_
 from src.config.configuration import queues_configuration
 from src.service.workers_service import get_queues, init_job_client, init_result_client
 from src.utils.tasks import Task
+from src.utils.shm import resolve
 
 
 def main():
     time.sleep(3)
     enqueued = set()
     counter = 3
-    jobs, results = get_queues(init_job_client(queues_configuration), init_result_client(queues_configuration))
+    job_client, results_client = init_job_client(queues_configuration), init_result_client(queues_configuration)
+    jobs, results = get_queues(job_client, results_client)
     while counter > 0:
-        for n in range(10):
-            _id = str(uuid.uuid4())
-            jobs.put(Task(_id, print_function, n), 200)
-            enqueued.add(_id)
-
-        for n in range(10000):
-            _id = str(uuid.uuid4())
-            jobs.put(Task(_id, print_function, n), 500)
-            enqueued.add(_id)
-
-        for n in range(10):
-            _id = str(uuid.uuid4())
-            jobs.put(Task(_id, factorial_function, n), 200)
-            enqueued.add(_id)
-
-        time.sleep(3)
-
-        for k in enqueued:
-            try:
-                print(k, results[k])
-            except KeyError:
-                print("Job not ready")
+        batch = [Task(str(uuid.uuid4()), print_function, n) for n in range(10)]
+        jobs.put_many([t.encode(job_client.codec) for t in batch], 200)
+        enqueued.update(t.id for t in batch)
+
+        batch = [Task(str(uuid.uuid4()), print_function, n) for n in range(10000)]
+        for i in range(0, len(batch), 256):
+            jobs.put_many([t.encode(job_client.codec) for t in batch[i:i + 256]], 500)
+        enqueued.update(t.id for t in batch)
+
+        batch = [Task(str(uuid.uuid4()), factorial_function, n) for n in range(10)]
+        jobs.put_many([t.encode(job_client.codec) for t in batch], 200)
+        enqueued.update(t.id for t in batch)
+
+        pending = list(enqueued)
+        for i in range(0, len(pending), 256):
+            chunk = set(pending[i:i + 256])
+            while chunk:
+                ready = results.wait_any(chunk, timeout=10, pop=True)
+                if not ready:
+                    print("Jobs not ready: {}".format(len(chunk)))
+                    break
+                for k, v in ready.items():
+                    print(k, resolve(results_client.codec.loads(v)))
+                chunk.difference_update(ready)
+                enqueued.difference_update(ready)
 
         counter -= 1
 
@@ -0,0 +1,97 @@
+from multiprocessing import Process
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.utils.cluster import HashRing
+from src.utils.queues import PersistentQueue, PersistentPriorityQueue
+
+__doc__ = """
+Crash replay of the persistent queues: a child process works the queue and dies without closing it, the queue
+rebuilt on the same directory must hold exactly the items not acked.
+
+    python -m unittest src.tests.test_persistent_replay
+"""
+
+
+def _work_then_crash(queue_type, path):
+    queue = queue_type(path)
+    queue.put_many(['a', 'b', 'c', 'd', 'e'], 1)
+    leases = dict((item, lease) for lease, item, _ in queue.lease_many(3))
+    queue.ack_many([leases['c']])  # out of delivery order
+    queue.nack_many([leases['b']])  # redelivered: a new record replaces the leased one
+    assert queue.get_many(1) == ['d']  # no lease: acked on delivery
+    (lease, item, _), = queue.lease_many(1, max_attempts=1)
+    assert item == 'e'
+    queue.nack_many([lease])  # out of attempts: dead letter
+    queue._log.wait_durable()
+    os._exit(0)
+
+
+class PersistentReplayTest(unittest.TestCase):
+    queue_type = PersistentQueue
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='dsys-replay-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_replays_what_was_not_acked(self):
+        child = Process(target=_work_then_crash, args=(self.queue_type, self.path))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+
+        queue = self.queue_type(self.path)
+        try:
+            self.assertEqual(queue.qsize(), 2)
+            replayed = dict((item, attempt) for _, item, attempt in queue.lease_many(10, timeout=0))
+            # a: leased, never acked. b: waiting for its second attempt
+            self.assertEqual(replayed, {'a': 1, 'b': 2})
+        finally:
+            queue.close()
+
+    def test_acks_follow_the_delivered_record(self):
+        queue = self.queue_type(self.path)
+        try:
+            queue.put_many(['a', 'b'], 1)
+            seqs = [seq for seq, _ in queue._log.live()]
+            leases = [lease for lease, _, _ in queue.lease_many(2)]
+            queue.ack_many(leases[1:])
+            self.assertEqual([seq for seq, _ in queue._log.live()], seqs[:1])
+        finally:
+            queue.close()
+
+    def test_export_acks_the_moved_records(self):
+        ring = HashRing([('kept', 1), ('moved', 2)])
+        items = ['item{}'.format(n) for n in range(20)]
+        queue = self.queue_type(self.path)
+        try:
+            queue.put_many(items, 1)
+            moved = [item for _, _, _, item in queue.export_moved(ring, ('kept', 1))]
+        finally:
+            queue.close()
+        kept = [item for item in items if ring.owner_of(item) == ('kept', 1)]
+        self.assertEqual(sorted(moved + kept), sorted(items))
+
+        queue = self.queue_type(self.path)
+        try:
+            self.assertEqual(sorted(queue.get_many(20, timeout=0)), sorted(kept))
+        finally:
+            queue.close()
+
+    def test_close_stops_the_timer(self):
+        queue = self.queue_type(self.path)
+        queue.put_many(['a'], 1, countdown=60)
+        queue.close()
+        self.assertFalse(queue._timer.is_alive())
+
+
+class PersistentPriorityReplayTest(PersistentReplayTest):
+    queue_type = PersistentPriorityQueue
+
+
+if __name__ == '__main__':
+    unittest.main()
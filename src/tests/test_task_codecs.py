@@ -0,0 +1,68 @@
+from multiprocessing import Queue
+import unittest
+
+from src.utils.tasks import Task, task
+from src.utils.workers import Job, Worker
+
+__doc__ = """
+A task that raises is reported as failed whatever the codec its job travels with: the decoded task must call the
+function itself, not the registry wrapper that logs and swallows its errors.
+
+    python -m unittest src.tests.test_task_codecs
+"""
+
+CODECS = ('pickle', 'json', 'msgpack')
+registry = {}
+
+
+@task(name='test_codecs.fails', container=registry)
+def fails(x):
+    raise ValueError(x)
+
+
+@task(name='test_codecs.double', container=registry)
+def double(x):
+    return 2 * x
+
+
+class RecordingWorker(Worker):
+    """
+    Records the failed jobs instead of reporting them to a queue
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingWorker, self).__init__(*args, **kwargs)
+        self.failed = []
+
+    def _fail(self, job):
+        self.failed.append(job)
+
+
+class TaskCodecsTest(unittest.TestCase):
+
+    def _run(self, codec, func, args):
+        worker = RecordingWorker(Queue(), Queue(), registered_functions=registry, codec=codec)
+        payload = Task.encode_many([Task('1', func, args)], codec)
+        job = Job(worker._decode(payload))
+        return worker, worker._execute(job)
+
+    def test_failing_task_raises(self):
+        for codec in CODECS:
+            decoded, = Task.decode(Task.encode_many([Task('1', fails, [1])], codec), codec, registry)
+            self.assertRaises(ValueError, decoded)
+
+    def test_failing_task_is_reported_failed(self):
+        for codec in CODECS:
+            worker, results = self._run(codec, fails, [1])
+            self.assertIsNone(results, codec)
+            self.assertEqual(len(worker.failed), 1, codec)
+
+    def test_task_runs(self):
+        for codec in CODECS:
+            worker, results = self._run(codec, double, [2])
+            self.assertEqual(results, {'1': 4}, codec)
+            self.assertEqual(worker.failed, [], codec)
+
+
+if __name__ == '__main__':
+    unittest.main()
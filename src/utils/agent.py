@@ -0,0 +1,426 @@
+from Queue import Empty
+from collections import defaultdict
+from multiprocessing import Process, Array, Event, Lock, Semaphore
+import errno
+import mmap
+import os
+import signal
+import struct
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from src.logging.dsys_logger_client import get_logger
+from src.utils.cluster import Delivery, sources_of
+from src.utils.shm import SharedPayload, resolve
+
+log = get_logger(__name__)
+
+__doc__ = """
+Per host agent between the central job queue and the workers of the host: the agent alone talks to the job
+server, the workers get their jobs and report them done through shared memory.
+
+    agent = HostAgent(jobs, slots=max_workers, prefetch=4, host=socket.gethostname())
+    agent.start()
+    workers = [Worker(agent.queue, results, ...) for _ in range(n)]
+
+The agent prefetches bounded batches (prefetch jobs per live worker) from the central queue into one ring
+buffer per worker, and forwards the task_done/acks of all the workers in one call per round. A worker takes the
+jobs of its own ring first and steals half of the fullest other ring once its ring is empty, so a slow or dead
+worker does not hold jobs back. Everything is created before the workers fork: the agent and the workers must
+be started by the process that created the agent (the Watchdog, its WarmPool).
+With leases (visibility), the agent leases the jobs and the local waiting time counts in the visibility timeout:
+keep prefetch small.
+"""
+
+HEADER = struct.Struct('=QQQ')  # head offset, tail offset, records
+LENGTH = struct.Struct('=I')
+
+
+class Ring(object):
+    """
+    Bounded FIFO of byte records in an anonymous shared mmap, every operation holds the ring lock.
+    Offsets only grow, the data wraps around the end of the buffer
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = mmap.mmap(-1, HEADER.size + capacity)
+        self.lock = Lock()
+
+    def __len__(self):
+        """
+        Records in the ring, read without the lock: a hint
+        """
+        return HEADER.unpack_from(self.buf, 0)[2]
+
+    def _write(self, pos, data):
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buf[HEADER.size + start:HEADER.size + start + first] = data[:first]
+        if first < len(data):
+            self.buf[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def _read(self, pos, size):
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        data = self.buf[HEADER.size + start:HEADER.size + start + first]
+        if first < size:
+            data += self.buf[HEADER.size:HEADER.size + size - first]
+        return data
+
+    def push_many(self, records):
+        """
+        @return: records pushed, in order, until the ring is full
+        """
+        with self.lock:
+            head, tail, count = HEADER.unpack_from(self.buf, 0)
+            pushed = 0
+            for data in records:
+                size = LENGTH.size + len(data)
+                if tail - head + size > self.capacity:
+                    break
+                self._write(tail, LENGTH.pack(len(data)) + data)
+                tail += size
+                pushed += 1
+            HEADER.pack_into(self.buf, 0, head, tail, count + pushed)
+            return pushed
+
+    def pop_many(self, max_records, half=False):
+        """
+        @param half: at most half of the records (rounded up), for the thieves
+        """
+        with self.lock:
+            head, tail, count = HEADER.unpack_from(self.buf, 0)
+            if half:
+                max_records = min(max_records, (count + 1) // 2)
+            records = []
+            while head < tail and len(records) < max_records:
+                size = LENGTH.unpack(self._read(head, LENGTH.size))[0]
+                records.append(self._read(head + LENGTH.size, size))
+                head += LENGTH.size + size
+            HEADER.pack_into(self.buf, 0, head, tail, count - len(records))
+            return records
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class LocalQueue(object):
+    """
+    Worker side of a HostAgent, with the job queue methods the Worker calls. A worker process claims a slot (its
+    job and report rings) at its first call, the slot of a dead worker is claimed again
+    """
+
+    def __init__(self, slots, capacity):
+        self.slots = slots
+        self.capacity = capacity
+        self.jobs = [Ring(capacity) for _ in range(slots)]
+        self.reports = [Ring(capacity) for _ in range(slots)]
+        self.pids = Array('l', slots)
+        self.counters = Array('l', 2 * slots, lock=False)  # taken, stolen per slot, written by its owner only
+        self.items = Semaphore(0)  # a release per job pushed
+        self.space = Semaphore(0)  # a release per take, wakes the feeder up
+        self.reported = Semaphore(0)  # a release per report
+        self._pid = self._slot = None
+
+    def _claim(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._slot
+        with self.pids.get_lock():
+            for slot in range(self.slots):
+                owner = self.pids[slot]
+                if not owner or owner == pid or not _alive(owner):
+                    self.pids[slot] = pid
+                    self._pid, self._slot = pid, slot
+                    return slot
+        raise RuntimeError("All the {} slots of the host agent are taken".format(self.slots))
+
+    def live_slots(self):
+        return [slot for slot, pid in enumerate(self.pids[:]) if pid and _alive(pid)]
+
+    def _dump(self, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.capacity // 4:
+            # larger than a ring can take at once: the record only holds a handle to a shared memory segment
+            data = pickle.dumps(SharedPayload.create(obj), pickle.HIGHEST_PROTOCOL)
+        return data
+
+    @staticmethod
+    def _load(data):
+        return resolve(pickle.loads(data))
+
+    # agent side
+
+    def push(self, records, slots):
+        """
+        @param records: (lease, item, attempt, source) records, spread over the emptiest rings of slots
+        @return: records that did not fit
+        """
+        rings = [self.jobs[slot] for slot in slots or range(self.slots)]
+        left = []
+        for record in records:
+            data = self._dump(record)
+            if not min(rings, key=len).push_many([data]) and not any(r.push_many([data]) for r in rings):
+                left.append(record)
+                continue
+            self.items.release()
+        return left
+
+    def drain(self, rings, max_records=1 << 16):
+        return [self._load(data) for ring in rings for data in ring.pop_many(max_records)]
+
+    # worker side
+
+    def _take(self, max_items, timeout):
+        slot = self._claim()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if deadline is None:
+                self.items.acquire()
+            elif not self.items.acquire(True, max(deadline - time.time(), 0)):
+                raise Empty
+            records = self.jobs[slot].pop_many(max(max_items, 1))
+            stolen = not records
+            if stolen:
+                for victim in sorted(range(self.slots), key=lambda s: -len(self.jobs[s])):
+                    records = self.jobs[victim].pop_many(max(max_items, 1), half=True) if victim != slot else []
+                    if records:
+                        break
+            if not records:
+                continue  # the job behind the release was taken by another worker
+            for _ in range(len(records) - 1):
+                if not self.items.acquire(False):
+                    break
+            self.space.release()
+            self.counters[2 * slot + stolen] += len(records)
+            return [self._load(data) for data in records]
+
+    def get_many(self, max_items, timeout=None, host=None):
+        records = self._take(max_items, timeout)
+        return Delivery([item for _, item, _, _ in records], [source for _, _, _, source in records])
+
+    def lease_many(self, max_items, timeout=None, visibility=None, max_attempts=None, host=None):
+        """
+        visibility and max_attempts are the agent ones
+        """
+        return [record[:3] for record in self._take(max_items, timeout)]
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, timeout if block else 0)[0]
+
+    def _report(self, report):
+        ring = self.reports[self._claim()]
+        data = self._dump(report)
+        while not ring.push_many([data]):
+            time.sleep(0.001)  # full until the agent drains it
+        self.reported.release()
+
+    def task_done_many(self, count, done_ids=(), sources=None):
+        self._report(('done', count, list(done_ids), sources))
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def ack_many(self, lease_ids, done_ids=()):
+        self._report(('ack', list(lease_ids), list(done_ids)))
+        return len(lease_ids)
+
+    def nack_many(self, lease_ids, delay=None, spend=True):
+        self._report(('nack', list(lease_ids), delay, spend))
+        return len(lease_ids)
+
+    def task_failed_many(self, task_ids):
+        self._report(('failed', list(task_ids)))
+
+    def put_many(self, items, priority=None, eta=None, countdown=None):
+        items = list(items)
+        self._report(('put', items, priority, eta, countdown))
+        return len(items)
+
+    def requeue_many(self, items, priority=None, sources=None):
+        items = list(items)
+        self._report(('requeue', items, priority, sources))
+        return len(items)
+
+    def put(self, item, priority, eta=None, countdown=None):
+        self.put_many([item], priority, eta, countdown)
+
+    def qsize(self):
+        return sum(len(ring) for ring in self.jobs)
+
+    def stats(self):
+        """
+        @return: dict(waiting, taken, stolen, live), jobs taken from the own ring and stolen from the others
+        """
+        counters = self.counters[:]
+        return dict(waiting=self.qsize(), taken=sum(counters[0::2]), stolen=sum(counters[1::2]),
+                    live=len(self.live_slots()))
+
+    def __repr__(self):
+        return "< LocalQueue -- slots: {} capacity: {} >".format(self.slots, self.capacity)
+
+
+class HostAgent(Process):
+    """
+    Feeds the LocalQueue of the host from the central job queue and reports the jobs done to it
+    """
+
+    def __init__(self, task_queue, slots=8, prefetch=4, capacity=1 << 20, host=None, visibility=None,
+                 max_attempts=5, linger=0.002, poll=0.5):
+        """
+        @param task_queue: central job queue (proxy)
+        @param slots: max workers of the host
+        @param prefetch: jobs waiting on the host per live worker
+        @param capacity: bytes of a worker ring
+        @param host: host the jobs are got as, see queues.RoutedQueue
+        @param visibility: lease the jobs for visibility seconds, as the Worker option. None gets them
+        @param linger: seconds the reports of the workers are let pile up before being sent in one call
+        @param poll: seconds between checks of the stop event while idle
+        """
+        super(HostAgent, self).__init__()
+        self.task_queue = task_queue
+        self.queue = LocalQueue(slots, capacity)
+        self.prefetch = prefetch
+        self.host = host
+        self.visibility = visibility
+        self.max_attempts = max_attempts
+        self.linger = linger
+        self.poll = poll
+        self.stopping = Event()
+        self.daemon = True
+
+    def stop(self):
+        self.stopping.set()
+
+    def _fetch(self, want):
+        route = {} if self.host is None else dict(host=self.host)
+        try:
+            if self.visibility is None:
+                got = self.task_queue.get_many(want, timeout=self.poll, **route)
+                return [(None, item, 1, source) for item, source in zip(got, sources_of(got))]
+            return [(lease, item, attempt, None) for lease, item, attempt in
+                    self.task_queue.lease_many(want, timeout=self.poll, visibility=self.visibility,
+                                               max_attempts=self.max_attempts, **route)]
+        except Empty:
+            return []
+
+    def _feed(self):
+        queue, pending = self.queue, []
+        while not self.stopping.is_set():
+            live = queue.live_slots()
+            target = self.prefetch * max(len(live), 1)
+            want = target - queue.qsize() - len(pending)
+            # refilled from half the target down, a fetch brings a batch instead of the last job taken
+            if want < (target + 1) // 2 or pending:
+                if queue.space.acquire(True, self.poll):
+                    while queue.space.acquire(False):
+                        pass
+                pending = queue.push(pending, live)
+                continue
+            pending = queue.push(self._fetch(want), live)
+        return pending
+
+    def _forward(self, reports):
+        done, done_ids, sources, failed_ids, acks, nacks = 0, [], [], [], [], defaultdict(list)
+        for report in reports:
+            kind = report[0]
+            if kind == 'done':
+                done += report[1]
+                done_ids.extend(report[2])
+                sources.extend(report[3] or [None] * report[1])
+            elif kind == 'ack':
+                acks.extend(report[1])
+                done_ids.extend(report[2])
+            elif kind == 'nack':
+                nacks[report[2:]].extend(report[1])
+            elif kind == 'failed':
+                failed_ids.extend(report[1])
+            elif kind == 'requeue':
+                _, items, priority, item_sources = report
+                self._requeue(items, priority, item_sources or [None] * len(items))
+            else:
+                _, items, priority, eta, countdown = report
+                self.task_queue.put_many(items, priority, eta=eta, countdown=countdown)
+        if acks:
+            self.task_queue.ack_many(acks, done_ids)
+            done_ids = []
+        if done or done_ids:
+            self._task_done(done, done_ids, sources)
+        for (delay, spend), leases in nacks.items():
+            self.task_queue.nack_many(leases, delay, spend)
+        if failed_ids:
+            self.task_queue.task_failed_many(failed_ids)
+
+    def _report_loop(self):
+        queue = self.queue
+        while True:
+            if not queue.reported.acquire(True, self.poll):
+                if self.stopping.is_set():
+                    return
+                continue
+            if self.linger:
+                time.sleep(self.linger)
+            reports = queue.drain(queue.reports)
+            for _ in range(len(reports) - 1):
+                if not queue.reported.acquire(False):
+                    break
+            try:
+                self._forward(reports)
+            except Exception as e:
+                log.error('Host agent: unable to report {} results -- {}'.format(len(reports), str(e)))
+
+    def _give_back(self, pending):
+        """
+        Jobs still on the host go back to the central queue, first in line
+        """
+        records = pending + self.queue.drain(self.queue.jobs)
+        leases = [lease for lease, _, _, _ in records if lease is not None]
+        items = [(item, source) for lease, item, _, source in records if lease is None]
+        if leases:
+            self.task_queue.nack_many(leases)
+        if items:
+            self._requeue([item for item, _ in items], 0, [source for _, source in items])
+
+    def _requeue(self, items, priority, sources):
+        if any(source is not None for source in sources):
+            self.task_queue.requeue_many(items, priority, sources=sources)
+        else:
+            self.task_queue.requeue_many(items, priority)
+
+    def _task_done(self, count, done_ids, sources):
+        """
+        To the queue the items came from when the central queue spreads its gets (see cluster.Delivery)
+        """
+        if any(source is not None for source in sources):
+            self.task_queue.task_done_many(count, done_ids, sources=sources)
+        else:
+            self.task_queue.task_done_many(count, done_ids)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        reporter = threading.Thread(target=self._report_loop, name='agent-reports')
+        reporter.daemon = True
+        reporter.start()
+        pending = []
+        try:
+            pending = self._feed()
+        except Exception as e:
+            log.error('Host agent: stopped feeding -- {}'.format(str(e)))
+        finally:
+            self.stopping.set()
+            reporter.join()
+            self._give_back(pending)
+
+    def __repr__(self):
+        return "< HostAgent -- host: {} slots: {} prefetch: {} >".format(self.host, self.queue.slots, self.prefetch)
@@ -0,0 +1,116 @@
+import math
+import time
+
+__doc__ = """
+Worker pool autoscaler driven by the jobs queue stats() counters.
+Arrival and completion rates are smoothed with EWMAs, the per worker throughput is learnt while the
+workers are saturated (and raised whenever exceeded), and the target is the pool that serves the arrivals and drains the backlog within
+target_age seconds (target tracking). Scale downs need a margin (hysteresis) and both directions have
+cool-downs, a single step can add or remove several workers.
+"""
+
+
+class EWMA(object):
+    """
+    Exponentially weighted moving average over irregular samples
+    """
+
+    def __init__(self, halflife, value=None):
+        self.halflife = halflife
+        self.value = value
+
+    def update(self, sample, dt):
+        if self.value is None:
+            self.value = sample
+        else:
+            alpha = 1. - math.exp(-dt * math.log(2) / self.halflife)
+            self.value += alpha * (sample - self.value)
+        return self.value
+
+
+class Autoscaler(object):
+
+    def __init__(self, min_workers, max_workers, worker_rate=10., target_age=5., halflife=3.,
+                 up_cooldown=2., down_cooldown=10., tolerance=0.2, max_step=None):
+        """
+        @param worker_rate: tasks/s of a single worker until measured
+        @param target_age: seconds the backlog may take to drain
+        @param halflife: seconds, smoothing of the rates
+        @param up_cooldown: seconds after a scaling step before scaling up again
+        @param down_cooldown: seconds after a scaling step before scaling down
+        @param tolerance: fraction of the pool that must be in excess before scaling down
+        @param max_step: max workers added or removed per step, None for no limit
+        """
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_age = target_age
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.tolerance = tolerance
+        self.max_step = max_step
+        self.arrival_rate = EWMA(halflife)
+        self.completion_rate = EWMA(halflife)
+        self.worker_rate = EWMA(halflife, worker_rate)
+        self.backlog = 0
+        self._last = None
+        self._last_scaled = None
+
+    def observe(self, stats, workers):
+        """
+        @param stats: jobs queue stats() sample
+        @param workers: workers running since the previous sample
+        """
+        last, self._last = self._last, stats
+        self.backlog = stats['size']
+        if last is None or stats['time'] <= last['time']:
+            return
+
+        dt = stats['time'] - last['time']
+        completed = (stats['completed'] - last['completed']) / dt
+        self.arrival_rate.update((stats['submitted'] - last['submitted']) / dt, dt)
+        self.completion_rate.update(completed, dt)
+        if workers:
+            # throughput measures the capacity while work was waiting for the workers, a lower bound otherwise
+            per_worker = completed / workers
+            if (last['size'] > 0 and stats['size'] > 0) or per_worker > self.worker_rate.value:
+                self.worker_rate.update(max(per_worker, 1e-3), dt)
+
+    @property
+    def queue_age(self):
+        """
+        Expected wait of a new task (Little's law)
+        """
+        rate = self.completion_rate.value or 0.
+        return float('inf') if self.backlog and not rate else self.backlog / max(rate, 1e-9)
+
+    def desired(self):
+        required = (self.arrival_rate.value or 0.) + self.backlog / float(self.target_age)
+        target = int(math.ceil(required / self.worker_rate.value))
+        return max(self.min_workers, min(self.max_workers, target))
+
+    def step(self, stats, workers, now=None):
+        """
+        @return: workers to add (> 0) or remove (< 0)
+        """
+        now = time.time() if now is None else now
+        self.observe(stats, workers)
+        target = self.desired()
+        since = float('inf') if self._last_scaled is None else now - self._last_scaled
+
+        if workers < self.min_workers:
+            delta = self.min_workers - workers
+        elif target > workers and since >= self.up_cooldown:
+            delta = target - workers
+        elif target < workers and since >= self.down_cooldown and workers - target >= self.tolerance * workers:
+            delta = target - workers
+        else:
+            return 0
+
+        if self.max_step:
+            delta = max(-self.max_step, min(self.max_step, delta))
+        self._last_scaled = now
+        return delta
+
+    def __repr__(self):
+        return "< Autoscaler -- arrivals: {:.1f}/s completions: {:.1f}/s per worker: {:.1f}/s backlog: {} >".format(
+            self.arrival_rate.value or 0., self.completion_rate.value or 0., self.worker_rate.value, self.backlog)
@@ -0,0 +1,582 @@
+from Queue import Empty
+from bisect import bisect
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from src.logging.dsys_logger_client import get_logger
+from src.utils.serializers import get_codec
+
+log = get_logger(__name__)
+
+__doc__ = """
+Job server cluster: the job queue runs as N partitions, a QueueManager each (one per node, or local ports), and
+PartitionedQueue is the client side view of all of them, with the interface of a single job queue proxy.
+
+    jobs = PartitionedClientManager([('10.0.0.1', 8506), ('10.0.0.2', 8506)], authkey).get_tasks_queue()
+    jobs.put_many(tasks, 1)        # every task to the partition owning its routing key, else its id
+    jobs.put_many([t.encode(codec) for t in tasks], 1, keys=[partition_key(t) for t in tasks])
+    jobs.get_many(8, timeout=1.)   # from any partition, round robin
+
+The partitions own the keys by consistent hashing (HashRing): a partition added takes ~1/N of the keys, a
+partition removed gives away only its own. Every partition keeps a copy of the membership (ClusterMap) and the
+clients check it every `refresh` seconds. add_partition/remove_partition publish the new map and move the waiting
+items to their new owner, a removed partition is still served until its last item is done.
+A task graph goes to a single partition, periodic schedules stay on the partition they were added to.
+"""
+
+
+def partition_key(item, codec=None):
+    """
+    @param codec: codec of the encoded tasks, None for a job queue of Task objects
+    @return: what item is partitioned by: the routing key of a Task, else its id. An encoded payload goes with
+    the task it decodes to, a batch with its first task, the other items (poison pills...) by their value
+    """
+    if codec is not None and isinstance(item, (bytes, type(u''))):
+        try:
+            item = get_codec(codec).loads(item)
+        except Exception:
+            pass
+    if isinstance(item, list) and item:
+        item = item[0]
+    if isinstance(item, dict):
+        # Task.as_dict, the json and msgpack payloads
+        key = item.get('routing_key')
+        if key is None:
+            key = item.get('id')
+    else:
+        key = getattr(item, 'routing_key', None)
+        if key is None:
+            key = getattr(item, 'id', None)
+    return item if key is None else key
+
+
+class Delivery(list):
+    """
+    Items got from a queue spreading its gets over other queues (partitions, replicas), with the queue each item
+    came from: task_done_many(sources=) reports them done there. A source is None for the items of a plain queue
+    """
+
+    def __init__(self, items=(), sources=None):
+        super(Delivery, self).__init__(items)
+        self.sources = [None] * len(self) if sources is None else list(sources)
+
+
+def sources_of(items):
+    """
+    @return: the sources of the items got, all None unless they are a Delivery
+    """
+    return getattr(items, 'sources', None) or [None] * len(items)
+
+
+def member_name(member):
+    return '{}:{}'.format(*member)
+
+
+def cluster_members(conf):
+    """
+    @param conf: jobs_queue configuration. members: [host, port] of every partition of the cluster, else
+    partitions (default 1) on consecutive ports from port
+    @return: list of (host, port)
+    """
+    if conf.get('members'):
+        return [tuple(member) for member in conf['members']]
+    return [(conf['address'], conf['port'] + n) for n in range(conf.get('partitions', 1))]
+
+
+def is_cluster(conf):
+    """
+    @param conf: jobs_queue configuration
+    @return: True if the job server runs as several partitions, a single partition is served as a plain job queue
+    """
+    return bool(conf.get('members')) or conf.get('partitions', 1) > 1
+
+
+def _point(value):
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of the keys on the partitions: every partition is `replicas` points of a circle, a key
+    belongs to the first point clockwise from its own hash
+    """
+
+    def __init__(self, members=(), replicas=64):
+        self.replicas = replicas
+        self.members = []
+        self._points, self._owners = [], []
+        for member in members:
+            self.add(member)
+
+    def add(self, member):
+        if member in self.members:
+            return
+        self.members.append(member)
+        for n in range(self.replicas):
+            point = _point('{}#{}'.format(member_name(member), n))
+            at = bisect(self._points, point)
+            self._points.insert(at, point)
+            self._owners.insert(at, member)
+
+    def remove(self, member):
+        self.members.remove(member)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != member]
+        self._points, self._owners = [p for p, _ in kept], [o for _, o in kept]
+
+    def owner(self, key):
+        if not self._points:
+            raise LookupError("No partition in the ring")
+        return self._owners[bisect(self._points, _point(str(key))) % len(self._points)]
+
+    def owner_of(self, item, codec=None):
+        return self.owner(partition_key(item, codec))
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return "< HashRing -- members: {} >".format([member_name(m) for m in self.members])
+
+
+class ClusterMap(object):
+    """
+    Membership of the cluster, a copy served by every partition next to its job queue: version, members (own the
+    keys) and retiring partitions (no key, still served until drained)
+    """
+
+    def __init__(self, members=()):
+        self._lock = threading.Lock()
+        self.version = 0
+        self.members = [tuple(m) for m in members]
+        self.retiring = []
+
+    def get(self):
+        with self._lock:
+            return self.version, list(self.members), list(self.retiring)
+
+    def set(self, version, members, retiring=()):
+        """
+        @return: True if the map is newer than this copy and replaced it
+        """
+        with self._lock:
+            if version <= self.version:
+                return False
+            self.version, self.members, self.retiring = version, list(members), list(retiring)
+            return True
+
+
+def merge_stats(stats):
+    """
+    Queue stats of the partitions as the stats of one queue: counters summed, flags or'ed, latest time
+    """
+    total = {}
+    for s in stats:
+        for k, v in s.items():
+            if k == 'time':
+                total[k] = max(total.get(k, v), v)
+            elif isinstance(v, bool):
+                total[k] = total.get(k, False) or v
+            elif v is None:
+                total.setdefault(k, None)
+            else:
+                total[k] = (total.get(k) or 0) + v
+    return total
+
+
+class PartitionedQueue(object):
+    """
+    Client side view over the partitions of the job server, same interface as a single job queue proxy.
+    Puts go to the owner of the key of every item. Gets poll the partitions in turn without waiting, then wait
+    on one of them a slice at a time. The items got are reported done to their partition (the one in the sources
+    of the Delivery for task_done_many, the one carried in the lease id for the acks), the done and failed ids of
+    the graph tasks to every partition
+    """
+
+    wait_slice = 0.1
+
+    def __init__(self, connect, members, refresh=1., codec=None):
+        """
+        @param connect: member -> (job queue, cluster map) proxies of the partition
+        @param members: (host, port) of the partitions, the cluster map of the partitions overrides them
+        @param refresh: seconds between two checks of the cluster map
+        @param codec: name of the codec the tasks are encoded with, their payloads are decoded for their partition
+        key when it is not given (see partition_key)
+        """
+        self._connect = connect
+        self.refresh = refresh
+        self.codec = codec
+        self._partitions = {}
+        self._lock = threading.RLock()
+        self._undone = OrderedDict()  # partition -> items got and not reported done yet
+        self._turn = 0
+        self._apply(0, [tuple(m) for m in members], [])
+
+    def _apply(self, version, members, retiring):
+        self.version = version
+        self.ring = HashRing(members)
+        self._retiring = list(retiring)
+        self._polled = list(members) + [m for m in retiring if m not in members]
+        self._synced = time.time()
+
+    def _partition(self, member):
+        partition = self._partitions.get(member)
+        if partition is None:
+            partition = self._partitions[member] = self._connect(member)
+        return partition
+
+    def _queue(self, member):
+        return self._partition(member)[0]
+
+    def _sync(self, force=False):
+        """
+        Pick up the cluster map published by add_partition/remove_partition
+        """
+        if not force and time.time() - self._synced < self.refresh:
+            return
+        with self._lock:
+            if not force and time.time() - self._synced < self.refresh:
+                return
+            self._synced = time.time()
+            for member in self._polled:
+                try:
+                    version, members, retiring = self._partition(member)[1].get()
+                    break
+                except Exception as e:
+                    log.warning("Cluster map of {} unavailable: {}".format(member_name(member), e))
+            else:
+                return
+            if version > self.version:
+                self._apply(version, members, retiring)
+                log.info("Cluster map {}: {}, retiring {}".format(version, self.ring, retiring))
+
+    def _publish(self, members, retiring):
+        """
+        Under the lock: the next map to every partition, old and new
+        """
+        version = self.version + 1
+        for member in set(self._polled) | set(members) | set(retiring):
+            self._partition(member)[1].set(version, members, retiring)
+        self._apply(version, members, retiring)
+
+    def _split(self, items, keys=None):
+        groups = OrderedDict()
+        owner = self.ring.owner
+        if keys is None:
+            keys = [partition_key(item, self.codec) for item in items]
+        for key, item in zip(keys, items):
+            groups.setdefault(owner(key), []).append(item)
+        return groups
+
+    def put_many(self, items, priority=None, eta=None, countdown=None, keys=None, **route):
+        """
+        One put_many per partition: a batch refused by a partition (Backpressure) leaves the batches of the others in
+        @param keys: partition key of every item, taken from the tasks before they were encoded (see partition_key)
+        so that the payloads are not decoded again
+        @param route: tenant of FairQueue partitions, host or key of RoutedQueue partitions. A batch with a key goes
+        to the owner of the key as a whole
+        """
+        self._sync()
+        items = list(items)
+        if route.get('key') is not None:
+            groups = {self.ring.owner(route['key']): items}
+        else:
+            groups = self._split(items, None if keys is None else list(keys))
+        return sum(self._queue(member).put_many(batch, priority, eta=eta, countdown=countdown, **route)
+                   for member, batch in groups.items())
+
+    def put_routed(self, batches, priority=None, eta=None, countdown=None):
+        """
+        RoutedQueue partitions: batches of different routes in one call per partition, see put_many
+        @param batches: list of (host, key, items)
+        """
+        self._sync()
+        routed = OrderedDict()
+        for host, key, items in batches:
+            groups = {self.ring.owner(key): list(items)} if key is not None else self._split(items)
+            for member, batch in groups.items():
+                routed.setdefault(member, []).append((host, key, batch))
+        return sum(self._queue(member).put_routed(member_batches, priority, eta, countdown)
+                   for member, member_batches in routed.items())
+
+    def put(self, item, *args, **kwargs):
+        self._sync()
+        return self._queue(self.ring.owner_of(item, self.codec)).put(item, *args, **kwargs)
+
+    def put_graph(self, nodes, priority=None, key=None, **route):
+        """
+        @param key: the whole graph goes to the owner of key, by default the owner of its first task id
+        @param route: tenant or host of the graph, see put_many
+        """
+        self._sync()
+        nodes = list(nodes)
+        if not nodes:
+            return 0
+        return self._queue(self.ring.owner(nodes[0][0] if key is None else key)).put_graph(nodes, priority, **route)
+
+    def _poll(self, fetch, timeout):
+        """
+        fetch(queue, timeout) every partition in turn without waiting, then wait on the next one for a slice
+        @return: (partition, items) of the first partition with items
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._sync()
+            polled = self._polled
+            self._turn = turn = (self._turn + 1) % len(polled)
+            polled = polled[turn:] + polled[:turn]
+            for member in polled:
+                try:
+                    return member, fetch(self._queue(member), 0)
+                except Empty:
+                    pass
+            wait = self.wait_slice if len(polled) > 1 else self.refresh
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise Empty
+            try:
+                return polled[0], fetch(self._queue(polled[0]), wait)
+            except Empty:
+                pass
+
+    def get_many(self, max_items, timeout=None, host=None):
+        route = {} if host is None else dict(host=host)
+        member, items = self._poll(lambda queue, wait: queue.get_many(max_items, wait, **route), timeout)
+        with self._lock:
+            self._undone[member] = self._undone.pop(member, 0) + len(items)
+        return Delivery(items, [(member, source) for source in sources_of(items)])
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, timeout if block else 0)[0]
+
+    def lease_many(self, max_items, timeout=None, visibility=30., max_attempts=5, host=None):
+        """
+        @return: list of ((partition, lease id), item, attempt)
+        """
+        route = {} if host is None else dict(host=host)
+        member, leased = self._poll(lambda queue, wait: queue.lease_many(max_items, wait, visibility, max_attempts,
+                                                                         **route), timeout)
+        return [((member, lease), item, attempt) for lease, item, attempt in leased]
+
+    def _announce(self, done_ids, reported):
+        """
+        The graph tasks wait on the partition of their graph, the other partitions ignore the ids
+        """
+        if done_ids:
+            for member in self._polled:
+                if member not in reported:
+                    self._queue(member).task_done_many(0, done_ids)
+
+    def _take_undone(self, count, sources):
+        """
+        Items got no longer undone: the ones of sources, else count of them from the partitions got from first
+        @return: OrderedDict partition -> sources of its items (None each without sources)
+        """
+        groups = OrderedDict()
+        with self._lock:
+            if sources is not None:
+                for member, source in sources:
+                    groups.setdefault(member, []).append(source)
+            elif count > sum(self._undone.values()):
+                raise ValueError('task_done() called too many times')
+            else:
+                for member, undone in self._undone.items():
+                    if not count:
+                        break
+                    groups[member] = [None] * min(count, undone)
+                    count -= len(groups[member])
+            if any(len(got) > self._undone.get(member, 0) for member, got in groups.items()):
+                raise ValueError('task_done() called too many times')
+            for member, got in groups.items():
+                self._undone[member] -= len(got)
+                if not self._undone[member]:
+                    del self._undone[member]
+        return groups
+
+    @staticmethod
+    def _inner(got):
+        return dict(sources=got) if any(source is not None for source in got) else {}
+
+    def task_done_many(self, count, done_ids=(), sources=None):
+        """
+        @param sources: Delivery.sources of the items done, by default the first items got are taken for them
+        """
+        groups = self._take_undone(count, sources)
+        for member, got in groups.items():
+            self._queue(member).task_done_many(len(got), done_ids, **self._inner(got))
+        self._announce(done_ids, groups)
+
+    def requeue_many(self, items, priority=None, sources=None):
+        """
+        Items got given back to the partition they came from, see task_done_many
+        """
+        items = list(items)
+        groups = self._take_undone(len(items), sources)
+        members = [member for member, _ in sources] if sources is not None else \
+            [member for member, got in groups.items() for _ in got]
+        batches = OrderedDict()
+        for member, item in zip(members, items):
+            batches.setdefault(member, []).append(item)
+        return sum(self._queue(member).requeue_many(batch, priority, **self._inner(groups[member]))
+                   for member, batch in batches.items())
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_failed_many(self, task_ids):
+        """
+        To every partition, as the done_ids
+        """
+        task_ids = list(task_ids)
+        return sum(self._queue(member).task_failed_many(task_ids) for member in self._polled)
+
+    @staticmethod
+    def _by_partition(lease_ids):
+        groups = OrderedDict()
+        for member, lease in lease_ids:
+            groups.setdefault(member, []).append(lease)
+        return groups
+
+    def ack_many(self, lease_ids, done_ids=()):
+        groups = self._by_partition(lease_ids)
+        acked = sum(self._queue(member).ack_many(leases, done_ids) for member, leases in groups.items())
+        self._announce(done_ids, groups)
+        return acked
+
+    def nack_many(self, lease_ids, delay=None, spend=True):
+        return sum(self._queue(member).nack_many(leases, delay, spend)
+                   for member, leases in self._by_partition(lease_ids).items())
+
+    def extend_many(self, lease_ids):
+        return sum(self._queue(member).extend_many(leases)
+                   for member, leases in self._by_partition(lease_ids).items())
+
+    def add_periodic(self, name, item, priority=None, cron=None, every=None, **route):
+        self._sync()
+        return self._queue(self.ring.owner(name)).add_periodic(name, item, priority, cron, every, **route)
+
+    def remove_periodic(self, name):
+        for member in self._polled:
+            self._queue(member).remove_periodic(name)
+
+    def periodic(self):
+        schedules = {}
+        for member in self._polled:
+            schedules.update(self._queue(member).periodic())
+        return schedules
+
+    def dead_letters(self, max_items=None, pop=True):
+        dead = []
+        for member in self._polled:
+            dead.extend(self._queue(member).dead_letters(None if max_items is None else max_items - len(dead), pop))
+        return sorted(dead, key=lambda d: d['time'])
+
+    def flow_control(self, high_water=None, low_water=None, overflow='block', timeout=None):
+        """
+        The marks apply to every partition
+        """
+        for member in self._polled:
+            self._queue(member).flow_control(high_water, low_water, overflow, timeout)
+
+    def qsize(self):
+        return sum(self._queue(member).qsize() for member in self._polled)
+
+    def stats(self):
+        """
+        Stats of the partitions merged (see merge_stats), with the number of partitions owning keys
+        """
+        self._sync()
+        stats = merge_stats([self._queue(member).stats() for member in self._polled])
+        stats['partitions'] = len(self.ring)
+        return stats
+
+    def partition_stats(self):
+        """
+        @return: {'host:port': stats of the partition}
+        """
+        self._sync()
+        return {member_name(member): self._queue(member).stats() for member in self._polled}
+
+    def _move(self, sources):
+        """
+        Waiting items of the sources owned by another partition now, put to their owner with their priority and
+        route, unthrottled: they were admitted already. Items their owner could not take go back to their source
+        @return: items moved
+        """
+        moved = 0
+        for source in sources:
+            batches = OrderedDict()
+            for owner, priority, route, item in self._queue(source).export_moved(self.ring, source, self.codec):
+                batches.setdefault((owner, priority, tuple(sorted(route.items()))), []).append(item)
+            for (owner, priority, route), items in batches.items():
+                try:
+                    moved += self._queue(owner).import_moved(items, priority, **dict(route))
+                except Exception as e:
+                    log.error("Unable to move {} items to {}, kept on {}: {}".format(
+                        len(items), member_name(owner), member_name(source), e))
+                    self._queue(source).import_moved(items, priority, **dict(route))
+        return moved
+
+    def add_partition(self, member):
+        """
+        member takes its share of the keys: the new map is published and the waiting items member owns now are
+        moved to it. The clients put to the previous owners until their next refresh, the workers get from
+        every partition anyway
+        @param member: (host, port) of a running job server
+        @return: items moved
+        """
+        member = tuple(member)
+        with self._lock:
+            self._sync(force=True)
+            if member in self.ring:
+                return 0
+            sources = list(self._polled)
+            self._publish(self.ring.members + [member], [m for m in self._retiring if m != member])
+        moved = self._move(sources)
+        log.info("Partition {} added, {} items moved to it".format(member_name(member), moved))
+        return moved
+
+    def remove_partition(self, member, timeout=30.):
+        """
+        member gives its keys back to the others: once the new map is published its waiting items are moved to
+        their new owner, until it holds nothing any more (its scheduled and blocked items are moved when released,
+        in flight ones reported done). Then it leaves the map, the server can be stopped
+        @param timeout: seconds waited for its items, None waits forever. Past it member leaves the map anyway
+        @return: items moved
+        """
+        member = tuple(member)
+        with self._lock:
+            self._sync(force=True)
+            if member not in self.ring:
+                raise ValueError("{} is not a partition of the cluster".format(member_name(member)))
+            if len(self.ring) == 1:
+                raise ValueError("Cannot remove the last partition of the cluster")
+            self._publish([m for m in self.ring.members if m != member], self._retiring + [member])
+
+        deadline = None if timeout is None else time.time() + timeout
+        moved, queue = 0, self._queue(member)
+        while True:
+            moved += self._move([member])
+            stats = queue.stats()
+            left = stats['size'] + stats['in_flight'] + stats['scheduled'] + stats['blocked']
+            if not left:
+                break
+            if deadline is not None and time.time() > deadline:
+                log.warning("Partition {} removed with {} items left".format(member_name(member), left))
+                break
+            time.sleep(0.1)
+
+        with self._lock:
+            self._sync(force=True)
+            self._publish(self.ring.members, [m for m in self._retiring if m != member])
+        log.info("Partition {} removed, {} items moved from it".format(member_name(member), moved))
+        return moved
+
+    def __repr__(self):
+        return "< PartitionedQueue -- map {}: {} retiring: {} >".format(
+            self.version, [member_name(m) for m in self.ring.members], [member_name(m) for m in self._retiring])
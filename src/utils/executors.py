@@ -0,0 +1,197 @@
+import threading
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from src.logging.dsys_logger_client import get_logger
+
+log = get_logger(__name__)
+
+__doc__ = """
+Worker execution modes, selected with the "mode" Worker option:
+  process    jobs run one after the other in the worker process (default)
+  threads:N  up to N jobs run concurrently on threads of the worker process, for I/O bound tasks
+A job is the list of tasks decoded from one queue item.
+"""
+
+DEFAULT_CONCURRENCY = 8
+
+_STOP = object()
+
+
+def parse_mode(mode):
+    """
+    @param mode: 'process' or 'threads:N', N defaults to DEFAULT_CONCURRENCY
+    @return: (kind, concurrency)
+    """
+    kind, _, concurrency = (mode or 'process').partition(':')
+    if kind not in executors_setup:
+        raise ValueError("Unknown execution mode {}, available: {}".format(mode, ', '.join(sorted(executors_setup))))
+    if kind == 'process':
+        return kind, 1
+    try:
+        concurrency = int(concurrency) if concurrency else DEFAULT_CONCURRENCY
+    except ValueError:
+        raise ValueError("Execution mode {}: concurrency must be an integer".format(mode))
+    if concurrency < 1:
+        raise ValueError("Execution mode {}: concurrency must be positive".format(mode))
+    return kind, concurrency
+
+
+class Executor(object):
+    """
+    Runs the jobs of a Worker in its process, one after the other
+    """
+
+    def __init__(self, execute, complete, concurrency=1):
+        """
+        @param execute: callable(tasks) returning the results by task id, None when the job failed
+        @param complete: callable(jobs, results) reporting executed jobs and their merged results
+        @param concurrency: jobs in flight
+        """
+        self.execute = execute
+        self.complete = complete
+        self.concurrency = concurrency
+
+    def free(self, extra=0):
+        """
+        @param extra: jobs accepted beyond the concurrency, waiting for a slot (prefetch)
+        @return: jobs that can be submitted now, blocks until there is at least one
+        """
+        return self.concurrency + extra
+
+    def submit_many(self, jobs):
+        done, results = [], {}
+        for tasks in jobs:
+            out = self.execute(tasks)
+            if out is not None:
+                done.append(tasks)
+                results.update(out)
+        if done:
+            self.complete(done, results)
+
+    def shutdown(self):
+        """
+        Wait for the jobs in flight and their reports
+        """
+
+    def __repr__(self):
+        return "< {} -- concurrency: {} >".format(self.__class__.__name__, self.concurrency)
+
+
+class ConcurrentExecutor(Executor):
+    """
+    Up to concurrency jobs in flight, the completed ones are reported in bulk from a reporter thread
+    """
+
+    def __init__(self, execute, complete, concurrency=DEFAULT_CONCURRENCY):
+        super(ConcurrentExecutor, self).__init__(execute, complete, concurrency)
+        self._running = 0
+        self._slots = threading.Condition(threading.Lock())
+        self._completed = Queue.Queue()
+        self._reporter = self._thread(self._report)
+
+    @staticmethod
+    def _thread(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _start(self, tasks):
+        raise NotImplementedError("This method must be implemented")
+
+    def free(self, extra=0):
+        with self._slots:
+            while self._running >= self.concurrency + extra:
+                # timed, so that the signal handlers of the main thread still run while it waits
+                self._slots.wait(1.)
+            return self.concurrency + extra - self._running
+
+    def submit_many(self, jobs):
+        with self._slots:
+            self._running += len(jobs)
+        for tasks in jobs:
+            self._start(tasks)
+
+    def _done(self, tasks, results):
+        self._completed.put((tasks, results))
+        with self._slots:
+            self._running -= 1
+            self._slots.notify()
+
+    def _report(self):
+        stop = False
+        while not stop:
+            items = [self._completed.get()]
+            while True:
+                try:
+                    items.append(self._completed.get_nowait())
+                except Queue.Empty:
+                    break
+
+            done, results = [], {}
+            for item in items:
+                if item is _STOP:
+                    stop = True
+                elif item[1] is not None:
+                    done.append(item[0])
+                    results.update(item[1])
+            if done:
+                try:
+                    self.complete(done, results)
+                except Exception as e:
+                    log.error("{}: unable to report {} jobs -- {}".format(self, len(done), str(e)))
+
+    def shutdown(self):
+        with self._slots:
+            while self._running:
+                self._slots.wait(1.)
+        self._completed.put(_STOP)
+        self._reporter.join()
+
+
+class ThreadExecutor(ConcurrentExecutor):
+
+    def __init__(self, execute, complete, concurrency=DEFAULT_CONCURRENCY):
+        super(ThreadExecutor, self).__init__(execute, complete, concurrency)
+        self._jobs = Queue.Queue()
+        self._threads = [self._thread(self._work) for _ in range(concurrency)]
+
+    def _start(self, tasks):
+        self._jobs.put(tasks)
+
+    def _work(self):
+        while True:
+            tasks = self._jobs.get()
+            if tasks is _STOP:
+                return
+            results = None
+            try:
+                results = self.execute(tasks)
+            except Exception as e:
+                log.error("{}: Encountered an error -- {}".format(self, str(e)))
+            self._done(tasks, results)
+
+    def shutdown(self):
+        super(ThreadExecutor, self).shutdown()
+        for _ in self._threads:
+            self._jobs.put(_STOP)
+
+
+executors_setup = {
+    'process': Executor,
+    'threads': ThreadExecutor,
+}
+
+
+def get_executor(mode, execute, complete, batch_size=1):
+    """
+    @param mode: execution mode, see parse_mode
+    @param batch_size: jobs per round in process mode
+    @return: Executor instance
+    """
+    kind, concurrency = parse_mode(mode)
+    return executors_setup[kind](execute, complete, batch_size if kind == 'process' else concurrency)
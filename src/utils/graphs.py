@@ -0,0 +1,145 @@
+from collections import OrderedDict
+
+__doc__ = """
+Task graphs: chain, group and chord over Tasks, submitted at once with BatchQueueMixin.put_graph.
+The job queue holds every task until the tasks it depends on are done: the workers report the graph tasks
+they complete with task_done_many/ack_many, which releases the tasks waiting for them. Results are passed by
+reference, the args of a downstream task hold a ResultRef per input, bound by the worker to the results read
+from the results store right before it runs the task.
+
+    pipeline = chain(Task(id1, fetch_figi, [tickers]), Task(id2, transform, []), Task(id3, store, []))
+    pipeline.submit(jobs)
+    results.wait_result(pipeline.leaves[0])
+
+A chained task gets the result of the previous step as first positional arg, a list of the results when the
+previous step is a group (chord). Intermediate results stay in the results store until they expire: they
+must not be popped, keep pop_on_read off for graphs.
+"""
+
+
+class ResultRef(dict):
+    """
+    Placeholder for the result of task task_id in the args of a graph task. A dict, so that it goes through
+    every codec as is
+    """
+
+    KEY = '__result__'
+
+    def __init__(self, task_id):
+        super(ResultRef, self).__init__()
+        self[self.KEY] = task_id
+
+    @property
+    def task_id(self):
+        return self[self.KEY]
+
+    def __repr__(self):
+        return "< ResultRef {} >".format(self.task_id)
+
+
+def _is_ref(value):
+    return isinstance(value, dict) and ResultRef.KEY in value
+
+
+def bind_results(args, results):
+    """
+    @param results: results by task id
+    @return: args with every ResultRef, in lists and dict values too, replaced by its result (None if missing)
+    """
+    if _is_ref(args):
+        return results.get(args[ResultRef.KEY])
+    if isinstance(args, (list, tuple)):
+        return type(args)(bind_results(a, results) for a in args)
+    if isinstance(args, dict):
+        return {k: bind_results(v, results) for k, v in args.items()}
+    return args
+
+
+def _prepend(task, value):
+    if isinstance(task.args, dict):
+        raise ValueError("Task {} takes keyword args, it cannot be fed a previous result".format(task.id))
+    task.args = [value] + list(task.args) if isinstance(task.args, (list, tuple)) else [value, task.args]
+
+
+class Graph(object):
+    """
+    Tasks and their dependencies. roots run first, the results of the leaves are the results of the graph
+    """
+
+    def __init__(self, nodes=None, roots=(), leaves=()):
+        self.nodes = nodes if nodes is not None else OrderedDict()  # task id -> (task, ids it waits for)
+        self.roots = list(roots)
+        self.leaves = list(leaves)
+
+    @classmethod
+    def of(cls, item):
+        if isinstance(item, Graph):
+            return item
+        return cls(OrderedDict([(item.id, (item, []))]), [item.id], [item.id])
+
+    def then(self, other, as_list=None):
+        """
+        @param as_list: feed other with the list of the results of the leaves, by default when there are several
+        @return: graph running other once this one is done, fed with the results of the leaves
+        """
+        other = Graph.of(other)
+        if set(self.nodes) & set(other.nodes):
+            raise ValueError("A task can appear once in a graph")
+        refs = [ResultRef(leaf) for leaf in self.leaves]
+        for leaf in self.leaves:
+            self.nodes[leaf][0].downstream = True
+        for root in other.roots:
+            task, waits = other.nodes[root]
+            _prepend(task, refs if as_list or (as_list is None and len(refs) > 1) else refs[0])
+            task.inputs = tuple(task.inputs) + tuple(self.leaves)
+            waits.extend(self.leaves)
+        nodes = OrderedDict(self.nodes)
+        nodes.update(other.nodes)
+        return Graph(nodes, self.roots, other.leaves)
+
+    def submit(self, queue, priority=1, codec=None):
+        """
+        @param queue: job queue (proxy), through put_graph
+        @param codec: codec name or instance the tasks are encoded with, None puts the Task objects
+        @return: ids of the leaves
+        """
+        queue.put_graph([(task_id, task.encode(codec) if codec is not None else task, waits)
+                         for task_id, (task, waits) in self.nodes.items()], priority)
+        return self.leaves
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return "< Graph -- tasks: {} roots: {} leaves: {} >".format(len(self.nodes), len(self.roots),
+                                                                     len(self.leaves))
+
+
+def chain(*steps):
+    """
+    Steps (tasks or graphs) one after the other, each one fed with the result of the previous
+    """
+    graph = Graph.of(steps[0])
+    for step in steps[1:]:
+        graph = graph.then(step)
+    return graph
+
+
+def group(*steps):
+    """
+    Steps running in parallel, their leaves together are the result
+    """
+    graphs = [Graph.of(step) for step in steps]
+    nodes = OrderedDict()
+    for graph in graphs:
+        if set(nodes) & set(graph.nodes):
+            raise ValueError("A task can appear once in a graph")
+        nodes.update(graph.nodes)
+    return Graph(nodes, [r for g in graphs for r in g.roots], [l for g in graphs for l in g.leaves])
+
+
+def chord(header, callback):
+    """
+    Fan-in: callback gets the list of the results of the header steps once they are all done
+    """
+    return group(*header).then(callback, as_list=True)
@@ -1,13 +1,106 @@
 import socket
 import time
-from multiprocessing import Manager, Process
-from multiprocessing.managers import BaseManager, DictProxy
+from multiprocessing import Process, current_process
+from multiprocessing.connection import Listener, Client
+from multiprocessing.managers import BaseManager, BaseProxy, AutoProxy, listener_client, dispatch, convert_to_error
 from random import seed, randint
 from src.logging.dsys_logger_client import get_logger
+from src.utils.results import ResultsStore, ResultsProxy, ShardedResults
+from src.utils.cluster import PartitionedQueue
+from src.utils.serializers import get_codec
+from src.utils.pool import get_pool
 
 log = get_logger(__name__)
 
 
+def _nodelay(conn):
+    """
+    Disable Nagle on manager connections: a batched message is sent as header + body, which otherwise
+    stalls on the peer's delayed ACK
+    """
+    try:
+        sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.close()
+    except (socket.error, AttributeError):
+        pass  # unix socket or pipe
+    return conn
+
+
+class NoDelayListener(Listener):
+    def accept(self):
+        return _nodelay(Listener.accept(self))
+
+
+def no_delay_client(address, family=None, authkey=None):
+    return _nodelay(Client(address, family, authkey))
+
+
+listener_client['pickle'] = (NoDelayListener, no_delay_client)
+
+
+def manager_connection(address, authkey):
+    """
+    Connection served by its own thread on the manager server, usable by any proxy of that server. The server is
+    up when a pool connects (its manager client connected first): a refused connection fails at once
+    """
+    if not HostUtils.listening(address):
+        raise IOError("Manager server {} not listening".format(address))
+    conn = no_delay_client(address, authkey=authkey)
+    dispatch(conn, None, 'accept_connection', ('{}|pool'.format(current_process().name),))
+    return conn
+
+
+def manager_pool(address, authkey, size=None):
+    return get_pool(('manager', address, authkey), lambda: manager_connection(address, authkey), size=size)
+
+
+class PooledProxy(BaseProxy):
+    """
+    BaseProxy sending its calls over the connection pool of its server instead of a connection per thread
+    """
+
+    def _callmethod(self, methodname, args=(), kwds={}):
+        try:
+            pool = self._pool
+        except AttributeError:
+            pool = self._pool = manager_pool(self._token.address, self._authkey)
+
+        kind, result = pool.request((self._id, methodname, args, kwds))
+        if kind == '#RETURN':
+            return result
+        elif kind == '#PROXY':
+            exposed, token = result
+            proxytype = self._manager._registry[token.typeid][-1]
+            token.address = self._token.address
+            proxy = proxytype(token, self._serializer, manager=self._manager, authkey=self._authkey,
+                              exposed=exposed)
+            conn = self._Client(token.address, authkey=self._authkey)
+            dispatch(conn, None, 'decref', (token.id,))
+            return proxy
+        raise convert_to_error(kind, result)
+
+
+_pooled_types = {}
+
+
+def pooled_proxy_type(proxytype):
+    """
+    @return: subclass of a BaseProxy type making its calls through PooledProxy
+    """
+    try:
+        return _pooled_types[proxytype]
+    except KeyError:
+        pooled = _pooled_types[proxytype] = type(str('Pooled' + proxytype.__name__), (PooledProxy, proxytype), {})
+        return pooled
+
+
+def PooledAutoProxy(token, serializer, manager=None, authkey=None, exposed=None, incref=True):
+    proxy = AutoProxy(token, serializer, manager=manager, authkey=authkey, exposed=exposed, incref=incref)
+    proxy.__class__ = pooled_proxy_type(type(proxy))
+    return proxy
+
+
 class QueueManager(BaseManager):
     """
     Job/queue server Manager
@@ -17,7 +110,7 @@ class QueueManager(BaseManager):
         self.queues_registered = []
 
         for q_name, queue in kwargs.pop('queues', {}).items():
-            QueueManager.register('get_' + q_name, callable=lambda: queue)
+            QueueManager.register('get_' + q_name, callable=lambda queue=queue: queue)
             self.queues_registered.append(q_name)
 
         # Register class methods
@@ -63,17 +156,20 @@ class ClientManager(BaseManager):
             kwargs.update(args[0])
 
         self.queues_registered = []
+        self.codec = get_codec(kwargs.pop('codec', None))
+        pool_size = kwargs.pop('pool_size', None)
 
         for q_name in kwargs.pop('queues', []):
-            ClientManager.register('get_' + q_name)
+            ClientManager.register('get_' + q_name, proxytype=PooledAutoProxy)
             self.queues_registered.append(q_name)
 
         # register server class method
-        ClientManager.register('get_server_info')
-        ClientManager.register('close_server')
-        ClientManager.register('get_results')
+        ClientManager.register('get_server_info', proxytype=PooledAutoProxy)
+        ClientManager.register('close_server', proxytype=PooledAutoProxy)
+        ClientManager.register('get_results', proxytype=pooled_proxy_type(ResultsProxy))
 
         super(ClientManager, self).__init__(address=kwargs.pop('address', None), authkey=kwargs.pop('authkey', None))
+        self.pool = manager_pool(self.address, self._authkey, size=pool_size)
 
         self.process()
 
@@ -81,6 +177,9 @@ class ClientManager(BaseManager):
         self.connect()
         log.info("Connected to: {0!s}".format(self.address))
 
+    def pool_stats(self):
+        return self.pool.stats()
+
     def shutdown_client(self):
         self.shutdown()
 
@@ -88,16 +187,96 @@ class ClientManager(BaseManager):
         return "< Queue manager client > -- connected to {}".format(self.address)
 
 
+class ShardedClientManager(object):
+    """
+    Client of a sharded results store: one ClientManager per shard
+    """
+
+    def __init__(self, addresses, authkey, queues=(), codec='json', pool_size=None):
+        self.codec = get_codec(codec, default='json')
+        self.clients = [ClientManager(address=address, authkey=authkey, queues=list(queues), codec=self.codec,
+                                      pool_size=pool_size)
+                        for address in addresses]
+
+    def get_results(self):
+        return ShardedResults([c.get_results() for c in self.clients])
+
+    def pool_stats(self):
+        """
+        Pool counters summed over the shards
+        """
+        total = {}
+        for c in self.clients:
+            for k, v in c.pool_stats().items():
+                total[k] = max(total.get(k, v), v) if k == 'max_wait' else total.get(k, 0) + v
+        return total
+
+    def shutdown_client(self):
+        for c in self.clients:
+            c.shutdown()
+
+    def __repr__(self):
+        return "< Sharded results client > -- connected to {}".format([c.address for c in self.clients])
+
+
+class PartitionedClientManager(object):
+    """
+    Client of a partitioned job server (see cluster): one ClientManager per partition, connected on first use
+    """
+
+    def __init__(self, addresses, authkey, codec=None, pool_size=None, refresh=1.):
+        self.codec = get_codec(codec)
+        self.authkey = authkey
+        self.pool_size = pool_size
+        self.refresh = refresh
+        self.addresses = [tuple(address) for address in addresses]
+        self.clients = {}
+
+    def _client(self, address):
+        client = self.clients.get(address)
+        if client is None:
+            client = self.clients[address] = ClientManager(address=address, authkey=self.authkey,
+                                                           queues=['tasks_queue', 'cluster_map'], codec=self.codec,
+                                                           pool_size=self.pool_size)
+        return client
+
+    def _partition(self, address):
+        client = self._client(address)
+        return client.get_tasks_queue(), client.get_cluster_map()
+
+    def get_tasks_queue(self):
+        return PartitionedQueue(self._partition, self.addresses, self.refresh, self.codec.name)
+
+    def pool_stats(self):
+        """
+        Pool counters summed over the partitions
+        """
+        total = {}
+        for c in self.clients.values():
+            for k, v in c.pool_stats().items():
+                total[k] = max(total.get(k, v), v) if k == 'max_wait' else total.get(k, 0) + v
+        return total
+
+    def shutdown_client(self):
+        for c in self.clients.values():
+            c.shutdown()
+
+    def __repr__(self):
+        return "< Partitioned job server client > -- partitions {}".format(self.addresses)
+
+
 class SharedResultsManager(BaseManager):
     """
-    Job/queue server Manager
+    Results server Manager, serves one shard of the results store
     """
 
     def __init__(self, *args, **kwargs):
         self.queues_registered = []
-        queue = Manager().dict()
+        store = ResultsStore(ttl=kwargs.pop('ttl', None),
+                             max_bytes=kwargs.pop('max_bytes', None),
+                             pop_on_read=kwargs.pop('pop_on_read', False))
 
-        SharedResultsManager.register('get_results', callable=lambda: queue, proxytype=DictProxy)
+        SharedResultsManager.register('get_results', callable=lambda: store, proxytype=ResultsProxy)
 
         # Register class methods
         SharedResultsManager.register('close_server', callable=self.shutdown_server)
@@ -161,6 +340,18 @@ class HostUtils(object):
 
         return port
 
+    @staticmethod
+    def listening(address, timeout=0.5):
+        """
+        Probe first: a manager client retries a refused connection for 20s
+        @return: True when a server accepts connections on address (host, port)
+        """
+        try:
+            socket.create_connection(address, timeout).close()
+            return True
+        except socket.error:
+            return False
+
     @staticmethod
     def get_host():
         return socket.gethostbyname(socket.gethostname())
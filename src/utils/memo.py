@@ -0,0 +1,88 @@
+import hashlib
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from src.utils.results import CACHE_HIT, CACHE_WAIT
+from src.utils.shm import load_args
+
+__doc__ = """
+Memoized tasks, registered with @task(cache=True, ttl=...): before running one, a worker looks its result up
+in the results store under the function name and the canonical form of its args. Identical tasks in flight
+at the same time are computed once, the other workers wait for that result (ResultsStore.claim).
+Only pure functions should be cached: a None result is taken for a failure and never cached.
+"""
+
+PREFIX = 'memo:'
+
+
+def canonical(value):
+    """
+    Args in a form equal for equal calls whatever the codec they travelled with: tuples and lists alike,
+    dicts and sets sorted, text as utf-8
+    """
+    if isinstance(value, dict):
+        return 'd', tuple(sorted((canonical(k), canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return 'l', tuple(canonical(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return 's', tuple(sorted(canonical(v) for v in value))
+    if isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def cache_key(task_name, args):
+    digest = hashlib.sha1(pickle.dumps(canonical(args), pickle.HIGHEST_PROTOCOL)).hexdigest()
+    return '{}{}:{}'.format(PREFIX, task_name, digest)
+
+
+def is_cached(task):
+    return getattr(task.func, 'cache', False)
+
+
+class TaskCache(object):
+    """
+    Worker side of the memoized tasks, over a results store (ResultsProxy or ShardedResults)
+    """
+
+    # a waiting claim holds a pooled connection to the results server, it is given back between slices
+    wait_slice = 1.
+
+    def __init__(self, store, codec, hold=60.):
+        """
+        @param codec: codec of the cached values, the results codec of the worker
+        @param hold: seconds a worker computing a result keeps the others waiting, past it one of them takes over
+        """
+        self.store = store
+        self.codec = codec
+        self.hold = hold
+
+    def call(self, task):
+        """
+        @return: the result of task, from the cache or computed and cached
+        """
+        key = cache_key(task.func.task_name, load_args(task.args))
+        state, value = self.store.claim(key, self.hold, self.wait_slice)
+        while state == CACHE_WAIT:
+            state, value = self.store.claim(key, self.hold, self.wait_slice, True)
+        if state == CACHE_HIT:
+            return self.codec.loads(value)
+
+        t0 = time.time()
+        try:
+            result = task()
+        except BaseException:
+            self.store.release(key)
+            raise
+        if result is None:
+            self.store.release(key)
+        else:
+            self.store.fill(key, self.codec.dumps(result), time.time() - t0, getattr(task.func, 'cache_ttl', None))
+        return result
+
+    def __repr__(self):
+        return "< TaskCache -- hold: {}s >".format(self.hold)
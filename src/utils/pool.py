@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+__doc__ = """
+Thread safe pool of multiprocessing.connection connections, shared by the manager proxies (see
+managers.PooledProxy) and PooledRPCProxy. Callers check a connection out for a single request/reply,
+so threads do not serialise on one socket nor open a connection each, and idle connections are
+health checked before being handed out again.
+"""
+
+DEFAULT_POOL_SIZE = 8
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Up to size connections, opened on demand by connect() and reused most recently released first
+    """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE, timeout=None, check_after=1.):
+        """
+        @param connect: callable returning a new connection
+        @param size: maximum number of open connections, callers wait for one beyond that
+        @param timeout: default seconds to wait for a connection, None waits forever
+        @param check_after: connections idle longer than this are health checked on checkout
+        """
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._reset()
+
+    def _reset(self):
+        # also run in a forked child: the connections inherited from the parent belong to its threads
+        for conn, _ in getattr(self, '_idle', ()):
+            self._close(conn)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = []  # (connection, released_at)
+        self._open = 0
+        self._waiting = 0  # notify() is pure python in py2, skipped without waiters
+        self._counters = dict(hits=0, misses=0, waits=0, wait_time=0., max_wait=0., timeouts=0, discarded=0,
+                              reconnects=0)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _healthy(conn):
+        """
+        An idle connection has nothing to read: readable means the peer closed it (or left garbage on it)
+        """
+        try:
+            return not conn.closed and not conn.poll(0)
+        except (IOError, OSError, EOFError):
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        @param timeout: seconds to wait for a free connection, defaults to the pool timeout
+        @return: (connection, reused), PoolTimeout if none freed up in time
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        timeout = self.timeout if timeout is None else timeout
+
+        with self._lock:
+            if not self._idle and self._open >= self.size:
+                self._wait(timeout)
+
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if time.time() - released_at < self.check_after or self._healthy(conn):
+                    self._counters['hits'] += 1
+                    return conn, True
+                self._close(conn)
+                self._open -= 1
+                self._counters['discarded'] += 1
+
+            self._open += 1
+            self._counters['misses'] += 1
+
+        try:
+            return self.connect(), False
+        except BaseException:
+            with self._lock:
+                self._open -= 1
+                self._notify()
+            raise
+
+    def _wait(self, timeout):
+        """
+        Wait, holding the lock, for a connection to be released or discarded
+        """
+        self._counters['waits'] += 1
+        self._waiting += 1
+        t0 = time.time()
+        try:
+            while not self._idle and self._open >= self.size:
+                remaining = None if timeout is None else t0 + timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    self._notify()  # pass on a wake up received just too late
+                    raise PoolTimeout("No connection released in {}s -- {}".format(timeout, self))
+                self._available.wait(remaining)
+        finally:
+            self._waiting -= 1
+            waited = time.time() - t0
+            self._counters['wait_time'] += waited
+            self._counters['max_wait'] = max(self._counters['max_wait'], waited)
+
+    def _notify(self):
+        if self._waiting:
+            self._available.notify()
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._idle.append((conn, time.time()))
+            self._notify()
+
+    def discard(self, conn):
+        """
+        Close a connection left in an unknown state instead of returning it to the pool
+        """
+        self._close(conn)
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._open -= 1
+            self._counters['discarded'] += 1
+            self._notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn, _ = self.acquire(timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+    def request(self, message, timeout=None):
+        """
+        Send message on a pooled connection and return the reply.
+        A send failing on a reused connection means the peer dropped it while idle: nothing reached the
+        server, so it is retried once on a fresh connection. Failures after the send are raised
+        """
+        for attempt in range(2):
+            conn, reused = self.acquire(timeout)
+            try:
+                conn.send(message)
+            except (IOError, OSError, EOFError):
+                self.discard(conn)
+                if reused and attempt == 0:
+                    with self._lock:
+                        self._counters['reconnects'] += 1
+                    continue
+                raise
+            except BaseException:
+                self.release(conn)  # pickling failed, nothing was written
+                raise
+
+            try:
+                reply = conn.recv()
+            except BaseException:
+                self.discard(conn)
+                raise
+            self.release(conn)
+            return reply
+
+    def stats(self):
+        """
+        Sizing counters: size, open, idle, hits (idle connection reused), misses (connection opened),
+        waits, wait_time, max_wait (seconds callers waited for a free connection), timeouts, discarded, reconnects
+        """
+        with self._lock:
+            return dict(self._counters, size=self.size, open=self._open, idle=len(self._idle))
+
+    def close(self):
+        with self._lock:
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._open -= len(self._idle)
+            self._idle = []
+
+    def __repr__(self):
+        return "< ConnectionPool -- open: {} idle: {} size: {} >".format(self._open, len(self._idle), self.size)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, connect, size=None, **options):
+    """
+    Process wide pool registry, one pool per server
+    @param key: hashable identifying the server, e.g. ('manager', address, authkey)
+    @param size: resizes an existing pool when given
+    """
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, size or DEFAULT_POOL_SIZE, **options)
+        elif size:
+            pool.size = size
+        return pool
@@ -1,5 +1,19 @@
-from Queue import Queue, PriorityQueue
+from Queue import Queue, PriorityQueue, Empty, Full
+from collections import deque, namedtuple
+from functools import partial
+from heapq import heappush, heappop, heapify
+from itertools import count
 import logging
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from src.utils.segment_log import SegmentLog, SYNC_GROUP
+from src.utils.schedules import due_time, Cron, Interval
 
 log = logging.getLogger(__name__)
 
@@ -14,25 +28,727 @@ TODO:
 """
 
 
-class IndexableQueue(Queue):
+# an item given back by an expired or nacked lease, with its next attempt number
+Redelivery = namedtuple('Redelivery', 'item attempts')
+
+
+class Backpressure(Full):
+    """
+    A put refused past the high water mark of the queue (see BatchQueueMixin.flow_control)
+    """
+
+
+class BatchQueueMixin(object):
+    """
+    Batched put/get for the registered queues.
+    A whole batch moves under a single lock acquisition, so through a manager proxy
+    it costs one round-trip instead of one per item.
+    Subclasses storing wrapped entries override _wrap/_unwrap/_requeue.
+    lease_many/ack_many give at-least-once delivery: un-acked items come back after their visibility timeout
+    with an attempt count, and go to the dead letters after max_attempts.
+    Batches put with an eta (or countdown) and the periodic items wait in a heap, moved into the queue by a
+    timer thread when due: getters never see them early and workers never sleep on them.
+    put_graph holds the tasks of a graph until the tasks they wait for are reported done (done_ids of
+    task_done_many/ack_many): they count as unfinished from the start, join() waits for the whole graph. The tasks
+    waiting for a task reported failed (task_failed_many) go to the dead letters.
+    Items waiting for their eta or their inputs and leases live in memory only, persistent queues included.
+    flow_control() bounds what the producers may leave waiting (ready, scheduled and blocked items): past the high
+    water mark their puts block, or fail with Backpressure, until the getters drain the queue to the low water mark.
+    """
+
+    completed = 0  # task_done() calls, read by stats()
+    scheduled = 0  # items waiting for their eta
+    redelivered = 0
+    dead_lettered = 0
+    blocked = 0  # graph items waiting for their inputs
+    _timers = None  # heap of (due, seq, action), created with the timer thread
+    _timer = None  # the timer thread
+    _timer_stop = None  # set by close()
+    _periodic = None
+    _leases = None  # {lease id: (expiry, entry)}
+    # {visibility: deque of expiries [deadline, leases left, first lease id, last lease id + 1, max attempts,
+    # visibility]}, one per lease_many call: its lease ids are consecutive
+    _expiries = None
+    _lease_id = 0  # last lease id given
+    _timer_due = None  # what the timer thread sleeps until, None for ever
+    _blocked = None  # {task id: [item, priority, inputs left]}
+    _dependents = None  # {task id: ids of the blocked tasks waiting for it}
+    _dead = None  # dead letters, dict(item, attempts, reason, time)
+    _getter = None  # host of the get_many/lease_many call draining the queue, for _get
+    high_water = None  # waiting items past which the producers get backpressure, None for no limit
+    low_water = None
+    overflow = 'block'
+    overflow_timeout = None
+    saturated = False  # the high water mark was hit, and the queue not drained to the low water mark since
+    refused = 0  # items refused by backpressure
+    throttled = 0  # puts that waited for the queue to drain
+    peak = 0  # most items waiting at once
+
+    def __init__(self, maxsize=0):
+        # Queue is an old-style class, object.__init__ comes first in the MRO of the subclasses
+        Queue.__init__(self, maxsize)
+
+    def _admit(self, items, priority):
+        """
+        Called under the lock before a batch is enqueued, raises to refuse the whole batch
+        """
+
+    def flow_control(self, high_water=None, low_water=None, overflow='block', timeout=None):
+        """
+        Producer backpressure
+        @param high_water: waiting items (ready, scheduled and blocked) a put may not take the queue past,
+        None disables it. A batch put into an empty queue is always admitted
+        @param low_water: once saturated, the puts resume when the queue is drained down to it, 3/4 of high_water
+        by default
+        @param overflow: 'block' waits for the queue to drain, 'reject' raises Backpressure at once
+        @param timeout: seconds a blocked put waits before raising Backpressure, None waits forever
+        """
+        if overflow not in ('block', 'reject'):
+            raise ValueError("Unknown overflow {}, available: block, reject".format(overflow))
+        if high_water is not None and high_water < 1:
+            raise ValueError("'high_water' must be a positive number")
+        with self.not_full:
+            self.high_water = high_water
+            self.low_water = None if high_water is None else \
+                min(high_water, high_water * 3 // 4 if low_water is None else low_water)
+            self.overflow = overflow
+            self.overflow_timeout = timeout
+            self.saturated = False
+            self.not_full.notify_all()
+
+    def _held(self):
+        return self._qsize() + self.scheduled + self.blocked
+
+    def _throttle(self, count):
+        """
+        Under the lock, before count items are admitted: wait for the getters past the high water mark
+        """
+        if self.high_water is None:
+            return
+        endtime = None
+        while True:
+            held = self._held()
+            if self.saturated and held <= self.low_water:
+                self.saturated = False
+                self.not_full.notify_all()
+            if not held or not self.saturated and held + count <= self.high_water:
+                return
+            self.saturated = True
+            if endtime is None:
+                endtime = float('inf') if self.overflow_timeout is None else time.time() + self.overflow_timeout
+                if self.overflow == 'block':
+                    self.throttled += 1
+            remaining = endtime - time.time()
+            if self.overflow == 'reject' or remaining <= 0:
+                self.refused += count
+                raise Backpressure("{} items waiting, high water mark {}: {} items refused".format(
+                    held, self.high_water, count))
+            # timed, the proxy thread of a blocked producer still notices a gone client
+            self.not_full.wait(min(remaining, 1.))
+
+    def _wrap(self, item, priority):
+        return item
+
+    def _unwrap(self, entry):
+        return entry
+
+    def _requeue(self, entry, item):
+        """
+        @return: the entry putting item back where entry was got from (same priority...)
+        """
+        return self._wrap(item, None)
+
+    def _priority(self, entry):
+        """
+        @return: the priority entry was put with, None for the FIFO queues
+        """
+        return None
+
+    def _route(self, entry):
+        """
+        @return: the route entry was put with (tenant, host, key), as keyword arguments of requeue_many
+        """
+        return {}
+
+    def put_many(self, items, priority=None, eta=None, countdown=None):
+        """
+        @param items: iterable of items to enqueue
+        @param priority: priority applied to the whole batch (ignored by FIFO queues)
+        @param eta: unix timestamp or datetime, the batch is delivered to the getters from then on
+        @param countdown: seconds from now, alternative to eta
+        @return: number of enqueued items
+        """
+        items = list(items)
+        due = due_time(eta, countdown)
+        if due is not None and due > time.time():
+            with self.not_full:
+                self._throttle(len(items))
+                self._admit(items, priority)
+                self._at(due, partial(self._release, items, priority))
+                self.scheduled += len(items)
+                self.peak = max(self.peak, self._held())
+            return len(items)
+        return self._put_now(items, priority)
+
+    def _put_now(self, items, priority, admit=True):
+        with self.not_full:
+            if admit:
+                self._throttle(len(items))
+                self._admit(items, priority)
+            for item in items:
+                if self.maxsize > 0:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                self._put(self._wrap(item, priority))
+            self.unfinished_tasks += len(items)
+            self.peak = max(self.peak, self._held())
+            self.not_empty.notify(len(items))
+        return len(items)
+
+    def requeue_many(self, items, priority=None):
+        """
+        Give back items got and not processed (a consumer stopping or giving a batch back): admitted already, they
+        are never throttled nor refused, and they stay the same tasks, their first delivery is done with
+        @return: number of items given back
+        """
+        items = list(items)
+        self._put_now(items, priority, admit=False)
+        with self.mutex:
+            self.unfinished_tasks -= len(items)
+        return len(items)
+
+    def import_moved(self, items, priority=None):
+        """
+        Items another partition of the job server exported (see export_moved): admitted there already, they are
+        never throttled nor refused, and they are new tasks here
+        @return: number of items put
+        """
+        return self._put_now(list(items), priority, admit=False)
+
+    def put_graph(self, nodes, priority=None):
+        """
+        Tasks depending on each other (see graphs), admitted as a whole: the tasks without inputs are put now,
+        the others once all the tasks they wait for are reported done. All of them count in unfinished_tasks now
+        @param nodes: list of (task id, item, ids of the tasks it waits for), all of them nodes of the call
+        @return: number of items put now
+        """
+        nodes = list(nodes)
+        ids = set(task_id for task_id, _, _ in nodes)
+        for task_id, _, waits in nodes:
+            if not ids.issuperset(waits):
+                raise ValueError("Graph task {} waits for tasks outside of the graph".format(task_id))
+
+        ready = []
+        with self.not_full:
+            self._throttle(len(nodes))
+            self._admit([item for _, item, _ in nodes], priority)
+            if self._blocked is None:
+                self._blocked, self._dependents = {}, {}
+            for task_id, item, waits in nodes:
+                waits = set(waits)
+                if not waits:
+                    ready.append(item)
+                    continue
+                self._blocked[task_id] = [item, priority, len(waits)]
+                for waited in waits:
+                    self._dependents.setdefault(waited, []).append(task_id)
+            self.blocked += len(nodes) - len(ready)
+            self.unfinished_tasks += len(nodes) - len(ready)
+            self.peak = max(self.peak, self._held())
+        return self._put_now(ready, priority, admit=False) if ready else 0
+
+    def _unblock(self, done_ids):
+        """
+        Under the lock: put the graph tasks all of whose inputs are done, counted in unfinished_tasks already
+        @return: number of tasks put
+        """
+        ready = {}
+        for task_id in done_ids:
+            for waiting in self._dependents.pop(task_id, ()):
+                node = self._blocked.get(waiting)
+                if node is None:
+                    continue  # dead-lettered with another of its inputs
+                node[2] -= 1
+                if not node[2]:
+                    del self._blocked[waiting]
+                    ready.setdefault(node[1], []).append(node[0])
+        released = 0
+        for priority, items in ready.items():
+            for item in items:
+                self._put(self._wrap(item, priority))
+            released += len(items)
+        self.blocked -= released
+        self.peak = max(self.peak, self._held())
+        self.not_empty.notify(released)
+        return released
+
+    def _start_timer(self):
+        if self._timers is None:
+            self._timers = []
+            self._timer_ids = count()
+            self._periodic = {}
+            self._timer_wake = threading.Condition(self.mutex)
+            self._timer_stop = threading.Event()
+            self._timer = threading.Thread(target=self._run_timer, name='{}-timer'.format(self.__class__.__name__))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def close(self):
+        """
+        Stop the timer thread: the scheduled and periodic items and the expired leases are no longer delivered
+        """
+        with self.mutex:
+            if self._timer is None:
+                return
+            self._timer_stop.set()
+            self._timer_wake.notify()
+        if self._timer is not threading.current_thread():
+            self._timer.join()
+
+    def _at(self, due, action):
+        """
+        Under the lock: run action(due, now) under the lock once due. It returns the (items, priority) batches
+        the timer then puts
+        """
+        self._start_timer()
+        heappush(self._timers, (due, next(self._timer_ids), action))
+        if self._timers[0][2] is action:
+            self._timer_wake.notify()  # earlier than what the timer waits for
+
+    def _next_due(self):
+        dues = [self._timers[0][0]] if self._timers else []
+        dues.extend(order[0][0] for order in (self._expiries or {}).values() if order)
+        return min(dues) if dues else None
+
+    def _run_timer(self):
+        while True:
+            with self.mutex:
+                while True:
+                    if self._timer_stop.is_set():
+                        return
+                    due = self._next_due()
+                    remaining = None if due is None else due - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._timer_due = due
+                    self._timer_wake.wait(remaining)
+
+                now, batches = time.time(), []
+                while self._timers and self._timers[0][0] <= now:
+                    at, _, action = heappop(self._timers)
+                    batches.extend(action(at, now))
+                self._expire_leases(now)
+
+            for items, priority in batches:
+                try:
+                    self._put_now(items, priority, admit=False)
+                except Exception as e:
+                    log.error("{}: unable to deliver {} scheduled items -- {}".format(self, len(items), str(e)))
+
+    def _release(self, items, priority, at, now):
+        self.scheduled -= len(items)
+        return [(items, priority)]
+
+    def _fire(self, periodic, at, now):
+        if self._periodic.get(periodic[0]) is not periodic:
+            return []  # removed
+        # a timer running late skips the missed runs
+        periodic[4] = periodic[1].next(at)
+        if periodic[4] <= now:
+            periodic[4] = periodic[1].next(now)
+        self._at(periodic[4], partial(self._fire, periodic))
+        return [([periodic[2]], periodic[3])]
+
+    def add_periodic(self, name, item, priority=None, cron=None, every=None):
+        """
+        Deliver item on a cron expression ("*/5 * * * *") or every `every` seconds, until remove_periodic(name).
+        The same payload is delivered each time, a Task keeps its id across runs
+        @return: first delivery time
+        """
+        if (cron is None) == (every is None):
+            raise ValueError("Periodic item {} needs either cron or every".format(name))
+        schedule = Cron(cron) if cron is not None else Interval(every)
+        due = schedule.next(time.time())
+        with self.mutex:
+            periodic = [name, schedule, item, priority, due]
+            self._at(due, partial(self._fire, periodic))
+            self._periodic[name] = periodic
+        return due
+
+    def remove_periodic(self, name):
+        """
+        @return: True if name was scheduled
+        """
+        with self.mutex:
+            return self._periodic is not None and self._periodic.pop(name, None) is not None
+
+    def periodic(self):
+        """
+        @return: {name: dict(schedule, priority, next)}
+        """
+        with self.mutex:
+            return {name: dict(schedule=repr(p[1]), priority=p[3], next=p[4])
+                    for name, p in (self._periodic or {}).items()}
+
+    def lease_many(self, max_items, timeout=None, visibility=30., max_attempts=5, host=None):
+        """
+        get_many with at-least-once delivery: every item is leased for `visibility` seconds and delivered again
+        unless acked in time. Leases of the same visibility expire in lease order: a deque per visibility keeps
+        them by lease_many call, with what the leases of the call share, every lease operation is O(1)
+        @param max_attempts: deliveries before the item goes to the dead letters, None retries forever
+        @param host: as in get_many
+        @return: list of (lease id, item, attempt), attempt counting from 1
+        """
+        with self.not_empty:
+            self._wait_items(timeout, host)
+            self._getter = host
+            if self._leases is None:
+                self._leases, self._expiries = {}, {}
+                self._start_timer()
+            order = self._expiries.get(visibility)
+            if order is None:
+                order = self._expiries[visibility] = deque()
+            lease_id = self._lease_id
+            expiry = [time.time() + visibility, 0, lease_id + 1, 0, max_attempts, visibility]
+
+            leases, leased = self._leases, []
+            while self._available(host) and len(leased) < max(max_items, 1):
+                entry = self._get()
+                item, attempt = self._unwrap(entry), 1
+                if isinstance(item, Redelivery):
+                    item, attempt = item
+                lease_id += 1
+                leases[lease_id] = expiry, entry
+                leased.append((lease_id, item, attempt))
+            self._lease_id = lease_id
+            self.not_full.notify(len(leased))
+            if leased:
+                expiry[1], expiry[3] = len(leased), lease_id + 1
+                order.append(expiry)
+                if self._timer_due is None or expiry[0] < self._timer_due:
+                    self._timer_wake.notify()
+            return leased
+
+    def _pop_leases(self, lease_ids):
+        if not self._leases:
+            return []
+        pop, leases = self._leases.pop, []
+        for lease_id in lease_ids:
+            lease = pop(lease_id, None)
+            if lease is not None:
+                lease[0][1] -= 1
+                leases.append(lease)
+        # acks come mostly in lease order, drop the expiries they emptied at the front of the deques
+        for order in self._expiries.itervalues():
+            while order and not order[0][1]:
+                order.popleft()
+        return leases
+
+    def ack_many(self, lease_ids, done_ids=()):
+        """
+        task_done() for leased items
+        @param done_ids: as in task_done_many, released even when the lease expired meanwhile
+        @return: items acked, leases that expired before the ack were redelivered already and are not counted
+        """
+        with self.mutex:
+            leases = self._pop_leases(lease_ids)
+            self._acked(leases)
+            acked = len(leases)
+            if acked or done_ids:
+                self._task_done(acked, done_ids)
+        return acked
+
+    def _acked(self, leases):
+        """
+        Under the lock: leases just acked, their entries are done with
+        """
+
+    def nack_many(self, lease_ids, delay=None, spend=True):
+        """
+        Give leased items back, for another attempt after delay seconds (immediately by default)
+        @param spend: False gives them back without spending an attempt, e.g. fetched before their eta
+        @return: items given back
+        """
+        with self.mutex:
+            leases = self._pop_leases(lease_ids)
+            for lease in leases:
+                if delay:
+                    self._at(time.time() + delay, partial(self._redeliver, lease, 'nacked', spent=spend))
+                else:
+                    self._redeliver(lease, 'nacked', spent=spend)
+        return len(leases)
+
+    def extend_many(self, lease_ids):
+        """
+        Renew leases for another visibility timeout, for tasks running longer than it
+        @return: leases renewed
+        """
+        with self.mutex:
+            leases, now, renewed = self._leases or {}, time.time(), 0
+            for lease_id in lease_ids:
+                lease = leases.get(lease_id)
+                if lease is not None:
+                    expiry, entry = lease
+                    expiry[1] -= 1
+                    expiry = [now + expiry[5], 1, lease_id, lease_id + 1, expiry[4], expiry[5]]
+                    leases[lease_id] = expiry, entry
+                    self._expiries[expiry[5]].append(expiry)
+                    renewed += 1
+            return renewed
+
+    def _expire_leases(self, now):
+        for order in (self._expiries or {}).values():
+            while order and order[0][0] <= now:
+                expiry = order.popleft()
+                for lease_id in xrange(expiry[2], expiry[3]):
+                    lease = self._leases.get(lease_id)
+                    if lease is not None and lease[0] is expiry:
+                        del self._leases[lease_id]
+                        self._redeliver(lease, 'expired')
+
+    def _redeliver(self, lease, reason, at=None, now=None, spent=True):
+        """
+        Under the lock: put a leased item back, or in the dead letters once out of attempts
+        @param spent: the delivery counts as an attempt
+        """
+        expiry, entry = lease
+        item, attempt, max_attempts = self._unwrap(entry), 1, expiry[4]
+        if isinstance(item, Redelivery):
+            item, attempt = item
+        if not spent:
+            self._put(self._requeue(entry, Redelivery(item, attempt)))
+            self.not_empty.notify()
+        elif max_attempts and attempt >= max_attempts:
+            self._dead_letter([item], attempt, reason)
+        else:
+            self._put(self._requeue(entry, Redelivery(item, attempt + 1)))
+            self.redelivered += 1
+            self.not_empty.notify()
+        return []
+
+    def _dead_letter(self, items, attempts, reason):
+        """
+        Under the lock: items done with, for good
+        """
+        if self._dead is None:
+            self._dead = deque()
+        now = time.time()
+        self._dead.extend(dict(item=item, attempts=attempts, reason=reason, time=now) for item in items)
+        self.dead_lettered += len(items)
+        self.unfinished_tasks -= len(items)
+        if self.unfinished_tasks <= 0:
+            self.all_tasks_done.notify_all()
+
+    def task_failed_many(self, task_ids):
+        """
+        Graph tasks that failed for good (no retry left): the tasks waiting for them, and the ones waiting for
+        those, would run without their inputs, they go to the dead letters
+        @return: number of tasks dead-lettered
+        """
+        with self.mutex:
+            failed, dropped = list(task_ids), []
+            while failed and self._dependents:
+                for waiting in self._dependents.pop(failed.pop(), ()):
+                    node = self._blocked.pop(waiting, None)
+                    if node is not None:
+                        dropped.append(node[0])
+                        failed.append(waiting)
+            if dropped:
+                self.blocked -= len(dropped)
+                self._dead_letter(dropped, 0, 'upstream failed')
+                self.not_full.notify_all()
+            return len(dropped)
+
+    def dead_letters(self, max_items=None, pop=True):
+        """
+        @return: list of dict(item, attempts, reason, time) of the items out of attempts, or waiting for a failed
+        graph task, oldest first
+        """
+        with self.mutex:
+            dead = self._dead or ()
+            items = list(dead)[:max_items]
+            if pop:
+                for _ in items:
+                    dead.popleft()
+            return items
+
+    def _take_moved(self, owner, partition):
+        """
+        Under the lock: take the waiting entries owner(entry) is not partition for out of the queue, the others are
+        put back
+        @return: list of (owner, entry) taken out
+        """
+        kept, taken = [], []
+        while self._qsize():
+            entry = self._get()
+            to = owner(entry)
+            if to == partition:
+                kept.append(entry)
+            else:
+                taken.append((to, entry))
+        for entry in kept:
+            self._put(entry)
+        return taken
+
+    def export_moved(self, ring, partition, codec=None):
+        """
+        Take out the waiting items owned by another partition of a job server cluster (see cluster): the items
+        leave the queue as if done, the ones partition still owns keep their place. Scheduled, blocked and leased
+        items stay, a redelivered item leaves without its attempts count. Items routed with a key are owned by the
+        owner of the key
+        @param ring: cluster.HashRing of the partitions
+        @param partition: member of ring this queue serves
+        @param codec: codec of the encoded tasks, see cluster.partition_key
+        @return: list of (owner, priority, route, item) taken out, route as the keyword arguments of import_moved
+        """
+        def owner(entry):
+            key = self._route(entry).get('key')
+            return ring.owner(key) if key is not None else ring.owner_of(BatchQueueMixin._item(self, entry), codec)
+
+        with self.mutex:
+            moved = [(to, self._priority(entry), self._route(entry), self._item(entry))
+                     for to, entry in self._take_moved(owner, partition)]
+            if moved:
+                self.unfinished_tasks -= len(moved)
+                if self.unfinished_tasks <= 0:
+                    self.all_tasks_done.notify_all()
+                self.not_full.notify(len(moved))
+            return moved
+
+    def _available(self, host):
+        """
+        Under the lock: items a getter of host may take
+        """
+        return self._qsize()
+
+    def _wait_items(self, timeout, host=None):
+        """
+        Under the lock: block until the queue has items for host, Empty after timeout seconds
+        """
+        if timeout is None:
+            while not self._available(host):
+                self.not_empty.wait()
+        elif timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        else:
+            endtime = time.time() + timeout
+            while not self._available(host):
+                remaining = endtime - time.time()
+                if remaining <= 0.0:
+                    raise Empty
+                self.not_empty.wait(remaining)
+
+    def get_many(self, max_items, timeout=None, host=None):
+        """
+        Block until at least one item is available, then drain up to max_items without waiting further
+        @param max_items: max number of items returned
+        @param timeout: seconds to wait for the first item, None waits forever
+        @param host: host of the getter, the queues routing items by host (RoutedQueue) serve its items first
+        @return: list of items
+        """
+        with self.not_empty:
+            self._wait_items(timeout, host)
+            self._getter = host
+            items = []
+            while self._available(host) and len(items) < max(max_items, 1):
+                items.append(self._item(self._get()))
+            self.not_full.notify(len(items))
+            return items
+
+    def _item(self, entry):
+        item = self._unwrap(entry)
+        return item.item if isinstance(item, Redelivery) else item
+
+    def get(self, block=True, timeout=None):
+        return self._item(Queue.get(self, block, timeout))
+
+    def put(self, item, block=True, timeout=None):
+        if self.high_water is None:
+            Queue.put(self, item, block, timeout)
+        else:
+            self.put_many([item])
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_done_many(self, count, done_ids=()):
+        """
+        task_done() for a whole batch
+        @param done_ids: ids of the graph tasks completed, the tasks waiting only for them are put
+        """
+        with self.all_tasks_done:
+            self._task_done(count, done_ids)
+
+    def _task_done(self, count, done_ids):
+        """
+        Under the lock
+        """
+        if done_ids and self._dependents:
+            self._unblock(done_ids)  # before the count drops: join() never sees a graph half done
+        unfinished = self.unfinished_tasks - count
+        if unfinished <= 0:
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self.all_tasks_done.notify_all()
+        self.unfinished_tasks = unfinished
+        self.completed += count
+
+    def stats(self):
+        """
+        Counters sampled by the autoscaler: size (waiting), in_flight (got, not done yet),
+        submitted and completed totals, scheduled (waiting for their eta), blocked (graph tasks waiting for their
+        inputs), leased, redelivered and dead_lettered, time of the sample.
+        Flow control: depth (size + scheduled + blocked, what high_water bounds), peak depth, high_water, low_water,
+        saturated, refused items and throttled puts
+        """
+        with self.mutex:
+            size = self._qsize()
+            leased = len(self._leases or ())
+            depth = self._held()
+            saturated = self.saturated and depth > self.low_water
+            return dict(size=size, in_flight=self.unfinished_tasks - size - self.blocked, scheduled=self.scheduled,
+                        leased=leased, blocked=self.blocked, redelivered=self.redelivered,
+                        dead_lettered=self.dead_lettered,
+                        submitted=self.unfinished_tasks + self.completed + self.dead_lettered, completed=self.completed,
+                        depth=depth, peak=self.peak, high_water=self.high_water, low_water=self.low_water,
+                        saturated=saturated, refused=self.refused, throttled=self.throttled, time=time.time())
+
+
+class IndexableQueue(BatchQueueMixin, Queue):
     def __getitem__(self, index):
         with self.mutex:
             return self.queue[index]
 
 
-class TasksPriorityQueue(PriorityQueue):
+class TasksPriorityQueue(BatchQueueMixin, PriorityQueue):
     def __init__(self):
         PriorityQueue.__init__(self)
         self.counter = 0
 
-    def put(self, item, priority):
-        PriorityQueue.put(self, (priority, self.counter, item))
-        self.counter += 1
+    def put(self, item, priority, eta=None, countdown=None):
+        if eta is None and countdown is None and self.high_water is None:
+            PriorityQueue.put(self, self._wrap(item, priority))
+        else:
+            self.put_many([item], priority, eta, countdown)
 
     def get(self, *args, **kwargs):
-        _, _, item = PriorityQueue.get(self, *args, **kwargs)
+        return self._item(PriorityQueue.get(self, *args, **kwargs))
+
+    def _wrap(self, item, priority):
+        entry = (priority, self.counter, item)
+        self.counter += 1
+        return entry
+
+    def _unwrap(self, entry):
+        _, _, item = entry
         return item
 
+    def _requeue(self, entry, item):
+        return self._wrap(item, entry[0])
+
+    def _priority(self, entry):
+        return entry[0]
+
 
 # class TasksPriorityQueue(PriorityQueue):
 #     def __init__(self, *args, **kwargs):
@@ -48,12 +764,601 @@ class TasksPriorityQueue(PriorityQueue):
 #         return item
 
 
-class SimpleQueue(Queue):
+class SimpleQueue(BatchQueueMixin, Queue):
+    pass
+
+
+DEFAULT_STORAGE_DIR = '/tmp/dsys_queue_storage'
+
+
+class PersistentQueue(BatchQueueMixin, Queue):
+    """
+    FIFO queue backed by an append-only SegmentLog: only (priority, seq) stays in memory, items are read back
+    from the segments on get.
+    Entries are (priority, seq, item), so a lease acks the record it was delivered from: lease_many/ack_many
+    items stay un-acked until acked, a redelivery or a dead letter acks the record it replaces. Items got without
+    a lease (get, get_many) are acked on delivery, nothing identifies them when task_done() comes.
+    Un-acked items are replayed when the queue is rebuilt on the same directory after a crash.
+    """
+
+    log_type = SegmentLog
+
+    def __init__(self, path=DEFAULT_STORAGE_DIR, maxsize=0, sync=SYNC_GROUP, sync_interval=0.005,
+                 segment_bytes=64 * 1024 * 1024):
+        self._log = self.log_type(path, segment_bytes=segment_bytes, sync=sync, sync_interval=sync_interval)
+        Queue.__init__(self, maxsize)
+
+        for seq, priority in self._log.live():
+            self._index_put(seq, priority)
+        self.unfinished_tasks = self._qsize()
+
+    def _init(self, maxsize):
+        self.queue = deque()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _index_put(self, seq, priority):
+        self.queue.append((priority, seq))
+
+    def _index_get(self):
+        return self.queue.popleft()
+
+    def _wrap(self, item, priority):
+        return priority or 0, None, item
+
+    def _unwrap(self, entry):
+        return entry[2]
+
+    def _requeue(self, entry, item):
+        return entry[0], None, item
+
+    def _put(self, entry):
+        priority, seq, item = entry
+        if seq is None:
+            seq = self._log.next_seq
+            self._log.put(seq, priority, pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self._index_put(seq, priority)
+
+    def _get(self):
+        priority, seq = self._index_get()
+        return priority, seq, pickle.loads(self._log.read(seq))
+
+    def _item(self, entry):
+        self._log.ack_many((entry[1],))
+        return BatchQueueMixin._item(self, entry)
+
+    def _acked(self, leases):
+        self._log.ack_many([lease[1][1] for lease in leases])
+
+    def _redeliver(self, lease, reason, at=None, now=None, spent=True):
+        # the redelivery is a new record, written before the old one is acked
+        batches = BatchQueueMixin._redeliver(self, lease, reason, at, now, spent)
+        self._log.ack_many((lease[1][1],))
+        return batches
+
+    def put(self, item, block=True, timeout=None, eta=None, countdown=None):
+        if eta is not None or countdown is not None or self.high_water is not None:
+            self.put_many([item], None, eta, countdown)
+            return
+        Queue.put(self, self._wrap(item, None), block, timeout)
+        self._log.wait_durable()
+
+    def _put_now(self, items, priority, admit=True):
+        count = BatchQueueMixin._put_now(self, items, priority, admit)
+        self._log.wait_durable()
+        return count
+
+    def close(self):
+        BatchQueueMixin.close(self)
+        self._log.close()
+
+
+class PersistentPriorityQueue(PersistentQueue):
+    """
+    Persistent variant of TasksPriorityQueue: same put(item, priority) signature, FIFO within a priority
+    """
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _index_put(self, seq, priority):
+        heappush(self.queue, (priority, seq))
+
+    def _index_get(self):
+        return heappop(self.queue)
+
+    def _priority(self, entry):
+        return entry[0]
+
+    def put(self, item, priority, block=True, timeout=None, eta=None, countdown=None):
+        if eta is not None or countdown is not None or self.high_water is not None:
+            self.put_many([item], priority, eta, countdown)
+            return
+        Queue.put(self, self._wrap(item, priority), block, timeout)
+        self._log.wait_durable()
+
+
+class QuotaExceeded(Full):
     pass
 
 
+class _FairSet(object):
+    """
+    Start-time fair queuing among keys: the backlogged key with the smallest virtual start tag is served next,
+    serving an item advances the key tag by 1 / weight, a key turning backlogged starts at the virtual time
+    """
+    __slots__ = ('vtime', 'tags', 'active', 'heap')
+
+    def __init__(self):
+        self.vtime = 0.
+        self.tags = {}
+        self.active = set()
+        self.heap = []  # (tag, key), stale entries are dropped when they surface
+
+    def activate(self, key):
+        tag = self.tags[key] = max(self.tags.get(key, 0.), self.vtime)
+        self.active.add(key)
+        heappush(self.heap, (tag, key))
+
+    def next(self):
+        heap = self.heap
+        while heap[0][1] not in self.active or heap[0][0] != self.tags[heap[0][1]]:
+            heappop(heap)
+        return heap[0][1]
+
+    def served(self, key, weight, backlogged):
+        tag = self.tags[key]
+        self.vtime = max(self.vtime, tag)
+        self.tags[key] = tag + 1. / weight
+        if self.heap[0] == (tag, key):
+            heappop(self.heap)
+        if backlogged:
+            heappush(self.heap, (self.tags[key], key))
+        else:
+            self.active.discard(key)
+
+
+class _PriorityClass(object):
+    __slots__ = ('weight', 'tenants', 'flows', 'size', 'waits', 'served')
+
+    def __init__(self, weight, window):
+        self.weight = weight
+        self.tenants = _FairSet()
+        self.flows = {}  # tenant -> deque of (seq, enqueued at, item)
+        self.size = 0
+        self.waits = deque(maxlen=window)
+        self.served = 0
+
+
+class FairQueue(BatchQueueMixin, Queue):
+    """
+    Scheduler queue with the TasksPriorityQueue put(item, priority) signature, plus an optional tenant.
+    Every operation is O(log n):
+      - priority classes share the consumers by weight (start-time fair queuing): a low priority class slows
+        down under load instead of starving. By default every `halving` priority points halve a class share
+      - within a class the tenants share the same way, by tenant weight (1 by default), FIFO per tenant.
+        quotas cap the items a tenant may have waiting, QuotaExceeded refuses the whole put
+      - aging: an item waiting longer than max_wait seconds is served before anything else, oldest first
+      - wait_stats() gives per class wait time percentiles over the last `window` gets
+    """
+
+    def __init__(self, maxsize=0, weights=None, halving=100., tenant_weights=None, quotas=None, max_wait=60.,
+                 window=1024):
+        """
+        @param weights: {priority: weight}, overrides the default 2 ** (-priority / halving)
+        @param tenant_weights: {tenant: weight}
+        @param quotas: {tenant: max waiting items}
+        @param max_wait: seconds, None disables aging
+        """
+        self.weights = weights or {}
+        self.halving = halving
+        self.tenant_weights = tenant_weights or {}
+        self.quotas = quotas or {}
+        self.max_wait = max_wait
+        self.window = window
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = None
+        self._size = 0
+        self._seq = 0
+        self._classes = {}
+        self._fair = _FairSet()
+        self._oldest = []  # (enqueued at, seq, priority, tenant), only with aging
+        self._waiting = {}  # tenant -> waiting items
+
+    def _qsize(self, len=len):
+        return self._size
+
+    def class_weight(self, priority):
+        weight = self.weights.get(priority)
+        return weight if weight else 2. ** (-(priority or 0) / float(self.halving))
+
+    def put(self, item, priority, tenant=None, eta=None, countdown=None):
+        self.put_many([item], priority, tenant, eta, countdown)
+
+    def put_many(self, items, priority=None, tenant=None, eta=None, countdown=None):
+        """
+        @param tenant: owner of the batch, for the tenant fair share and quota
+        """
+        return BatchQueueMixin.put_many(self, [(tenant, item) for item in items], priority, eta, countdown)
+
+    def requeue_many(self, items, priority=None, tenant=None):
+        return BatchQueueMixin.requeue_many(self, [(tenant, item) for item in items], priority)
+
+    def import_moved(self, items, priority=None, tenant=None):
+        return BatchQueueMixin.import_moved(self, [(tenant, item) for item in items], priority)
+
+    def put_graph(self, nodes, priority=None, tenant=None):
+        return BatchQueueMixin.put_graph(self, [(task_id, (tenant, item), waits) for task_id, item, waits in nodes],
+                                         priority)
+
+    def add_periodic(self, name, item, priority=None, cron=None, every=None, tenant=None):
+        return BatchQueueMixin.add_periodic(self, name, (tenant, item), priority, cron, every)
+
+    def get(self, *args, **kwargs):
+        return self._item(Queue.get(self, *args, **kwargs))
+
+    def _admit(self, items, priority):
+        if not items:
+            return
+        tenant = items[0][0]
+        quota = self.quotas.get(tenant)
+        if quota is not None and self._waiting.get(tenant, 0) + len(items) > quota:
+            raise QuotaExceeded("Tenant {} quota of {} waiting items exceeded".format(tenant, quota))
+
+    def _wrap(self, item, priority):
+        tenant, item = item
+        return priority or 0, tenant, item
+
+    def _put(self, entry):
+        priority, tenant, item = entry
+        cls = self._classes.get(priority)
+        if cls is None:
+            cls = self._classes[priority] = _PriorityClass(self.class_weight(priority), self.window)
+        flow = cls.flows.get(tenant)
+        if flow is None:
+            flow = cls.flows[tenant] = deque()
+
+        now, seq = time.time(), self._seq
+        self._seq += 1
+        flow.append((seq, now, item))
+        if len(flow) == 1:
+            cls.tenants.activate(tenant)
+        cls.size += 1
+        if cls.size == 1:
+            self._fair.activate(priority)
+        if self.max_wait is not None:
+            heappush(self._oldest, (now, seq, priority, tenant))
+        self._waiting[tenant] = self._waiting.get(tenant, 0) + 1
+        self._size += 1
+
+    def _aged(self, now):
+        """
+        @return: (priority, tenant) of the oldest item if it waited longer than max_wait, else None
+        """
+        oldest = self._oldest
+        while oldest:
+            enqueued_at, seq, priority, tenant = oldest[0]
+            flow = self._classes[priority].flows.get(tenant)
+            if not flow or flow[0][0] != seq:
+                heappop(oldest)  # served by the fair share already
+                continue
+            return (priority, tenant) if now - enqueued_at > self.max_wait else None
+
+    def _get(self):
+        now = time.time()
+        aged = self._aged(now) if self.max_wait is not None else None
+        if aged is None:
+            priority = self._fair.next()
+            tenant = self._classes[priority].tenants.next()
+        else:
+            priority, tenant = aged
+
+        cls = self._classes[priority]
+        flow = cls.flows[tenant]
+        seq, enqueued_at, item = flow.popleft()
+        if not flow:
+            del cls.flows[tenant]
+        cls.size -= 1
+        cls.tenants.served(tenant, self.tenant_weights.get(tenant, 1.), bool(flow))
+        self._fair.served(priority, cls.weight, bool(cls.size))
+        cls.waits.append(now - enqueued_at)
+        cls.served += 1
+
+        self._waiting[tenant] -= 1
+        if not self._waiting[tenant]:
+            del self._waiting[tenant]
+        self._size -= 1
+        return priority, tenant, item
+
+    def _unwrap(self, entry):
+        return entry[2]
+
+    def _requeue(self, entry, item):
+        return self._wrap((entry[1], item), entry[0])
+
+    def _priority(self, entry):
+        return entry[0]
+
+    def _route(self, entry):
+        return dict(tenant=entry[1])
+
+    def _take_moved(self, owner, partition):
+        """
+        The kept items stay in their flow, with their enqueue time: the export does not reset their aging
+        """
+        taken = []
+        for priority, cls in self._classes.items():
+            for tenant, flow in list(cls.flows.items()):
+                kept = deque()
+                for seq, enqueued_at, item in flow:
+                    to = owner((priority, tenant, item))
+                    if to == partition:
+                        kept.append((seq, enqueued_at, item))
+                    else:
+                        taken.append((to, (priority, tenant, item)))
+                gone = len(flow) - len(kept)
+                if not gone:
+                    continue
+                cls.size -= gone
+                self._size -= gone
+                self._waiting[tenant] -= gone
+                if not self._waiting[tenant]:
+                    del self._waiting[tenant]
+                if kept:
+                    cls.flows[tenant] = kept
+                else:
+                    # no longer backlogged, its stale tags are dropped when they surface
+                    del cls.flows[tenant]
+                    cls.tenants.active.discard(tenant)
+            if not cls.size:
+                self._fair.active.discard(priority)
+        return taken
+
+    @staticmethod
+    def _percentile(samples, p):
+        return samples[min(int(len(samples) * p / 100.), len(samples) - 1)] if samples else None
+
+    def wait_stats(self):
+        """
+        @return: {priority: dict(waiting, served, weight, p50, p95, p99, max)}, wait times in seconds of the last
+        window items got from the class, plus the current age of its oldest item
+        """
+        with self.mutex:
+            now = time.time()
+            stats = {}
+            for priority, cls in self._classes.items():
+                waits = sorted(cls.waits)
+                heads = [flow[0][1] for flow in cls.flows.values()]
+                stats[priority] = dict(waiting=cls.size, served=cls.served, weight=cls.weight,
+                                       p50=self._percentile(waits, 50), p95=self._percentile(waits, 95),
+                                       p99=self._percentile(waits, 99), max=waits[-1] if waits else None,
+                                       oldest=now - min(heads) if heads else None)
+            return stats
+
+
+class RoutedQueue(BatchQueueMixin, Queue):
+    """
+    Job queue with a sub-queue per worker host, for tasks whose data already lives on a host. Same
+    put(item, priority) signature as TasksPriorityQueue, plus a route for the batch:
+      - host: the items go to that host sub-queue (args in its shared memory, see tasks.Task.route)
+      - key: routing key (dataset, ticker...), the items of a key go to the host the key is bound to, where the
+        previous ones left their local caches warm. A key is bound at its first put to the live host with the
+        smallest backlog, and bound again once that host stopped getting items for host_ttl seconds
+      - neither: shared sub-queue, served to any host
+    A getter passes its host (get_many/lease_many host=): it gets the best items, by priority then FIFO, of its
+    sub-queue and the shared one, and steals from the largest backlog of key routed items of the other hosts once
+    both are empty. Items put for a host are pinned to it, never stolen: their args may live in its shared memory.
+    Getters without a host get the shared items first. O(log n) per item plus O(hosts) per steal or key binding.
+    routing_stats() counts the local, shared and stolen gets
+    """
+
+    def __init__(self, maxsize=0, host_ttl=60., max_keys=100000):
+        """
+        @param host_ttl: seconds without a get after which a host is taken for gone and its keys bound again
+        @param max_keys: key bindings kept, the oldest are forgotten past it
+        """
+        self.host_ttl = host_ttl
+        self.max_keys = max_keys
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = None
+        self._size = 0
+        self._seq = 0
+        self._hosts = {None: []}  # host -> heap of (priority, seq, host, key, item), None for the shared items
+        self._pinned = {}  # host -> heap of the items put for that host, served to it only
+        self._pinned_size = 0
+        self._seen = {}  # host -> time of its last get
+        self._getters = {}  # host -> get calls in progress, waiting hosts are live
+        self._homes = {}  # key -> host
+        self._bound = deque()  # keys by binding time
+        self.local = self.shared = self.stolen = 0
+
+    def _qsize(self, len=len):
+        return self._size
+
+    def put(self, item, priority, host=None, key=None, eta=None, countdown=None):
+        self.put_many([item], priority, host, key, eta, countdown)
+
+    def put_many(self, items, priority=None, host=None, key=None, eta=None, countdown=None):
+        """
+        @param host: host the batch runs on
+        @param key: routing key of the batch, ignored when host is given
+        """
+        return BatchQueueMixin.put_many(self, [(host, key, item) for item in items], priority, eta, countdown)
+
+    def requeue_many(self, items, priority=None, host=None, key=None):
+        return BatchQueueMixin.requeue_many(self, [(host, key, item) for item in items], priority)
+
+    def import_moved(self, items, priority=None, host=None, key=None):
+        return BatchQueueMixin.import_moved(self, [(host, key, item) for item in items], priority)
+
+    def put_routed(self, batches, priority=None, eta=None, countdown=None):
+        """
+        Batches of different routes in one call
+        @param batches: list of (host, key, items)
+        """
+        return BatchQueueMixin.put_many(self, [(host, key, item) for host, key, items in batches for item in items],
+                                        priority, eta, countdown)
+
+    def put_graph(self, nodes, priority=None, host=None, key=None):
+        return BatchQueueMixin.put_graph(self, [(task_id, (host, key, item), waits) for task_id, item, waits in nodes],
+                                         priority)
+
+    def add_periodic(self, name, item, priority=None, cron=None, every=None, host=None, key=None):
+        return BatchQueueMixin.add_periodic(self, name, (host, key, item), priority, cron, every)
+
+    def get(self, block=True, timeout=None, host=None):
+        return self.get_many(1, timeout if block else 0, host)[0]
+
+    def _arrive(self, host, delta):
+        if host is not None:
+            with self.mutex:
+                self._getters[host] = self._getters.get(host, 0) + delta
+                self._seen[host] = time.time()
+
+    def get_many(self, max_items, timeout=None, host=None):
+        self._arrive(host, 1)
+        try:
+            return BatchQueueMixin.get_many(self, max_items, timeout, host)
+        finally:
+            self._arrive(host, -1)
+
+    def lease_many(self, max_items, timeout=None, visibility=30., max_attempts=5, host=None):
+        self._arrive(host, 1)
+        try:
+            return BatchQueueMixin.lease_many(self, max_items, timeout, visibility, max_attempts, host)
+        finally:
+            self._arrive(host, -1)
+
+    def _live(self, host, now):
+        return self._getters.get(host) or now - self._seen.get(host, 0.) <= self.host_ttl
+
+    def _home(self, key):
+        """
+        @return: host the key is bound to, None while no host ever got items
+        """
+        host, now = self._homes.get(key), time.time()
+        if host is not None and self._live(host, now):
+            return host
+        live = [h for h in self._seen if self._live(h, now)]
+        if not live:
+            # every host quiet for host_ttl: keep the binding, the host finds its keys when it comes back
+            if host is not None or not self._seen:
+                return host
+            live = list(self._seen)
+        if key not in self._homes:
+            self._bound.append(key)
+            if len(self._bound) > self.max_keys:
+                self._homes.pop(self._bound.popleft(), None)
+        host = self._homes[key] = min(live, key=self._backlog)
+        return host
+
+    def _backlog(self, host):
+        return len(self._hosts.get(host, ())) + len(self._pinned.get(host, ()))
+
+    def _available(self, host):
+        return self._size - self._pinned_size + len(self._pinned.get(host, ()))
+
+    def _wrap(self, item, priority):
+        host, key, item = item
+        return priority or 0, host, key, item
+
+    def _put(self, entry):
+        priority, host, key, item = entry
+        if host is not None:
+            heaps, target = self._pinned, host
+            self._pinned_size += 1
+            # only the getters of host may take it: wake them all, not the first waiters of any host
+            self.not_empty.notify_all()
+        else:
+            heaps, target = self._hosts, None if key is None else self._home(key)
+        heap = heaps.get(target)
+        if heap is None:
+            heap = heaps[target] = []
+        heappush(heap, (priority, self._seq, host, key, item))
+        self._seq += 1
+        self._size += 1
+
+    def _get(self):
+        getter, shared = self._getter, self._hosts[None]
+        own = [h for h in (self._pinned.get(getter), self._hosts.get(getter)) if h] if getter is not None else []
+        heap = min(own + [shared] if shared else own, key=lambda h: h[0]) if own or shared else None
+        if heap is None:
+            # the key routed items of the busiest host
+            heap = max([h for h in self._hosts.values() if h], key=len)
+            self.stolen += 1
+        elif heap is shared:
+            self.shared += 1
+        else:
+            self.local += 1
+        priority, _, host, key, item = heappop(heap)
+        self._size -= 1
+        if host is not None:
+            self._pinned_size -= 1
+        return priority, host, key, item
+
+    def _unwrap(self, entry):
+        return entry[3]
+
+    def _requeue(self, entry, item):
+        return entry[:3] + (item,)
+
+    def _priority(self, entry):
+        return entry[0]
+
+    def _route(self, entry):
+        return dict(host=entry[1], key=entry[2])
+
+    def _take_moved(self, owner, partition):
+        """
+        Straight from the heaps, pinned ones included, without counting gets nor binding keys again
+        """
+        taken = []
+        for heaps in (self._hosts, self._pinned):
+            for target, heap in list(heaps.items()):
+                kept = []
+                for priority, seq, host, key, item in heap:
+                    to = owner((priority, host, key, item))
+                    if to == partition:
+                        kept.append((priority, seq, host, key, item))
+                    else:
+                        taken.append((seq, to, (priority, host, key, item)))
+                if len(kept) < len(heap):
+                    heapify(kept)
+                    heaps[target] = kept
+        self._size -= len(taken)
+        self._pinned_size -= sum(1 for _, _, entry in taken if entry[1] is not None)
+        # in put order
+        return [(to, entry) for _, to, entry in sorted(taken, key=lambda t: t[0])]
+
+    def routing_stats(self):
+        """
+        @return: dict(local, shared, stolen gets, keys bound, shared items waiting, hosts: {host: dict(waiting,
+        pinned, getters, live, keys)})
+        """
+        with self.mutex:
+            now = time.time()
+            keys = {}
+            for host in self._homes.values():
+                keys[host] = keys.get(host, 0) + 1
+            hosts = set(self._seen) | set(h for h in self._hosts if h is not None) | set(self._pinned)
+            return dict(local=self.local, shared=self.shared, stolen=self.stolen, keys=len(self._homes),
+                        waiting=len(self._hosts[None]),
+                        hosts={h: dict(waiting=self._backlog(h), pinned=len(self._pinned.get(h, ())),
+                                       getters=self._getters.get(h, 0), live=bool(self._live(h, now)),
+                                       keys=keys.get(h, 0)) for h in hosts})
+
+
 queues_setup = {
     'priority': TasksPriorityQueue,
+    'fair': FairQueue,
+    'routed': RoutedQueue,
     'simple': SimpleQueue,
     'indexable': IndexableQueue,
+    'persistent': PersistentPriorityQueue,
+    'persistent_fifo': PersistentQueue,
 }
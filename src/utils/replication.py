@@ -0,0 +1,571 @@
+from collections import OrderedDict, deque
+from itertools import islice
+from multiprocessing import Process
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+
+from src.logging.dsys_logger_client import get_logger
+from src.utils.cluster import Delivery, member_name
+from src.utils.managers import QueueManager, ClientManager, HostUtils
+from src.utils.queues import PersistentPriorityQueue
+from src.utils.segment_log import SegmentLog, PUT, SYNC_GROUP
+from src.utils.serializers import get_codec
+
+log = get_logger(__name__)
+
+__doc__ = """
+Replicated job queue: a group of job server processes, every one with its own segment log directory. The leader
+serves the job queue (ReplicatedQueue, a PersistentPriorityQueue) and streams the PUT and ACK records of its log
+to the followers, which append them to their own log (Follower). When the leader goes down a follower takes over:
+it rebuilds the queue from its log, the un-acked items come back as after a crash. See Replica for the
+election, FailoverClientManager for the clients.
+
+    jobs = FailoverClientManager([('localhost', 8506), ('localhost', 8507)], authkey).get_tasks_queue()
+
+With sync replication a put returns once every follower in sync wrote the records of the put to its log, a
+failover loses none of the puts returned. Async puts return as soon as the leader wrote them: the followers trail
+behind and a failover loses the puts they did not fetch yet.
+Delivery is at least once: the items in flight at the failover are delivered again by the new leader. Scheduled
+(eta) items, blocked graph tasks and periodic schedules live in the leader memory only.
+"""
+
+SNAPSHOT = 'snapshot'
+RECORDS = 'records'
+ACK_MANY = 3  # a record acking a list of seqs
+
+
+def replica_addresses(conf):
+    """
+    @param conf: jobs_queue configuration, the replicas (default 2) of its replication listen on consecutive ports
+    from port
+    @return: list of (host, port)
+    """
+    return [(conf['address'], conf['port'] + n) for n in range(conf['replication'].get('replicas', 2))]
+
+
+def forget(queue):
+    """
+    Drop the proxy of a dead server: its decref on garbage collection would retry connecting to it for 20s
+    """
+    close = getattr(queue, '_close', None)
+    if close is not None:
+        close.cancel()
+
+
+class ReplicatedLog(SegmentLog):
+    """
+    SegmentLog numbering its PUT and ACK records (lsn) in an in-memory backlog the followers fetch from. A follower
+    fetching from lsn acks every record up to lsn, records acked by every follower leave the backlog
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.term = 0
+        self.lag_timeout = 1.
+        self.backlog = 100000
+        self.lsn = 0
+        self.followers = {}  # follower -> [last lsn acked, time of its last fetch]
+        self._stream = deque()  # (lsn, kind, seq or seqs, priority, payload)
+        self._replication = threading.Condition(threading.Lock())
+        SegmentLog.__init__(self, *args, **kwargs)
+
+    def _ship(self, kind, seq, priority, payload):
+        self.lsn += 1
+        self._stream.append((self.lsn, kind, seq, priority, payload))
+        if len(self._stream) > self.backlog:
+            self._stream.popleft()  # the followers that far behind start over from a snapshot
+        self._replication.notify_all()
+
+    def put(self, seq, priority, payload):
+        with self._replication:
+            SegmentLog.put(self, seq, priority, payload)
+            self._ship(PUT, seq, priority, payload)
+
+    def ack_many(self, seqs):
+        seqs = list(seqs)
+        with self._replication:
+            SegmentLog.ack_many(self, seqs)
+            self._ship(ACK_MANY, seqs, 0., b'')
+
+    def _in_sync(self, now):
+        return [acked for acked, fetched in self.followers.values() if now - fetched < self.lag_timeout]
+
+    def _first(self):
+        return self._stream[0][0] if self._stream else self.lsn + 1
+
+    def fetch(self, follower, term, lsn, max_records=1000, timeout=0.5):
+        """
+        Long poll of a follower, acking every record up to lsn
+        @param term: term of the leader the follower got its records from
+        @param lsn: last record the follower has
+        @return: (RECORDS, term, lsn, [(lsn, kind, seq or seqs, priority, payload)]) following lsn, empty after
+        timeout. (SNAPSHOT, term, lsn, [(seq, priority, payload)]) of the live PUTs instead when the follower has the
+        records of another leader or fell out of the backlog
+        """
+        deadline = time.time() + timeout
+        with self._replication:
+            now = time.time()
+            self.followers[follower] = [lsn, now]
+            self._replication.notify_all()
+            acked = min(self._in_sync(now))
+            while self._stream and self._stream[0][0] <= acked:
+                self._stream.popleft()
+
+            while term == self.term and lsn == self.lsn:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return RECORDS, self.term, lsn, []
+                self._replication.wait(remaining)
+            if term != self.term or not self._first() - 1 <= lsn <= self.lsn:
+                return SNAPSHOT, self.term, self.lsn, [(seq, priority, self.read(seq)) for seq, priority in self.live()]
+            start = lsn + 1 - self._first()
+            return RECORDS, self.term, lsn, list(islice(self._stream, start, start + max_records))
+
+    def wait_replicated(self):
+        """
+        Block until every follower in sync acked the records written so far. A follower stays in sync while it
+        fetches at least every lag_timeout: a follower down holds the puts back lag_timeout at most
+        """
+        with self._replication:
+            lsn = self.lsn
+            while True:
+                now = time.time()
+                behind = [fetched + self.lag_timeout - now for acked, fetched in self.followers.values()
+                          if acked < lsn and now - fetched < self.lag_timeout]
+                if not behind:
+                    return
+                self._replication.wait(min(behind))
+
+    def replication_stats(self):
+        with self._replication:
+            now = time.time()
+            return dict(term=self.term, lsn=self.lsn, backlog=len(self._stream),
+                        followers={name: dict(lag=self.lsn - acked, seen=now - fetched, in_sync=now - fetched <
+                                              self.lag_timeout)
+                                   for name, (acked, fetched) in self.followers.items()})
+
+
+class ReplicatedQueue(PersistentPriorityQueue):
+    """
+    PersistentPriorityQueue of the leader of a replica group, its log streamed to the followers
+    """
+
+    log_type = ReplicatedLog
+
+    def __init__(self, path, term=1, sync_replicas=True, lag_timeout=1., backlog=100000, **kwargs):
+        """
+        @param term: election term of the leader, higher than every term before
+        @param sync_replicas: puts return once the followers in sync have them, else as soon as the leader has them
+        @param lag_timeout: seconds a follower not fetching stays in sync
+        @param backlog: records kept for the followers behind
+        """
+        PersistentPriorityQueue.__init__(self, path, **kwargs)
+        self.sync_replicas = sync_replicas
+        self._log.term, self._log.lag_timeout, self._log.backlog = term, lag_timeout, backlog
+
+    def put(self, item, priority, block=True, timeout=None, eta=None, countdown=None):
+        PersistentPriorityQueue.put(self, item, priority, block, timeout, eta, countdown)
+        if self.sync_replicas:
+            self._log.wait_replicated()
+
+    def _put_now(self, items, priority, admit=True):
+        count = PersistentPriorityQueue._put_now(self, items, priority, admit)
+        if self.sync_replicas:
+            self._log.wait_replicated()
+        return count
+
+    def replicate(self, follower, term, lsn, max_records=1000, timeout=0.5):
+        """
+        See ReplicatedLog.fetch
+        """
+        return self._log.fetch(follower, term, lsn, max_records, timeout)
+
+    def replication_stats(self):
+        """
+        @return: dict(term, lsn (last record), backlog, followers: {name: dict(lag in records, seen seconds ago,
+        in_sync)}, sync)
+        """
+        return dict(self._log.replication_stats(), sync=self.sync_replicas)
+
+
+class Follower(object):
+    """
+    Copy of the leader log kept by a replica: fetches the records following its last one and appends them to its
+    own log, the fetch after acks them
+    """
+
+    def __init__(self, name, path, sync=SYNC_GROUP, max_records=1000):
+        self.name = name
+        self.path = path
+        self.sync = sync
+        self.max_records = max_records
+        self.term, self.lsn = 0, 0
+        self.snapshots = 0
+        self.log = SegmentLog(path, sync=sync)
+
+    def _restart(self, term, lsn, live):
+        self.log.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.log = SegmentLog(self.path, sync=self.sync)
+        for seq, priority, payload in live:
+            self.log.put(seq, priority, payload)
+        self.term, self.lsn = term, lsn
+        self.snapshots += 1
+        log.info("{} restarted from a snapshot of term {}: {} live records".format(self.name, term, len(live)))
+
+    def pull(self, queue, timeout=0.5):
+        """
+        One fetch from the leader queue (proxy), the records are durable in the follower log on return
+        @return: records applied
+        """
+        kind, term, lsn, records = queue.replicate(self.name, self.term, self.lsn, self.max_records, timeout)
+        if kind == SNAPSHOT:
+            self._restart(term, lsn, records)
+        else:
+            for _, kind, seq, priority, payload in records:
+                if kind == PUT:
+                    self.log.put(seq, priority, payload)
+                else:
+                    self.log.ack_many(seq)
+            if records:
+                self.lsn = records[-1][0]
+        self.log.wait_durable()
+        return len(records)
+
+    def close(self):
+        self.log.close()
+
+
+class FailoverQueue(object):
+    """
+    Job queue of the leader of a replica group, same interface as a job queue proxy. A call failing on a connection
+    error goes to the replica leading after it. The items got from a previous leader are not reported done to
+    the new one, it delivers them again: the gets return a Delivery whose sources are the leader terms
+    """
+
+    def __init__(self, connect, replicas, failover_timeout=30.):
+        """
+        @param connect: address -> job queue proxy of the replica at address, connection error unless it leads
+        @param replicas: (host, port) of the replicas
+        @param failover_timeout: seconds waited for a leader before the calls fail
+        """
+        self._connect = connect
+        self.replicas = [tuple(r) for r in replicas]
+        self.failover_timeout = failover_timeout
+        self._lock = threading.RLock()
+        self._queue, self.term, self.leader = None, None, None
+        self.failovers = 0
+        self._undone = OrderedDict()  # leader term -> items got and not reported done yet
+
+    def _lead(self):
+        """
+        @return: (job queue, term) of the leader, connected to it first if needed
+        """
+        with self._lock:
+            deadline = time.time() + self.failover_timeout
+            while self._queue is None:
+                for address in self.replicas:
+                    try:
+                        queue = self._connect(address)
+                        term = queue.replication_stats()['term']
+                    except (EOFError, IOError):
+                        continue
+                    if self.term is not None and term != self.term:
+                        self.failovers += 1
+                        log.warning("Job server failover to {}, term {}".format(address, term))
+                    self._queue, self.term, self.leader = queue, term, address
+                    break
+                else:
+                    if time.time() > deadline:
+                        raise IOError("No leader among the replicas {} after {}s".format(self.replicas,
+                                                                                        self.failover_timeout))
+                    time.sleep(0.05)
+            return self._queue, self.term
+
+    def _down(self, queue, error):
+        with self._lock:
+            if self._queue is queue:
+                log.warning("Job server leader {} unreachable: {!r}".format(self.leader, error))
+                forget(queue)
+                self._queue = None
+
+    def _call(self, method, *args, **kwargs):
+        """
+        @return: (term of the leader which answered, result)
+        """
+        while True:
+            queue, term = self._lead()
+            try:
+                return term, getattr(queue, method)(*args, **kwargs)
+            except (EOFError, IOError) as e:
+                self._down(queue, e)
+
+    def _report(self, term, method, *args):
+        """
+        method(*args) to the leader of term only, the other leaders do not know the items
+        """
+        while True:
+            queue, current = self._lead()
+            if current != term:
+                return 0
+            try:
+                return getattr(queue, method)(*args)
+            except (EOFError, IOError) as e:
+                self._down(queue, e)
+
+    def put_many(self, items, priority=None, eta=None, countdown=None, **route):
+        return self._call('put_many', list(items), priority, eta=eta, countdown=countdown, **route)[1]
+
+    def put(self, item, *args, **kwargs):
+        return self._call('put', item, *args, **kwargs)[1]
+
+    def put_graph(self, nodes, priority=None):
+        return self._call('put_graph', list(nodes), priority)[1]
+
+    def get_many(self, max_items, timeout=None, host=None):
+        route = {} if host is None else dict(host=host)
+        term, items = self._call('get_many', max_items, timeout, **route)
+        with self._lock:
+            self._undone[term] = self._undone.pop(term, 0) + len(items)
+        return Delivery(items, [term] * len(items))
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, timeout if block else 0)[0]
+
+    def lease_many(self, max_items, timeout=None, visibility=30., max_attempts=5, host=None):
+        """
+        @return: list of ((term, lease id), item, attempt)
+        """
+        route = {} if host is None else dict(host=host)
+        term, leased = self._call('lease_many', max_items, timeout, visibility, max_attempts, **route)
+        return [((term, lease), item, attempt) for lease, item, attempt in leased]
+
+    def _take_undone(self, count, sources):
+        """
+        Items got no longer undone: the ones of sources, else count of them from the leader terms got from first
+        @return: OrderedDict leader term -> items
+        """
+        counts = OrderedDict()
+        with self._lock:
+            if sources is not None:
+                for term in sources:
+                    counts[term] = counts.get(term, 0) + 1
+            elif count > sum(self._undone.values()):
+                raise ValueError('task_done() called too many times')
+            else:
+                for term, undone in self._undone.items():
+                    if not count:
+                        break
+                    counts[term] = min(count, undone)
+                    count -= counts[term]
+            if any(n > self._undone.get(term, 0) for term, n in counts.items()):
+                raise ValueError('task_done() called too many times')
+            for term, n in counts.items():
+                self._undone[term] -= n
+                if not self._undone[term]:
+                    del self._undone[term]
+        return counts
+
+    def task_done_many(self, count, done_ids=(), sources=None):
+        """
+        @param sources: Delivery.sources of the items done, by default the first items got are taken for them
+        """
+        for term, n in self._take_undone(count, sources).items():
+            self._report(term, 'task_done_many', n, done_ids)
+
+    def requeue_many(self, items, priority=None, sources=None):
+        """
+        Items got given back to the leader they came from, a later leader delivers them again anyway
+        """
+        items = list(items)
+        counts = self._take_undone(len(items), sources)
+        terms = sources if sources is not None else [term for term, n in counts.items() for _ in range(n)]
+        batches = OrderedDict()
+        for term, item in zip(terms, items):
+            batches.setdefault(term, []).append(item)
+        return sum(self._report(term, 'requeue_many', batch, priority) for term, batch in batches.items())
+
+    def task_done(self):
+        self.task_done_many(1)
+
+    def task_failed_many(self, task_ids):
+        return self._call('task_failed_many', list(task_ids))[1]
+
+    def _by_term(self, method, lease_ids, *args):
+        groups = {}
+        for term, lease in lease_ids:
+            groups.setdefault(term, []).append(lease)
+        return sum(self._report(term, method, leases, *args) for term, leases in groups.items())
+
+    def ack_many(self, lease_ids, done_ids=()):
+        return self._by_term('ack_many', lease_ids, done_ids)
+
+    def nack_many(self, lease_ids, delay=None, spend=True):
+        return self._by_term('nack_many', lease_ids, delay, spend)
+
+    def extend_many(self, lease_ids):
+        return self._by_term('extend_many', lease_ids)
+
+    def add_periodic(self, name, item, priority=None, cron=None, every=None):
+        return self._call('add_periodic', name, item, priority, cron, every)[1]
+
+    def remove_periodic(self, name):
+        return self._call('remove_periodic', name)[1]
+
+    def periodic(self):
+        return self._call('periodic')[1]
+
+    def dead_letters(self, max_items=None, pop=True):
+        return self._call('dead_letters', max_items, pop)[1]
+
+    def flow_control(self, high_water=None, low_water=None, overflow='block', timeout=None):
+        return self._call('flow_control', high_water, low_water, overflow, timeout)[1]
+
+    def qsize(self):
+        return self._call('qsize')[1]
+
+    def stats(self):
+        return self._call('stats')[1]
+
+    def replication_stats(self):
+        return self._call('replication_stats')[1]
+
+    def __repr__(self):
+        return "< FailoverQueue -- leader {} term {} failovers {} >".format(self.leader, self.term, self.failovers)
+
+
+class FailoverClientManager(object):
+    """
+    Client of a replicated job server: its queue follows the leader of the replicas, through a fresh ClientManager
+    of the new leader after a failover
+    """
+
+    def __init__(self, addresses, authkey, codec=None, pool_size=None, failover_timeout=30.):
+        self.codec = get_codec(codec)
+        self.authkey = authkey
+        self.pool_size = pool_size
+        self.failover_timeout = failover_timeout
+        self.addresses = [tuple(address) for address in addresses]
+
+    def _queue(self, address):
+        if not HostUtils.listening(address):
+            raise IOError("Job server replica {} not listening".format(member_name(address)))
+        return ClientManager(address=address, authkey=self.authkey, queues=['tasks_queue'], codec=self.codec,
+                             pool_size=self.pool_size).get_tasks_queue()
+
+    def get_tasks_queue(self):
+        return FailoverQueue(self._queue, self.addresses, self.failover_timeout)
+
+    def __repr__(self):
+        return "< Replicated job server client > -- replicas {}".format(self.addresses)
+
+
+class Replica(object):
+    """
+    One job server process of a replica group. The replicas share a directory holding the group
+    lock, the leader file and a log directory per replica. The replica holding the lock (flock, released by the
+    kernel when its process dies) leads: it rebuilds the queue from its log and serves it on its own port. The
+    others follow the leader named in the leader file until they get the lock
+    """
+
+    LOCK_FILE = 'leader.lock'
+    LEADER_FILE = 'leader.json'
+
+    def __init__(self, replicas, index, authkey, root, sync_replicas=True, lag_timeout=1., sync=SYNC_GROUP,
+                 flow_control=None):
+        """
+        @param replicas: (host, port) of every replica of the group
+        @param index: of this replica in replicas
+        @param sync_replicas, lag_timeout: see ReplicatedQueue
+        @param sync: segment log sync mode of every replica
+        @param flow_control: flow_control() keyword arguments of the queue once leading, None leaves it unbounded
+        """
+        self.replicas = [tuple(r) for r in replicas]
+        self.address = self.replicas[index]
+        self.authkey = authkey
+        self.root = root
+        self.path = os.path.join(root, 'replica-{}'.format(index))
+        self.sync_replicas = sync_replicas
+        self.lag_timeout = lag_timeout
+        self.sync = sync
+        self.flow_control = flow_control
+        self.elected = threading.Event()
+
+    def _elect(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        self.elected.set()
+
+    def _leader(self):
+        try:
+            with open(os.path.join(self.root, self.LEADER_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def follow(self):
+        """
+        Copy the log of the leader until elected
+        """
+        follower = Follower(member_name(self.address), self.path, sync=self.sync)
+        queue = None
+        while not self.elected.is_set():
+            try:
+                if queue is None:
+                    leader = self._leader()
+                    if (leader is None or tuple(leader['address']) == self.address or
+                            not HostUtils.listening(tuple(leader['address']))):
+                        time.sleep(0.05)
+                        continue
+                    queue = ClientManager(address=tuple(leader['address']), authkey=self.authkey,
+                                          queues=['tasks_queue']).get_tasks_queue()
+                follower.pull(queue, self.lag_timeout / 2)
+            except (EOFError, IOError):
+                forget(queue)
+                queue = None
+                time.sleep(0.05)
+        follower.close()
+
+    def lead(self):
+        """
+        Serve the queue of the log copied so far, forever
+        """
+        leader = self._leader()
+        term = (leader['term'] if leader else 0) + 1
+        queue = ReplicatedQueue(self.path, term=term, sync_replicas=self.sync_replicas, lag_timeout=self.lag_timeout,
+                                sync=self.sync)
+        if self.flow_control:
+            queue.flow_control(**self.flow_control)
+        server = QueueManager(address=self.address[0], port=self.address[1], authkey=self.authkey,
+                              queues={'tasks_queue': queue}).get_server()
+        path = os.path.join(self.root, self.LEADER_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(address=self.address, term=term), f)
+        os.rename(path + '.tmp', path)
+        log.info("Replica {} leads, term {}, {} items".format(member_name(self.address), term, queue.qsize()))
+        server.serve_forever()
+
+    def run(self):
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass  # made by another replica
+        lock = open(os.path.join(self.root, self.LOCK_FILE), 'a')
+        elector = threading.Thread(target=self._elect, args=(lock,))
+        elector.daemon = True
+        elector.start()
+        self.follow()
+        self.lead()
+
+
+def start_replicas(replicas, authkey, root, **options):
+    """
+    Start a process per replica of a job server replica group, see Replica
+    @return: list of replica processes
+    """
+    processes = [Process(target=Replica(replicas, n, authkey, root, **options).run) for n in range(len(replicas))]
+    for p in processes:
+        p.start()
+    return processes
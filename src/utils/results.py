@@ -0,0 +1,506 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from heapq import heappush, heappop
+from itertools import count
+from multiprocessing.managers import MakeProxyType
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__doc__ = """
+Results store served by SharedResultsManager.
+Results live in the manager server process itself (no nested Manager().dict()), and a deployment can
+run several shards: ShardedResults routes every key to its shard by crc32, so writes from the workers
+spread over independent server processes and locks.
+The store also holds the results of the memoized tasks (see memo), under "memo:" keys.
+"""
+
+CACHE_HIT = 'hit'
+CACHE_RUN = 'run'
+CACHE_WAIT = 'wait'
+
+
+class ResultsStore(object):
+    """
+    Dict-like results container living in the results server process.
+    Entries can expire (store-wide ttl or per-entry ttl on set/set_many), the store is bounded to max_bytes
+    by evicting the least recently used entries, and with pop_on_read every read also removes the entry.
+    Memoized results go through claim/fill/release: one caller computes a missing entry while the others
+    wait for it, cached entries are never popped by reads.
+    """
+
+    def __init__(self, ttl=None, max_bytes=None, pop_on_read=False):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.pop_on_read = pop_on_read
+        self._lock = threading.Lock()
+        self._waiters = {}          # key -> conditions of the clients blocked on it
+        self._data = OrderedDict()  # key -> (value, expires_at, size), least recently used first
+        self._expiry = []           # heap of (expires_at, key), stale items skipped lazily
+        self._claims = {}           # memo key -> time its claim lapses
+        self._deadlines = []        # heap of [deadline, seq, condition] of the timed waits, None once over
+        self._deadline_ids = count()
+        self._clock_wake = None     # condition of the thread enforcing the deadlines, created with it
+        self._bytes = 0
+        self._counters = dict(hits=0, misses=0, popped=0, evicted_ttl=0, evicted_lru=0,
+                              cache_hits=0, cache_misses=0, cache_coalesced=0, cache_saved=0.)
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, (bytes, type(u''))):
+            return len(value)
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _remove(self, key):
+        value, _, size = self._data.pop(key)
+        self._bytes -= size
+        return value
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heappop(self._expiry)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] == expires_at:
+                self._remove(key)
+                self._counters['evicted_ttl'] += 1
+
+    def _set(self, key, value, ttl, now):
+        if key in self._data:
+            self._remove(key)
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl else None
+        size = self._sizeof(value)
+        self._data[key] = (value, expires_at, size)
+        self._bytes += size
+        if expires_at is not None:
+            heappush(self._expiry, (expires_at, key))
+        for cond in self._waiters.get(key, ()):
+            cond.notify()
+
+    def _evict(self):
+        while self.max_bytes and self._bytes > self.max_bytes and self._data:
+            self._remove(next(iter(self._data)))
+            self._counters['evicted_lru'] += 1
+
+    def _read(self, key, now, pop=False, count_miss=True):
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            if count_miss:
+                self._counters['misses'] += 1
+            raise KeyError(key)
+
+        self._counters['hits'] += 1
+        if pop or self.pop_on_read:
+            self._counters['popped'] += 1
+            return self._remove(key)
+        # refresh LRU position
+        del self._data[key]
+        self._data[key] = entry
+        return entry[0]
+
+    def _cached(self, key, now):
+        """
+        @return: (value, cost) of a memoized result, None if missing or expired
+        """
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            return None
+        del self._data[key]
+        self._data[key] = entry
+        return entry[0]
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._read(key, time.time())
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._data)
+
+    def set(self, key, value, ttl=None):
+        """
+        @param ttl: seconds to live for this entry, defaults to the store ttl
+        """
+        self.set_many({key: value}, ttl)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                return self._read(key, time.time())
+            except KeyError:
+                return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            try:
+                return self._read(key, time.time(), pop=True)
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+
+    def keys(self):
+        with self._lock:
+            self._expire(time.time())
+            return list(self._data.keys())
+
+    def values(self):
+        with self._lock:
+            self._expire(time.time())
+            return [v[0] for v in self._data.values()]
+
+    def items(self):
+        with self._lock:
+            self._expire(time.time())
+            return [(k, v[0]) for k, v in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expiry = []
+            self._bytes = 0
+
+    def get_many(self, ids, pop=False):
+        """
+        @param ids: keys to look up
+        @param pop: remove the entries found
+        @return: dict with the keys found
+        """
+        found = {}
+        with self._lock:
+            now = time.time()
+            for k in ids:
+                try:
+                    found[k] = self._read(k, now, pop)
+                except KeyError:
+                    pass
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            for k, v in mapping.items():
+                self._set(k, v, ttl, now)
+            self._evict()
+
+    def update(self, mapping):
+        self.set_many(mapping)
+
+    def _collect(self, ids, pop):
+        found, now = {}, time.time()
+        for k in ids:
+            try:
+                found[k] = self._read(k, now, pop, count_miss=False)
+            except KeyError:
+                pass
+        return found
+
+    def _wait(self, ids, timeout, pop):
+        """
+        Block on a condition registered under every id until one of them is written.
+        The deadline is enforced by the clock thread notifying the condition, an untimed wait wakes up as soon
+        as the writer notifies instead of polling
+        """
+        with self._lock:
+            found = self._collect(ids, pop)
+            if found or timeout == 0:
+                return found
+
+            cond = threading.Condition(self._lock)
+            for k in ids:
+                self._waiters.setdefault(k, []).append(cond)
+
+            alarm = None
+            if timeout is not None:
+                endtime = time.time() + timeout
+                alarm = self._notify_at(endtime, cond)
+            try:
+                while not found:
+                    if timeout is not None and time.time() >= endtime:
+                        break
+                    cond.wait()
+                    found = self._collect(ids, pop)
+                return found
+            finally:
+                if alarm is not None:
+                    alarm[2] = None
+                for k in ids:
+                    waiters = self._waiters.get(k)
+                    if waiters is not None:
+                        waiters.remove(cond)
+                        if not waiters:
+                            del self._waiters[k]
+
+    def _notify_at(self, when, cond):
+        """
+        Under the lock: notify cond at time when, from the one thread timing every wait of the store
+        @return: the heap entry, its condition set to None cancels it
+        """
+        if self._clock_wake is None:
+            self._clock_wake = threading.Condition(self._lock)
+            clock = threading.Thread(target=self._run_clock, name='ResultsStore-clock')
+            clock.daemon = True
+            clock.start()
+        alarm = [when, next(self._deadline_ids), cond]
+        heappush(self._deadlines, alarm)
+        if self._deadlines[0] is alarm:
+            self._clock_wake.notify()  # earlier than what the clock waits for
+        return alarm
+
+    def _run_clock(self):
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][2] is None):
+                    cond = heappop(self._deadlines)[2]
+                    if cond is not None:
+                        cond.notify()
+                self._clock_wake.wait(self._deadlines[0][0] - now if self._deadlines else None)
+
+    def wait_result(self, task_id, timeout=None, pop=False):
+        """
+        Block until the result of task_id is written
+        @param timeout: seconds, None waits forever
+        @param pop: remove the result once read
+        @return: the result, KeyError if it did not land in time
+        """
+        found = self._wait([task_id], timeout, pop)
+        if task_id not in found:
+            raise KeyError(task_id)
+        return found[task_id]
+
+    def wait_any(self, ids, timeout=None, pop=False):
+        """
+        Block until at least one of ids has a result
+        @return: dict with every result of ids available at wake up, empty on timeout
+        """
+        return self._wait(list(ids), timeout, pop)
+
+    def claim(self, key, hold=60., wait=None, waited=False):
+        """
+        Look a memoized result up, or claim the right to compute it. While another caller holds the claim,
+        block until it fills the entry, releases the claim or lets it lapse
+        @param hold: seconds the claim is held for the caller before another one may take over
+        @param wait: seconds to block at most, None until the claim lapses
+        @param waited: the caller already waited for this key (CACHE_WAIT), for the cache_coalesced counter
+        @return: (CACHE_HIT, value), (CACHE_RUN, None) and the caller then owes a fill or a release,
+        (CACHE_WAIT, None) when still computed elsewhere after wait seconds
+        """
+        with self._lock:
+            cond = alarm = None
+            endtime = None if wait is None else time.time() + wait
+            try:
+                while True:
+                    now = time.time()
+                    cached = self._cached(key, now)
+                    if cached is not None:
+                        self._counters['cache_hits'] += 1
+                        self._counters['cache_coalesced'] += waited or cond is not None
+                        self._counters['cache_saved'] += cached[1]
+                        return CACHE_HIT, cached[0]
+
+                    lapses = self._claims.get(key)
+                    if lapses is None or lapses <= now:
+                        self._claims[key] = now + hold
+                        self._counters['cache_misses'] += 1
+                        return CACHE_RUN, None
+                    if endtime is not None and endtime <= now:
+                        return CACHE_WAIT, None
+
+                    if cond is None:
+                        cond = threading.Condition(self._lock)
+                        self._waiters.setdefault(key, []).append(cond)
+                    if alarm is not None:
+                        alarm[2] = None
+                    # the claim lapsing and the wait deadline are enforced by the clock thread, as in _wait
+                    alarm = self._notify_at(min(lapses, endtime or lapses), cond)
+                    cond.wait()
+            finally:
+                if alarm is not None:
+                    alarm[2] = None
+                if cond is not None:
+                    waiters = self._waiters[key]
+                    waiters.remove(cond)
+                    if not waiters:
+                        del self._waiters[key]
+
+    def fill(self, key, value, cost=0., ttl=None):
+        """
+        Store a claimed memoized result and wake up the callers waiting for it
+        @param cost: seconds it took to compute, credited to cache_saved on every hit
+        @param ttl: seconds to live, defaults to the store ttl
+        """
+        with self._lock:
+            now = time.time()
+            self._claims.pop(key, None)
+            self._expire(now)
+            self._set(key, (value, cost), ttl, now)
+            self._evict()
+
+    def release(self, key):
+        """
+        Give a claim up without a result (the task failed): the next waiter computes it
+        """
+        with self._lock:
+            self._claims.pop(key, None)
+            for cond in self._waiters.get(key, ()):
+                cond.notify()
+
+    def stats(self):
+        """
+        Sizing counters: entries, bytes, max_bytes, hits, misses, popped, evicted_ttl, evicted_lru.
+        Memoized tasks: cache_hits, cache_misses (computed), cache_coalesced (hits that waited for a computation
+        in flight), cache_saved (seconds of computation the hits saved)
+        """
+        with self._lock:
+            self._expire(time.time())
+            stats = dict(self._counters, entries=len(self._data), bytes=self._bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+ResultsProxy = MakeProxyType('ResultsProxy', (
+    '__contains__', '__delitem__', '__getitem__', '__len__', '__setitem__',
+    'claim', 'clear', 'fill', 'get', 'get_many', 'items', 'keys', 'pop', 'release', 'set', 'set_many', 'stats',
+    'update', 'values', 'wait_any', 'wait_result'
+))
+
+
+def shard_of(key, shards):
+    return zlib.crc32(str(key)) % shards
+
+
+class ShardedResults(object):
+    """
+    Client side view over the results shards, same interface as a single ResultsProxy
+    """
+
+    wait_slice = 0.1
+
+    def __init__(self, shards):
+        self.shards = list(shards)
+
+    def _shard(self, key):
+        return self.shards[shard_of(key, len(self.shards))]
+
+    def _split(self, keys):
+        groups = {}
+        for k in keys:
+            groups.setdefault(shard_of(k, len(self.shards)), []).append(k)
+        return groups
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards)
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def pop(self, key, *default):
+        return self._shard(key).pop(key, *default)
+
+    def keys(self):
+        return [k for s in self.shards for k in s.keys()]
+
+    def values(self):
+        return [v for s in self.shards for v in s.values()]
+
+    def items(self):
+        return [i for s in self.shards for i in s.items()]
+
+    def clear(self):
+        for s in self.shards:
+            s.clear()
+
+    def set(self, key, value, ttl=None):
+        self._shard(key).set(key, value, ttl)
+
+    def claim(self, key, hold=60., wait=None, waited=False):
+        return self._shard(key).claim(key, hold, wait, waited)
+
+    def fill(self, key, value, cost=0., ttl=None):
+        self._shard(key).fill(key, value, cost, ttl)
+
+    def release(self, key):
+        self._shard(key).release(key)
+
+    def get_many(self, ids, pop=False):
+        found = {}
+        for shard, keys in self._split(ids).items():
+            found.update(self.shards[shard].get_many(keys, pop))
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        for shard, keys in self._split(mapping).items():
+            self.shards[shard].set_many({k: mapping[k] for k in keys}, ttl)
+
+    def wait_result(self, task_id, timeout=None, pop=False):
+        return self._shard(task_id).wait_result(task_id, timeout, pop)
+
+    def wait_any(self, ids, timeout=None, pop=False):
+        """
+        A single shard blocks server side. Across shards, the shard holding most of ids blocks for at most
+        wait_slice seconds at a time and the others are polled with get_many between the slices: one round-trip
+        in flight, whatever the number of shards. Nothing is popped until a winner is known
+        """
+        ids = list(ids)
+        groups = self._split(ids)
+        if len(groups) == 1:
+            shard, keys = groups.popitem()
+            return self.shards[shard].wait_any(keys, timeout, pop)
+
+        endtime = None if timeout is None else time.time() + timeout
+        blocking = max(groups, key=lambda shard: len(groups[shard]))
+        others = [k for shard, keys in groups.items() if shard != blocking for k in keys]
+        found = self.get_many(ids)
+        while not found:
+            remaining = self.wait_slice if endtime is None else min(self.wait_slice, endtime - time.time())
+            if remaining <= 0:
+                return {}
+            found = self.shards[blocking].wait_any(groups[blocking], remaining) or self.get_many(others)
+
+        return self.get_many(found.keys(), pop=True) if pop else found
+
+    def stats(self):
+        """
+        Counters summed over the shards
+        """
+        total = {}
+        for s in self.shards:
+            for k, v in s.stats().items():
+                total[k] = v if total.get(k) is None else total[k] + (v or 0)
+        return total
+
+    def update(self, mapping):
+        self.set_many(mapping)
+
+    def __repr__(self):
+        return "< ShardedResults -- shards: {}>".format(len(self.shards))
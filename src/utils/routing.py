@@ -0,0 +1,25 @@
+from collections import OrderedDict
+
+__doc__ = """
+Locality aware submission on a queues.RoutedQueue: every task goes to the sub-queue of the host its data lives on.
+
+    tasks = [Task(new_id(), fetch_prices, [ticker], routing_key=ticker) for ticker in tickers]
+    put_tasks(jobs, tasks, priority=1, codec='pickle')
+
+Task.route gives the host (the affinity, else the host of the shared memory holding the args) and the routing key.
+The workers pass their host to get_many/lease_many (Worker host=): they run the tasks of their host first and
+steal the others only once their host and the shared sub-queues are empty.
+"""
+
+
+def put_tasks(queue, tasks, priority=None, codec=None, eta=None, countdown=None):
+    """
+    @param queue: RoutedQueue (proxy) or PartitionedQueue of them, all the routes go in one put_routed call
+    @param codec: codec name or instance the tasks are encoded with, None puts the Task objects
+    @return: number of tasks put
+    """
+    batches = OrderedDict()
+    for t in tasks:
+        batches.setdefault(t.route, []).append(t)
+    return queue.put_routed([(host, key, [t.encode(codec) if codec is not None else t for t in batch])
+                             for (host, key), batch in batches.items()], priority, eta, countdown)
@@ -1,23 +1,115 @@
 from __future__ import print_function, unicode_literals
+import errno
+import hmac
+import itertools
+import logging
 import multiprocessing
-from multiprocessing.connection import Listener, Client
-from Queue import Empty, Full
-from threading import Thread, active_count
-
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from thread import allocate_lock
+from multiprocessing.connection import Client, CHALLENGE, WELCOME, FAILURE, MESSAGE_LENGTH
+from Queue import Queue, Empty, Full
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from src.utils.pool import get_pool
 from src.utils.queues import PersistentQueue
 
 
+__doc__ = """
+RPC over the multiprocessing.connection wire format (4 bytes length prefix + pickle, hmac handshake), so
+plain multiprocessing Clients and RPCProxy talk to RPCServer unchanged.
+RPCServer runs a single threaded epoll (poll where missing) loop: a client costs a socket and a small
+_ClientConnection, not an OS thread. Registered functions run on the loop and must not block, the ones
+registered with blocking=True (put_job: a persistent queue put waits for its fsync) run on a few handler
+threads instead, their replies handed back to the loop through a pipe.
+Requests carry an id, so RPCProxy and AsyncRPCProxy keep many calls in flight on one connection and
+batch() ships many calls in one frame. PooledRPCProxy shares a connection pool between threads.
+"""
+
+log = logging.getLogger(__name__)
+
+
 class ShutDown(Exception):
     pass
 
 
+class RPCTimeout(Exception):
+    pass
+
+
+FRAME = struct.Struct(str('!i'))
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# connection states, the handshake mirrors Listener.accept: deliver_challenge then answer_challenge
+AUTH_DIGEST, AUTH_CHALLENGE, AUTH_WELCOME, READY = range(4)
+
+
+def _poller():
+    """
+    @return: (poller, scale of the poll timeout for seconds)
+    """
+    if hasattr(select, 'epoll'):
+        return select.epoll(), 1.
+    return select.poll(), 1000.
+
+
+class _ClientConnection(object):
+    """
+    Event loop state of a client: handshake step, partial input frame and pending output
+    """
+    __slots__ = ('sock', 'fd', 'state', 'challenge', 'inbuf', 'outbuf', 'out_offset', 'events', 'closing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.state = READY
+        self.challenge = None
+        self.inbuf = bytearray()
+        self.outbuf = deque()
+        self.out_offset = 0
+        self.events = select.POLLIN
+        self.closing = False
+
+
 class RPCServer(multiprocessing.Process):
-    def __init__(self, address, authkey):
+    backlog = 1024
+    recv_size = 64 * 1024
+
+    def __init__(self, address, authkey, handler_threads=4):
+        """
+        @param handler_threads: threads running the blocking functions, started on the first blocking call
+        """
         multiprocessing.Process.__init__(self)
         self._functions = {}
-        self.active_threads_num = 0
+        self._blocking = set()  # names of the functions run off the loop
+        self._clients = {}
+        self._poller = None
+        self.handler_threads = handler_threads
+        self._requests = None  # (client, request) for the handler threads
+        self._replies = deque()  # (client, reply) of the handler threads, sent by the loop
+        self._wake_r = self._wake_w = None
         self.stay_alive = True
-        self._server_c = Listener(address, authkey=authkey)
+        self.authkey = authkey
+        self._server_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_s.bind(address)
+        self._server_s.listen(self.backlog)
+        self._server_s.setblocking(False)
+        self.address = self._server_s.getsockname()
+
+    @property
+    def active_clients(self):
+        return len(self._clients)
 
     def register_queues(self, queues):
         """
@@ -28,9 +120,14 @@ class RPCServer(multiprocessing.Process):
         for q_name, queue in queues.items():
                 setattr(self, q_name, queue)
 
-    def register_class_function(self, func):
+    def register_class_function(self, func, blocking=False):
+        """
+        @param blocking: func may block (I/O, locks held by other clients...), it runs on a handler thread
+        """
         self.add_method(func)
         self._functions[func.__name__] = getattr(self, func.__name__)
+        if blocking:
+            self._blocking.add(func.__name__)
 
     def add_method(self, method, name=None):
 
@@ -43,51 +140,491 @@ class RPCServer(multiprocessing.Process):
         setattr(new, name, method)
         self.__class__ = new
 
-    def register_function(self, func):
+    def register_function(self, func, blocking=False):
         self._functions[func.__name__] = func
-
-    def serve_forever(self):
-
+        if blocking:
+            self._blocking.add(func.__name__)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._poller, scale = _poller()
+        listener_fd = self._server_s.fileno()
+        self._poller.register(listener_fd, select.POLLIN)
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller.register(self._wake_r, select.POLLIN)
+        try:
+            while self.stay_alive:
+                try:
+                    events = self._poller.poll(poll_interval * scale)
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for fd, event in events:
+                    if fd == listener_fd:
+                        self._accept()
+                        continue
+                    if fd == self._wake_r:
+                        self._send_replies()
+                        continue
+                    client = self._clients.get(fd)
+                    if client is None:
+                        continue
+                    if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                        self._read(client)
+                    if event & select.POLLOUT and fd in self._clients:
+                        self._flush(client)
+        finally:
+            for client in list(self._clients.values()):
+                self._close(client)
+            self._server_s.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+
+    def _accept(self):
         while True:
-            client_c = self._server_c.accept()
-            t = Thread(target=self.handle_client, args=(client_c,))
-            t.daemon = True
-            t.start()
-
-            self.active_threads_num = active_count()
+            try:
+                sock, _ = self._server_s.accept()
+            except socket.error as e:
+                if e.args[0] not in RETRY_ERRNOS + (errno.ECONNABORTED,):
+                    log.error("RPC server unable to accept clients -- {}".format(e))
+                return
+
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _ClientConnection(sock)
+            self._clients[client.fd] = client
+            self._poller.register(client.fd, client.events)
+            if self.authkey:
+                client.state = AUTH_DIGEST
+                client.challenge = os.urandom(MESSAGE_LENGTH)
+                self._send_frame(client, CHALLENGE + client.challenge)
+                self._flush(client)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(self.recv_size)
+        except socket.error as e:
+            if e.args[0] in RETRY_ERRNOS:
+                return
+            data = b''
+        if not data:
+            self._close(client)
+            return
+
+        inbuf = client.inbuf
+        inbuf += data
+        offset = 0
+        while not client.closing and len(inbuf) - offset >= FRAME.size:
+            end = offset + FRAME.size + FRAME.unpack_from(inbuf, offset)[0]
+            if len(inbuf) < end:
+                break
+            self._on_frame(client, bytes(inbuf[offset + FRAME.size:end]))
+            offset = end
+        if offset:
+            del inbuf[:offset]
+        self._flush(client)
+
+    def _on_frame(self, client, frame):
+        if client.state == READY:
+            self._dispatch(client, frame)
+        elif client.state == AUTH_DIGEST:
+            if frame == hmac.new(self.authkey, client.challenge).digest():
+                self._send_frame(client, WELCOME)
+                client.state = AUTH_CHALLENGE
+            else:
+                self._send_frame(client, FAILURE)
+                client.closing = True
+        elif client.state == AUTH_CHALLENGE and frame.startswith(CHALLENGE):
+            self._send_frame(client, hmac.new(self.authkey, frame[len(CHALLENGE):]).digest())
+            client.state = AUTH_WELCOME
+        elif client.state == AUTH_WELCOME and frame == WELCOME:
+            client.state = READY
+        else:
+            client.closing = True
 
-    def handle_client(self, client_c):
+    def _dispatch(self, client, frame):
+        """
+        Requests are (func_name, args, kwargs), answered with the bare result, (req_id, func_name, args, kwargs)
+        answered with (req_id, result), or a list of the latter answered with the list of replies in one frame.
+        A request calling a blocking function goes to the handler threads, a batch as a whole
+        """
+        try:
+            request = pickle.loads(frame)
+        except Exception as e:
+            self._send(client, e)
+            return
+        if self._blocking and self._blocking.intersection(self._names(request)):
+            self._start_handlers()
+            self._requests.put((client, request))
+            return
+        self._send(client, self._answer(request))
+
+    @staticmethod
+    def _names(request):
+        if isinstance(request, list):
+            return [r[1] for r in request]
+        return [request[1] if len(request) == 4 else request[0]]
+
+    def _answer(self, request):
+        try:
+            if isinstance(request, list):
+                return [(r[0], self._call(*r[1:])) for r in request]
+            elif len(request) == 4:
+                return request[0], self._call(*request[1:])
+            return self._call(*request)
+        except Exception as e:
+            return e
+
+    def _start_handlers(self):
+        if self._requests is not None:
+            return
+        self._requests = Queue()
+        for n in range(self.handler_threads):
+            handler = threading.Thread(target=self._handle_forever, name='RPCServer-handler-{}'.format(n))
+            handler.daemon = True
+            handler.start()
+
+    def _handle_forever(self):
         while True:
+            client, request = self._requests.get()
+            self._replies.append((client, self._answer(request)))
+            os.write(self._wake_w, b'x')
 
-            func_name, args, kwargs = client_c.recv()
-            try:
-                r = self._functions[func_name](*args,**kwargs)
-                client_c.send(r)
-            except Exception as e:
-                client_c.send(e)
+    def _send_replies(self):
+        """
+        On the loop: send what the handler threads answered, to the clients still connected
+        """
+        os.read(self._wake_r, 4096)
+        while self._replies:
+            client, reply = self._replies.popleft()
+            if self._clients.get(client.fd) is client:
+                self._send(client, reply)
+                self._flush(client)
+
+    def _call(self, func_name, args, kwargs):
+        try:
+            return self._functions[func_name](*args, **kwargs)
+        except ShutDown as e:
+            self.stay_alive = False
+            return e
+        except Exception as e:
+            return e
+
+    def _send(self, client, obj):
+        try:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = pickle.dumps(pickle.PicklingError(str(e)), pickle.HIGHEST_PROTOCOL)
+        self._send_frame(client, data)
+
+    def _send_frame(self, client, data):
+        client.outbuf.append(FRAME.pack(len(data)) + data)
+
+    def _flush(self, client):
+        out = client.outbuf
+        try:
+            while out:
+                client.out_offset += client.sock.send(memoryview(out[0])[client.out_offset:])
+                if client.out_offset < len(out[0]):
+                    break
+                out.popleft()
+                client.out_offset = 0
+        except socket.error as e:
+            if e.args[0] not in RETRY_ERRNOS:
+                self._close(client)
+                return
+
+        if not out and client.closing:
+            self._close(client)
+            return
+        events = select.POLLIN | select.POLLOUT if out else select.POLLIN
+        if events != client.events:
+            self._poller.modify(client.fd, events)
+            client.events = events
+
+    def _close(self, client):
+        if self._clients.pop(client.fd, None) is None:
+            return
+        try:
+            self._poller.unregister(client.fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        client.sock.close()
 
     def run(self):
         self.serve_forever()
 
     def __repr__(self):
-        return "< RPC server > -- serving at {}".format(self._server_c.address)
+        return "< RPC server > -- serving at {}".format(self.address)
+
+
+class RPCFuture(object):
+    """
+    Result of an in-flight call, resolved by the proxy that issued it.
+    A bare lock held until the reply lands: threading.Event costs a Condition and two locks per call
+    """
+    __slots__ = ('_lock', '_result', '_exception', '_proxy')
+
+    def __init__(self, proxy):
+        self._lock = allocate_lock()
+        self._lock.acquire()
+        self._result = None
+        self._exception = None
+        self._proxy = proxy
+
+    def set_result(self, result):
+        if isinstance(result, Exception):
+            self._exception = result
+        else:
+            self._result = result
+        self._lock.release()
+
+    def done(self):
+        if self._lock.acquire(False):
+            self._lock.release()
+            return True
+        return False
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self._proxy._resolve(self, timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """
+        @param timeout: seconds, None waits forever
+        @return: the call result, raises the exception returned by the server or RPCTimeout
+        """
+        if not self.done():
+            self._proxy._resolve(self, timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _wait(self, timeout):
+        if timeout is None:
+            self._lock.acquire()
+            self._lock.release()
+            return
+
+        # same backoff as a timed Condition.wait
+        endtime, delay = time.time() + timeout, 0.0005
+        while not self.done():
+            remaining = endtime - time.time()
+            if remaining <= 0:
+                raise RPCTimeout("RPC call still pending after {}s".format(timeout))
+            time.sleep(min(delay, remaining, .05))
+            delay *= 2
 
 
 class RPCProxy(object):
+    """
+    Attribute calls are synchronous. call_async returns an RPCFuture instead, so any number of calls can be
+    outstanding on the connection; replies are matched by request id while a result is waited for.
+    Not thread safe, share an AsyncRPCProxy between threads
+    """
+
     def __init__(self, address, authkey):
         self._conn = Client(address, authkey=authkey)
+        self._ids = itertools.count()
+        self._pending = {}
+        self._batch = None
+
+    def call_async(self, name, *args, **kwargs):
+        req_id = next(self._ids)
+        future = self._pending[req_id] = RPCFuture(self)
+        request = (req_id, name, args, kwargs)
+        if self._batch is not None:
+            self._batch.append(request)
+        else:
+            self._conn.send(request)
+        return future
+
+    def call(self, name, *args, **kwargs):
+        if self._pending or self._batch is not None:
+            return self.call_async(name, *args, **kwargs).result()
+
+        # nothing else in flight: the next reply is ours
+        self._conn.send((next(self._ids), name, args, kwargs))
+        _, result = self._conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def do_rpc(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return do_rpc
+
+    @contextmanager
+    def batch(self):
+        """
+        Buffer the calls made in the block and write them as a single frame on exit, answered by a single frame
+            with proxy.batch():
+                futures = [proxy.call_async('put_job', n, 'jobs') for n in range(100)]
+        Waiting on a result inside the block flushes the calls buffered so far
+        """
+        if not self._begin_batch():
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            self._flush_batch(end=True)
+
+    def _begin_batch(self):
+        """
+        @return: True if the batch starts with this call, False within a batch already
+        """
+        if self._batch is not None:
+            return False
+        self._batch = []
+        return True
+
+    def _flush_batch(self, end=False):
+        """
+        Send the buffered calls. end closes the batch in the same step, a call made meanwhile is either in the
+        frame or sent on its own
+        """
+        requests = self._batch
+        if requests is not None:
+            self._batch = None if end else []
+        if requests:
+            self._conn.send(requests)
+
+    def _set_results(self, reply):
+        for req_id, result in reply if isinstance(reply, list) else [reply]:
+            self._pending.pop(req_id).set_result(result)
+
+    def _resolve(self, future, timeout):
+        """
+        Read replies until future is set
+        """
+        self._flush_batch()
+        endtime = None if timeout is None else time.time() + timeout
+        while not future.done():
+            if endtime is not None and not self._conn.poll(max(endtime - time.time(), 0)):
+                raise RPCTimeout("RPC call still pending after {}s".format(timeout))
+            self._set_results(self._conn.recv())
+
+    def close(self):
+        self._conn.close()
+
+    def __repr__(self):
+        return "< RPC client > -- {} calls in flight".format(len(self._pending))
+
+
+class AsyncRPCProxy(RPCProxy):
+    """
+    Thread safe pipelining client: attribute calls return an RPCFuture (call() waits for it) and a reader
+    thread sets the replies as they arrive, so no caller has to drive the connection.
+    batch() buffers the calls of every thread
+    """
+
+    def __init__(self, address, authkey):
+        super(AsyncRPCProxy, self).__init__(address, authkey)
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_forever)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def call_async(self, name, *args, **kwargs):
+        with self._send_lock:
+            if self._closed:
+                raise EOFError("Connection to the RPC server closed")
+            return super(AsyncRPCProxy, self).call_async(name, *args, **kwargs)
+
+    def call(self, name, *args, **kwargs):
+        return self.call_async(name, *args, **kwargs).result()
 
     def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
         def do_rpc(*args, **kwargs):
-            self._conn.send((name, args, kwargs))
-            result = self._conn.recv()
-            if isinstance(result, Exception):
-                raise result
-            return result
+            return self.call_async(name, *args, **kwargs)
         return do_rpc
 
+    def _begin_batch(self):
+        with self._send_lock:
+            return super(AsyncRPCProxy, self)._begin_batch()
+
+    def _flush_batch(self, end=False):
+        with self._send_lock:
+            super(AsyncRPCProxy, self)._flush_batch(end)
+
+    def _resolve(self, future, timeout):
+        self._flush_batch()
+        future._wait(timeout)
+
+    def _read_forever(self):
+        try:
+            while True:
+                reply = self._conn.recv()
+                with self._send_lock:
+                    self._set_results(reply)
+        except (EOFError, IOError, OSError):
+            pass  # server gone or close(): the calls in flight fail below
+        with self._send_lock:
+            self._closed = True
+            for future in self._pending.values():
+                future.set_result(EOFError("Connection to the RPC server lost"))
+            self._pending.clear()
+
+    def close(self):
+        """
+        Shut the socket down so the reader leaves its recv() and ends, then close the connection
+        """
+        with self._send_lock:
+            self._closed = True
+        try:
+            socket.fromfd(self._conn.fileno(), socket.AF_INET, socket.SOCK_STREAM).shutdown(socket.SHUT_RDWR)
+        except (socket.error, IOError, OSError):
+            pass  # closed by the server already
+        self._reader.join()
+        self._conn.close()
+
     def __repr__(self):
-        return "< RPC client > -- connected"
+        return "< Async RPC client > -- {} calls in flight".format(len(self._pending))
+
+
+class PooledRPCProxy(object):
+    """
+    Thread safe synchronous client: every call checks a connection out of the pool of its server, so
+    concurrent callers neither serialise on one socket nor connect each. Pipelining and batch() stay on
+    RPCProxy / AsyncRPCProxy, which own their connection
+    """
+
+    def __init__(self, address, authkey, pool_size=None, **pool_options):
+        self.address = address
+        self.pool = get_pool(('rpc', address, authkey), lambda: Client(address, authkey=authkey),
+                             size=pool_size, **pool_options)
+
+    def call(self, name, *args, **kwargs):
+        _, result = self.pool.request((0, name, args, kwargs))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def do_rpc(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return do_rpc
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def __repr__(self):
+        return "< Pooled RPC client > -- {}".format(self.pool)
 
 
 def add(x, y):
@@ -122,7 +659,7 @@ def put_job(cls, value, q_name):
 
 
 def get_active_clients(cls):
-    return cls.active_threads
+    return cls.active_clients
 
 
 def shutdown(cls):
@@ -156,6 +693,7 @@ class Task(object):
 
 
 register_functions = [get_job, put_job, get_active_clients, shutdown, task_done]
+blocking_functions = [put_job]
 
 
 def get_server(address='localhost', port=9999, authkey='mykey', queues={}):
@@ -163,14 +701,19 @@ def get_server(address='localhost', port=9999, authkey='mykey', queues={}):
     server = RPCServer((address, int(port)), authkey=str(authkey))
 
     for func in register_functions:
-        server.register_class_function(func)
+        server.register_class_function(func, blocking=func in blocking_functions)
 
     server.register_queues(queues)
 
     return server
 
 
-def get_client(address='localhost', port=9999, authkey='mykey'):
+def get_client(address='localhost', port=9999, authkey='mykey', pool_size=None):
+    """
+    @param pool_size: return a thread safe PooledRPCProxy sharing up to pool_size connections
+    """
+    if pool_size:
+        return PooledRPCProxy((address, int(port)), authkey=str(authkey), pool_size=pool_size)
     return RPCProxy((address, int(port)), authkey=str(authkey))
 
 
@@ -0,0 +1,106 @@
+import calendar
+import time
+from datetime import datetime, timedelta
+
+__doc__ = """
+Delivery times of the delayed and periodic tasks held by the job queues (see queues.BatchQueueMixin).
+Times are unix timestamps of the queue server clock, cron expressions are read in its local time.
+"""
+
+
+def due_time(eta=None, countdown=None):
+    """
+    @param eta: unix timestamp or datetime (naive means local time)
+    @param countdown: seconds from now, ignored when eta is given
+    @return: unix timestamp, None if neither is given
+    """
+    if eta is not None:
+        if isinstance(eta, datetime):
+            if eta.tzinfo is not None:
+                return calendar.timegm(eta.utctimetuple()) + eta.microsecond / 1e6
+            return time.mktime(eta.timetuple()) + eta.microsecond / 1e6
+        return float(eta)
+    if countdown is not None:
+        return time.time() + countdown
+    return None
+
+
+class Interval(object):
+    """
+    Every `seconds`, measured from the previous due time so that the period does not drift
+    """
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("Interval must be positive, got {}".format(seconds))
+        self.seconds = float(seconds)
+
+    def next(self, after):
+        return after + self.seconds
+
+    def __repr__(self):
+        return "< Interval {}s >".format(self.seconds)
+
+
+class Cron(object):
+    """
+    Five fields cron expression: minute hour day-of-month month day-of-week (0 or 7 = Sunday).
+    Fields take *, a, a-b, lists a,b and steps */n or a-b/n. As in cron, when both day fields are
+    restricted a day matching either of them fires
+    """
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression needs 5 fields, got {!r}".format(expr))
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        self.weekdays = set(d % 7 for d in weekdays)
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            spec, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = [int(v) for v in spec.split('-', 1)]
+            else:
+                start = int(spec)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("Invalid cron field {!r}, range {}-{}".format(field, low, high))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        day, weekday = t.day in self.days, (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        """
+        @return: first matching minute strictly after the `after` timestamp
+        """
+        t = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(100000):
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return time.mktime(t.timetuple())
+        raise ValueError("Cron expression {!r} never fires".format(self.expr))
+
+    def __repr__(self):
+        return "< Cron {} >".format(self.expr)
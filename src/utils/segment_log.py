@@ -0,0 +1,313 @@
+import os
+import mmap
+import struct
+import threading
+import time
+import zlib
+import logging
+
+log = logging.getLogger(__name__)
+
+__doc__ = """
+Append-only segment log used by the persistent queues.
+Every record is a fixed header followed by the payload:
+    type (B) | seq (Q) | priority (d) | payload length (I) | payload crc32 (I)
+PUT records carry a pickled item, ACK records only the seq of the acked PUT.
+Segments are rolled at segment_bytes, sealed segments are read through mmap and dropped once every
+PUT they hold is acked.
+"""
+
+PUT = 1
+ACK = 2
+
+HEADER = struct.Struct('>BQdII')
+SEGMENT_SUFFIX = '.seg'
+
+SYNC_GROUP = 'group'        # put blocks until its record is fsynced, concurrent writers share one fsync
+SYNC_INTERVAL = 'interval'  # fsync every sync_interval in background, put never blocks
+SYNC_OFF = 'off'            # leave it to the OS
+
+
+class SegmentLog(object):
+
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024, sync=SYNC_GROUP, sync_interval=0.005,
+                 compact_ratio=0.25):
+        assert sync in (SYNC_GROUP, SYNC_INTERVAL, SYNC_OFF), "Unknown sync mode {}".format(sync)
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Condition(self._lock)
+        self._durable_cond = threading.Condition(self._lock)
+        self._written = 0
+        self._durable = 0
+
+        self._locations = {}  # live seq -> (segment, payload offset, length, priority)
+        self._live = {}       # segment -> live PUTs
+        self._total = {}      # segment -> PUTs ever written
+        self._mmaps = {}
+        self._writer = None
+        self._reader = None
+        self._active = None
+        self._pid = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.next_seq = 1
+        self._replay()
+
+    # -- recovery
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%016d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _segments(self):
+        return sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.path) if f.endswith(SEGMENT_SUFFIX))
+
+    def _replay(self):
+        segments = self._segments()
+        for segment in segments:
+            self._live.setdefault(segment, 0)
+            self._total.setdefault(segment, 0)
+            good = self._scan(segment)
+            if good is not None:
+                if segment != segments[-1]:
+                    log.warning("Segment {} is corrupted after offset {}".format(segment, good))
+                else:
+                    log.warning("Truncating torn tail of segment {} at offset {}".format(segment, good))
+                    with open(self._segment_path(segment), 'r+b') as f:
+                        f.truncate(good)
+
+        self._active = segments[-1] if segments else 0
+        self._live.setdefault(self._active, 0)
+        self._total.setdefault(self._active, 0)
+        log.info("Replayed {} live records from {} segments in {}".format(len(self._locations), len(segments),
+                                                                          self.path))
+
+    def _scan(self, segment):
+        """
+        @return: None if the whole segment is valid, else the offset of the first bad record
+        """
+        with open(self._segment_path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                if offset + HEADER.size > size:
+                    return offset
+                kind, seq, priority, length, crc = HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                if start + length > size or zlib.crc32(data[start:start + length]) & 0xffffffff != crc:
+                    return offset
+
+                if kind == PUT:
+                    self._discard(seq)
+                    self._locations[seq] = (segment, start, length, priority)
+                    self._live[segment] += 1
+                    self._total[segment] += 1
+                elif kind == ACK:
+                    self._discard(seq)
+                self.next_seq = max(self.next_seq, seq + 1)
+                offset = start + length
+            return None
+        finally:
+            data.close()
+
+    def _discard(self, seq):
+        loc = self._locations.pop(seq, None)
+        if loc is not None:
+            self._live[loc[0]] -= 1
+
+    def live(self):
+        """
+        @return: [(seq, priority)] of the un-acked records, in seq order
+        """
+        return sorted((seq, loc[3]) for seq, loc in self._locations.items())
+
+    # -- writes
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        # first write in this process (the queue is built before the server forks)
+        self._pid = os.getpid()
+        self._mmaps = {}
+        self._writer = open(self._segment_path(self._active), 'ab')
+        self._reader = open(self._segment_path(self._active), 'rb')
+        if self.sync != SYNC_OFF:
+            flusher = threading.Thread(target=self._flush_forever)
+            flusher.daemon = True
+            flusher.start()
+
+    def _append(self, kind, seq, priority, payload):
+        if self._writer.tell() >= self.segment_bytes:
+            self._roll()
+        offset = self._writer.tell() + HEADER.size
+        self._writer.write(HEADER.pack(kind, seq, priority, len(payload), zlib.crc32(payload) & 0xffffffff))
+        self._writer.write(payload)
+        self._written += 1
+        return offset
+
+    def _put_record(self, seq, priority, payload):
+        offset = self._append(PUT, seq, priority, payload)
+        self._locations[seq] = (self._active, offset, len(payload), priority)
+        self._live[self._active] += 1
+        self._total[self._active] += 1
+
+    def put(self, seq, priority, payload):
+        with self._lock:
+            self._ensure_open()
+            self._put_record(seq, priority, payload)
+            self.next_seq = max(self.next_seq, seq + 1)
+
+    def ack_many(self, seqs):
+        with self._lock:
+            self._ensure_open()
+            for seq in seqs:
+                if seq in self._locations:
+                    self._append(ACK, seq, 0., b'')
+                    self._discard(seq)
+            self._drop_acked_segments()
+
+    def _roll(self):
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._reader.close()
+        self._durable = self._written
+        self._durable_cond.notify_all()
+
+        self._active += 1
+        self._live[self._active] = 0
+        self._total[self._active] = 0
+        self._writer = open(self._segment_path(self._active), 'ab')
+        self._reader = open(self._segment_path(self._active), 'rb')
+
+    # -- reads
+
+    def read(self, seq):
+        with self._lock:
+            self._ensure_open()
+            segment, offset, length, _ = self._locations[seq]
+            if segment == self._active:
+                self._writer.flush()
+                self._reader.seek(offset)
+                return self._reader.read(length)
+
+            data = self._mmaps.get(segment)
+            if data is None:
+                with open(self._segment_path(segment), 'rb') as f:
+                    data = self._mmaps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return data[offset:offset + length]
+
+    # -- durability
+
+    def wait_durable(self):
+        if self.sync != SYNC_GROUP:
+            return
+        with self._lock:
+            target = self._written
+            while self._durable < target:
+                self._flush_needed.notify()
+                self._durable_cond.wait()
+
+    def _flush_forever(self):
+        while True:
+            with self._lock:
+                if self._writer is None:
+                    return  # closed
+                if self._durable >= self._written:
+                    self._flush_needed.wait(self.sync_interval)
+                if self._writer is None:
+                    return
+                if self._durable >= self._written:
+                    continue
+                self._writer.flush()
+                target, fd = self._written, self._writer.fileno()
+
+            try:
+                os.fsync(fd)  # outside the lock, writers keep appending into the next group
+            except OSError:
+                pass  # segment rolled meanwhile, _roll already synced it
+
+            with self._lock:
+                if self._writer is None:
+                    return  # closed meanwhile, close() synced everything
+                self._durable = max(self._durable, target)
+                self._durable_cond.notify_all()
+                self._compact()
+
+    # -- compaction
+
+    def _drop_acked_segments(self):
+        """
+        Drop leading sealed segments without live PUTs. Dropping strictly in order keeps replay correct:
+        an ACK always lives in the same segment as its PUT or in a later one
+        """
+        for segment in sorted(self._live):
+            if segment == self._active or self._live[segment] > 0:
+                break
+            data = self._mmaps.pop(segment, None)
+            if data is not None:
+                data.close()
+            del self._live[segment], self._total[segment]
+            try:
+                os.remove(self._segment_path(segment))
+            except OSError as e:
+                log.error("Unable to remove segment {}: {}".format(segment, e))
+
+    def _compact(self):
+        """
+        Rewrite the few live records of the oldest sealed segment at the head of the log so the segment
+        can be dropped instead of pinning the whole log on disk
+        """
+        oldest = min(self._live)
+        if oldest == self._active or not self._total[oldest]:
+            return
+        if float(self._live[oldest]) / self._total[oldest] > self.compact_ratio:
+            return
+
+        moved = [(seq, loc) for seq, loc in self._locations.items() if loc[0] == oldest]
+        for seq, (segment, offset, length, priority) in sorted(moved):
+            data = self._mmaps.get(segment)
+            if data is None:
+                with open(self._segment_path(segment), 'rb') as f:
+                    data = self._mmaps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            payload = data[offset:offset + length]
+            self._live[oldest] -= 1
+            self._put_record(seq, priority, payload)
+
+        # the rewritten records must be durable before their old copies disappear
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._durable = self._written
+        self._durable_cond.notify_all()
+        self._drop_acked_segments()
+        log.info("Compacted segment {}: moved {} live records".format(oldest, len(moved)))
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None and self._pid == os.getpid():
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._reader.close()
+                self._writer = None
+                self._pid = None
+                # synced: wake the waiters, and the flusher so that it exits
+                self._durable = self._written
+                self._durable_cond.notify_all()
+                self._flush_needed.notify()
+            for data in self._mmaps.values():
+                data.close()
+            self._mmaps = {}
+
+    def __repr__(self):
+        return "< SegmentLog {} -- live={} segments={} >".format(self.path, len(self._locations), len(self._live))
@@ -0,0 +1,93 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__doc__ = """
+Codecs for task payloads and results, selected per queue with the "codec" key of queuesconfig.json.
+pickle carries whole Task objects, json and msgpack carry Task.as_dict and resolve the function by its
+registered name on the worker side.
+"""
+
+
+class Codec(object):
+    name = None
+
+    def dumps(self, obj):
+        raise NotImplementedError("This method must be implemented")
+
+    def loads(self, data):
+        raise NotImplementedError("This method must be implemented")
+
+    def __repr__(self):
+        return "< Codec {} >".format(self.name)
+
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    protocol = pickle.HIGHEST_PROTOCOL
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack codec requires the msgpack package")
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs_setup = {
+    'pickle': PickleCodec,
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+_instances = {}
+
+
+def get_codec(codec=None, default='pickle'):
+    """
+    @param codec: codec name, a Codec instance or None for the default
+    @return: Codec instance
+    """
+    if isinstance(codec, Codec):
+        return codec
+    name = codec or default
+    if name not in _instances:
+        try:
+            _instances[name] = codecs_setup[name]()
+        except KeyError:
+            raise ValueError("Unknown codec {}, available: {}".format(name, ', '.join(sorted(codecs_setup))))
+    return _instances[name]
@@ -0,0 +1,262 @@
+import os
+import mmap
+import fcntl
+import socket
+import struct
+import tempfile
+import time
+import uuid
+import logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+__doc__ = """
+Same-host transport for large task arguments and results.
+A payload above the threshold is written once into a file under /dev/shm and only a small SharedPayload
+handle travels through the queues and the results store. NumPy arrays are mapped back without copying,
+other objects are pickled. Each segment carries a reference count in its header and is unlinked when the
+last holder releases it.
+"""
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'dsys-'
+HEADER_SIZE = 64  # refcount + padding, keeps array data 64 bytes aligned
+REFS = struct.Struct('>q')
+DEFAULT_THRESHOLD = 1024 * 1024
+MAX_AGE = 3600.  # seconds before cleanup() unlinks a segment nobody released
+
+NDARRAY = 'ndarray'
+PICKLE = 'pickle'
+
+
+def payload_size(obj):
+    """
+    Cheap size estimate of the objects worth sharing, None for everything else (never pickled to find out)
+    """
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    memory_usage = getattr(obj, 'memory_usage', None)  # pandas DataFrame / Series
+    if memory_usage is not None:
+        try:
+            usage = memory_usage(index=True)
+            return int(getattr(usage, 'sum', lambda: usage)())
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class SharedPayload(object):
+    """
+    Handle to a payload stored in a shared memory segment
+    """
+    __slots__ = ('name', 'size', 'kind', 'meta', 'host')
+
+    def __init__(self, name, size, kind, meta=None, host=None):
+        self.name = name
+        self.size = size
+        self.kind = kind
+        self.meta = meta
+        self.host = host or socket.gethostname()
+
+    @property
+    def path(self):
+        return os.path.join(SHM_DIR, self.name)
+
+    @classmethod
+    def create(cls, obj, refs=1):
+        """
+        @param obj: payload, NumPy arrays are stored raw, anything else pickled
+        @param refs: number of releases needed before the segment is unlinked
+        @return: SharedPayload
+        """
+        if numpy is not None and isinstance(obj, numpy.ndarray) and obj.dtype != object:
+            obj = numpy.ascontiguousarray(obj)
+            handle = cls(PREFIX + uuid.uuid4().hex, obj.nbytes, NDARRAY, (obj.dtype.str, obj.shape))
+            data = None
+        else:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            handle = cls(PREFIX + uuid.uuid4().hex, len(data), PICKLE)
+
+        fd = os.open(handle.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + max(handle.size, 1))
+            segment = mmap.mmap(fd, HEADER_SIZE + max(handle.size, 1))
+        finally:
+            os.close(fd)
+        try:
+            REFS.pack_into(segment, 0, refs)
+            if data is None:
+                view = numpy.frombuffer(segment, dtype=obj.dtype, count=obj.size, offset=HEADER_SIZE)
+                view[:] = obj.ravel()
+                del view
+            else:
+                segment[HEADER_SIZE:HEADER_SIZE + handle.size] = data
+        finally:
+            segment.close()
+        return handle
+
+    def load(self):
+        """
+        @return: the payload. Arrays are copy-on-write views of the segment, valid even after release()
+        """
+        if self.host != socket.gethostname():
+            raise IOError("Shared payload {} lives on host {}".format(self.name, self.host))
+
+        with open(self.path, 'rb') as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.kind == NDARRAY:
+            dtype, shape = self.meta
+            count = 1
+            for dim in shape:
+                count *= dim
+            return numpy.frombuffer(segment, dtype=numpy.dtype(dtype), count=count, offset=HEADER_SIZE).reshape(shape)
+
+        try:
+            return pickle.loads(segment[HEADER_SIZE:HEADER_SIZE + self.size])
+        finally:
+            segment.close()
+
+    def _add_refs(self, delta):
+        with open(self.path, 'r+b') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            refs = REFS.unpack(f.read(REFS.size))[0] + delta
+            f.seek(0)
+            f.write(REFS.pack(refs))
+        return refs
+
+    def incref(self, count=1):
+        return self._add_refs(count)
+
+    def release(self):
+        """
+        Drop one reference, the segment is unlinked with the last one
+        """
+        try:
+            refs = self._add_refs(-1)
+        except (IOError, OSError):
+            log.warning("Shared payload {} already released".format(self.name))
+            return 0
+        if refs <= 0:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        return refs
+
+    @property
+    def as_dict(self):
+        return {'__shm__': [self.name, self.size, self.kind, self.meta, self.host]}
+
+    @classmethod
+    def from_dict(cls, data):
+        name, size, kind, meta, host = data['__shm__']
+        if meta is not None:
+            meta = (meta[0], tuple(meta[1]))
+        return cls(name, size, kind, meta, host)
+
+    def __getstate__(self):
+        return self.name, self.size, self.kind, self.meta, self.host
+
+    def __setstate__(self, state):
+        self.name, self.size, self.kind, self.meta, self.host = state
+
+    def __repr__(self):
+        return "< SharedPayload {} -- {} bytes {} on {} >".format(self.name, self.size, self.kind, self.host)
+
+
+def share(obj, threshold=DEFAULT_THRESHOLD):
+    """
+    @return: a SharedPayload for objects above threshold, obj itself otherwise
+    """
+    if threshold is None or isinstance(obj, SharedPayload):
+        return obj
+    size = payload_size(obj)
+    if size is not None and size >= threshold:
+        return SharedPayload.create(obj)
+    return obj
+
+
+def share_args(args, threshold=DEFAULT_THRESHOLD):
+    """
+    Replace the large items of a task args (tuple, list, dict or single value) with handles
+    """
+    if threshold is None:
+        return args
+    if isinstance(args, (tuple, list)):
+        return type(args)(share(a, threshold) for a in args)
+    if isinstance(args, dict):
+        return {k: share(v, threshold) for k, v in args.items()}
+    return share(args, threshold)
+
+
+def args_host(args, threshold=DEFAULT_THRESHOLD):
+    """
+    @return: host whose shared memory holds some of the args, or will once they are shared past threshold,
+    None if none of them goes through shared memory
+    """
+    values = args if isinstance(args, (tuple, list)) else args.values() if isinstance(args, dict) else [args]
+    for value in values:
+        if isinstance(value, SharedPayload):
+            return value.host
+        if threshold is not None and (payload_size(value) or 0) >= threshold:
+            return socket.gethostname()
+    return None
+
+
+def load_args(args):
+    if isinstance(args, (tuple, list)):
+        return type(args)(a.load() if isinstance(a, SharedPayload) else a for a in args)
+    if isinstance(args, dict):
+        return {k: v.load() if isinstance(v, SharedPayload) else v for k, v in args.items()}
+    return args.load() if isinstance(args, SharedPayload) else args
+
+
+def handles(args):
+    if isinstance(args, (tuple, list)):
+        return [a for a in args if isinstance(a, SharedPayload)]
+    if isinstance(args, dict):
+        return [v for v in args.values() if isinstance(v, SharedPayload)]
+    return [args] if isinstance(args, SharedPayload) else []
+
+
+def resolve(value, release=True):
+    """
+    Consumer side of a shared result: load the payload behind a handle (or its as_dict form)
+    """
+    if isinstance(value, dict) and '__shm__' in value:
+        value = SharedPayload.from_dict(value)
+    if not isinstance(value, SharedPayload):
+        return value
+    payload = value.load()
+    if release:
+        value.release()
+    return payload
+
+
+def cleanup(max_age=MAX_AGE):
+    """
+    Unlink segments older than max_age seconds, e.g. results evicted from the store before being read
+    @return: number of segments removed
+    """
+    removed, now = 0, time.time()
+    for name in os.listdir(SHM_DIR):
+        path = os.path.join(SHM_DIR, name)
+        try:
+            if name.startswith(PREFIX) and now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -1,9 +1,11 @@
 from __future__ import absolute_import, print_function, division, unicode_literals
 
-import time
 from functools import wraps
 
 from src.logging.dsys_logger_client import get_logger
+from src.utils.serializers import get_codec
+from src.utils.shm import share_args, load_args, handles, args_host
+from src.utils.schedules import due_time
 import simplejson as json
 import dill
 
@@ -12,49 +14,177 @@ log = get_logger(__name__)
 _registered_functions = dict()
 
 
-class Task(object):
+def registered_name(func):
+    """
+    @return: the name func is registered under with @task/@delayed_task, None for ad-hoc callables
+    """
+    name = getattr(func, 'task_name', None)
+    return name if name in _registered_functions else None
+
+
+def _unwrapped(func):
+    """
+    @return: the function a registry wrapper holds: a task shipped by name raises like the dill-ed function did,
+    the worker then neither stores a result nor acks the job
+    """
+    return getattr(func, '_function', func)
+
+
+class FunctionRef(object):
+    """
+    Registered function not (yet) known in this process, resolved from the registry when called
+    """
+    __slots__ = ('task_name',)
+
+    def __init__(self, task_name):
+        self.task_name = task_name
+
+    def resolve(self, registered_functions=None):
+        registered = _registered_functions if registered_functions is None else registered_functions
+        try:
+            return _unwrapped(registered[self.task_name])
+        except KeyError:
+            raise KeyError("Task function {} is not registered in this process".format(self.task_name))
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        return "< FunctionRef {} >".format(self.task_name)
 
-    def __init__(self, id, func, args):
+
+class Task(object):
+    # args larger than this many bytes (arrays, DataFrames, buffers) travel through shared memory, None disables
+    shm_threshold = None
+
+    def __init__(self, id, func, args, eta=None, countdown=None, affinity=None, routing_key=None):
+        """
+        @param eta: unix timestamp or datetime before which the task must not run
+        @param countdown: seconds from now, alternative to eta, defaults to the wait of a @delayed_task
+        @param affinity: host the task should run on, see route
+        @param routing_key: tasks of the same key run on the same host, e.g. the dataset they read
+        """
         self.id = str(id)
         self.args = args
         self.func = func
+        if eta is None and countdown is None:
+            countdown = getattr(func, 'countdown', None) or None
+        self.eta = due_time(eta, countdown)
+        # task graphs (see graphs): ids of the tasks whose results the args refer to, tasks waiting for this one
+        self.inputs = ()
+        self.downstream = False
+        # routing hints, used when the task is put (see queues.RoutedQueue). The routing key travels with the
+        # task: the partitions of a job server cluster own the encoded tasks by it (see cluster.partition_key)
+        self.affinity = affinity
+        self.routing_key = routing_key
+
+    @property
+    def route(self):
+        """
+        @return: (host, routing key) of the task for queues.RoutedQueue: its affinity, else the host of the shared
+        memory its args go through, None for any host
+        """
+        host = self.affinity if self.affinity is not None else args_host(self.args, self.shm_threshold)
+        return host, self.routing_key
 
     def __call__(self):
+        args = load_args(self.args)
 
-        if isinstance(self.args, tuple) or isinstance(self.args, list):
+        if isinstance(args, tuple) or isinstance(args, list):
             # time.sleep(0.1)
-            return self.func(*self.args)
-        elif isinstance(self.args, dict):
+            return self.func(*args)
+        elif isinstance(args, dict):
             # time.sleep(0.1)
-            return self.func(**self.args)
+            return self.func(**args)
         else:
             # time.sleep(0.1)
-            return self.func(self.args)
+            return self.func(args)
 
-    def __getstate__(self):
-        log.debug("Enqueued Task %s" % self.id)
+    def release_payloads(self):
+        """
+        Drop the shared memory segments holding the args, once the task is done with them
+        """
+        for handle in handles(self.args):
+            handle.release()
 
-        return {
-            'id': self.id,
-            'args': self.args,
-            'func': dill.dumps(self.func)
-        }
+    def __getstate__(self):
+        """
+        Registered functions travel as their registered name, dill is only the fallback for ad-hoc callables
+        @return: (id, args, registered name, dill dump, eta, inputs, downstream, routing key)
+        """
+        log.debug("Enqueued Task %s", self.id)
+
+        args = share_args(self.args, self.shm_threshold)
+        name = registered_name(self.func)
+        if name is not None:
+            return self.id, args, name, None, self.eta, self.inputs, self.downstream, self.routing_key
+        return self.id, args, None, dill.dumps(self.func), self.eta, self.inputs, self.downstream, self.routing_key
 
     def __setstate__(self, data):
-        self.__dict__ = data
-        self.func = dill.loads(self.func)
-        log.debug("Selected Task %s" % self.id)
+        if isinstance(data, dict):
+            # payloads pickled before function references
+            data = data['id'], data['args'], None, data['func']
+
+        self.id, self.args, name, code = data[:4]
+        self.eta = data[4] if len(data) > 4 else None
+        self.inputs, self.downstream = data[5:7] if len(data) > 6 else ((), False)
+        self.affinity = None
+        self.routing_key = data[7] if len(data) > 7 else None
+        if name is not None:
+            self.func = _unwrapped(_registered_functions.get(name) or FunctionRef(name))
+        else:
+            self.func = dill.loads(code)
+        log.debug("Selected Task %s", self.id)
+
+    def resolve(self, registered_functions):
+        """
+        Bind a function reference unknown at unpickling time to the worker registry
+        """
+        if isinstance(self.func, FunctionRef):
+            self.func = self.func.resolve(registered_functions)
+        return self
 
     @property
     def as_dict(self):
-        return dict(id=self.id, args=self.args, func=self.func.__name__)
+        return dict(id=self.id, args=self.args, func=getattr(self.func, 'task_name', self.func.__name__),
+                    eta=self.eta, inputs=list(self.inputs), downstream=self.downstream, routing_key=self.routing_key)
 
     def to_json(self):
         return json.dumps(self.as_dict)
 
     @classmethod
     def from_dict(cls, data, registered_functions):
-        return cls(id=data['id'], args=data['args'], func=registered_functions[data['func']])
+        task = cls(id=data['id'], args=data['args'], func=_unwrapped(registered_functions[data['func']]))
+        task.eta = data.get('eta')
+        task.inputs, task.downstream = tuple(data.get('inputs', ())), data.get('downstream', False)
+        task.routing_key = data.get('routing_key')
+        return task
+
+    def encode(self, codec=None):
+        """
+        @param codec: codec name or instance. pickle ships the whole Task, the others ship as_dict
+        @return: encoded payload
+        """
+        codec = get_codec(codec)
+        return codec.dumps(self if codec.name == 'pickle' else self.as_dict)
+
+    @classmethod
+    def encode_many(cls, tasks, codec=None):
+        """
+        Encode a batch of tasks as a single payload
+        """
+        codec = get_codec(codec)
+        return codec.dumps(list(tasks) if codec.name == 'pickle' else [t.as_dict for t in tasks])
+
+    @classmethod
+    def decode(cls, data, codec=None, registered_functions=None):
+        """
+        @return: list of tasks found in the payload
+        """
+        decoded = get_codec(codec).loads(data)
+        decoded = decoded if isinstance(decoded, list) else [decoded]
+        registered = _registered_functions if registered_functions is None else registered_functions
+        return [d if isinstance(d, cls) else cls.from_dict(d, registered) for d in decoded]
 
     def __repr__(self):
         return "Task %s -- %s(%r)" % (self.id, self.__class__, self.__dict__)
@@ -64,6 +194,9 @@ class BaseTaskWrap(object):
     def __init__(self, _function):
         self._function = _function
         self.__name__ = _function.__name__
+        self.task_name = getattr(_function, 'task_name', _function.__name__)
+        self.cache = getattr(_function, 'cache', False)
+        self.cache_ttl = getattr(_function, 'cache_ttl', None)
 
     def __call__(self, *args, **kwargs):
         log.debug("Calling {} with params [{}] [{}]".format(self.__name__, args, kwargs))
@@ -79,6 +212,10 @@ class DelayedTaskWrap(object):
     def __init__(self, _function):
         self._function = _function
         self.__name__ = _function.__name__
+        self.task_name = getattr(_function, 'task_name', _function.__name__)
+        self.countdown = getattr(_function, 'countdown', None)
+        self.cache = getattr(_function, 'cache', False)
+        self.cache_ttl = getattr(_function, 'cache_ttl', None)
 
     def __call__(self, *args, **kwargs):
         log.debug("Calling delayed {} with params [{}] [{}]".format(self.__name__, args, kwargs))
@@ -90,30 +227,43 @@ class DelayedTaskWrap(object):
                                                                                    str(e)))
 
 
-def task(name=None, container=_registered_functions):
+def task(name=None, container=_registered_functions, cache=False, ttl=None):
+    """
+    @param cache: memoize the results of the function (pure functions only): the workers look identical calls up
+    in the results store and identical calls in flight run once, see memo
+    @param ttl: seconds a memoized result lives, defaults to the results store ttl
+    """
 
     def inner(func):
         def wrapped(*args, **kwargs):
             return func(*args, **kwargs)
 
         wrapped.__name__ = func.__name__
-        container[name if name else func.__name__] = BaseTaskWrap(wrapped)
+        wrapped.task_name = name if name else func.__name__
+        wrapped.cache, wrapped.cache_ttl = cache, ttl
+        container[wrapped.task_name] = BaseTaskWrap(wrapped)
         return wrapped
 
     return inner
 
 
-def delayed_task(name=None, container=_registered_functions, wait=0.):
+def delayed_task(name=None, container=_registered_functions, wait=0., cache=False, ttl=None):
+    """
+    The tasks of the function get an eta `wait` seconds after their creation: the job queue holds them until
+    then (put with eta=task.eta), a worker fetching one early postpones it instead of sleeping (Worker._postpone).
+    cache and ttl as in task
+    """
 
     def outer(func):
         @wraps(func)
         def wrapped(*args, **kwargs):
-            log.debug("Waiting {} to execute".format(wait))
-            time.sleep(wait)
             return func(*args, **kwargs)
 
         wrapped.__name__ = func.__name__
-        container[name if name else func.__name__] = DelayedTaskWrap(wrapped)
+        wrapped.task_name = name if name else func.__name__
+        wrapped.countdown = wait
+        wrapped.cache, wrapped.cache_ttl = cache, ttl
+        container[wrapped.task_name] = DelayedTaskWrap(wrapped)
         return wrapped
 
     return outer
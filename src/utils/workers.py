@@ -1,42 +1,201 @@
 from Queue import Empty
-from multiprocessing import Process
+from collections import deque
+from contextlib import contextmanager
+from heapq import heappush, heappop
+from importlib import import_module
+from itertools import count
+from multiprocessing import Process, Event
+import math
 import sys
 import os
+import time
 from src.logging.dsys_logger_client import get_logger
-from src.utils.tasks import Task
-import simplejson as json
-import functools
+from src.utils.tasks import Task, _registered_functions
+from src.utils.serializers import get_codec
+from src.utils.shm import share, resolve, SharedPayload
+from src.utils.executors import get_executor, parse_mode
+from src.utils.memo import TaskCache, is_cached
+from src.utils.graphs import bind_results
+from src.utils.autoscaler import EWMA
+from src.utils.cluster import sources_of
 import signal
+import threading
 import psutil
 
 log = get_logger(__name__)
 
 SHARED_DICT = 1
 STD_QUEUE = 0
+AUTO_PREFETCH_LIMIT = 64
+
+
+class Job(list):
+    """
+    Tasks decoded from one queue item, with the lease to ack once they ran (None without leases), the delivery
+    attempt of the item and the queue it came from without leases (see cluster.Delivery)
+    """
+    __slots__ = ('lease', 'attempt', 'source')
+
+    def __init__(self, tasks=(), lease=None, attempt=1, source=None):
+        super(Job, self).__init__(tasks)
+        self.lease = lease
+        self.attempt = attempt
+        self.source = source
+
+
+class Credits(object):
+    """
+    Jobs a worker asks for beyond its free slots. 'auto' learns enough of them to keep the slots busy for a fetch
+    round-trip: moving averages of the round-trip, sampled on the fetches that got every job asked for (the
+    others waited for jobs), and of the job time
+    """
+
+    def __init__(self, prefetch, concurrency, limit=AUTO_PREFETCH_LIMIT, halflife=8.):
+        """
+        @param prefetch: jobs, or 'auto'
+        @param halflife: samples, smoothing of the averages
+        """
+        self.auto = prefetch == 'auto'
+        self.fixed = 0 if self.auto else max(int(prefetch or 0), 0)
+        self.concurrency = concurrency
+        self.limit = limit
+        self.rtt = EWMA(halflife)
+        self.job_time = EWMA(halflife)
+
+    def fetched(self, seconds, asked, got):
+        if self.auto and got >= asked:
+            self.rtt.update(seconds, 1.)
+
+    def executed(self, seconds):
+        if self.auto:
+            self.job_time.update(seconds, 1.)
+
+    @property
+    def extra(self):
+        if not self.auto:
+            return self.fixed
+        if self.rtt.value is None or not self.job_time.value:
+            return 0
+        return min(self.limit, int(math.ceil(self.rtt.value * self.concurrency / self.job_time.value)))
+
+    def __repr__(self):
+        return "< Credits -- extra: {} rtt: {} job time: {} >".format(self.extra, self.rtt.value, self.job_time.value)
 
 
 class Worker(Process):
-    class ShutdownSignaException(Exception):
-        pass
+    """
+    Consumer process. Stopping it:
+      - drain() or SIGTERM: cooperative, the worker stops fetching, runs the jobs it holds, reports them and exits
+      - SIGUSR1 or SIGINT: hard stop, the jobs in flight go back to the queue (nacked, or put again without
+        leases) and the worker exits. A signal arriving during a job server round-trip takes effect after it,
+        the jobs of a fetch or of a report are never half handled
+    """
+
+    class ShutdownSignaException(BaseException):
+        """
+        Not an Exception, like SystemExit: the task wrappers log and swallow the errors of the tasks, the
+        shutdown signal must get through them and stop the worker
+        """
 
-    def __init__(self, task_queue, result_queue, wait=True, poison_pill=None, registered_functions=None):
+    def __init__(self, task_queue, result_queue, wait=True, poison_pill=None, registered_functions=None,
+                 batch_size=1, codec='pickle', results_codec='json', shm_threshold=None, activation=None, preload=(),
+                 mode='process', visibility=None, max_attempts=5, host=None, credits=0, poll=1.):
+        """
+        @param batch_size: jobs fetched per round-trip in process mode, the concurrent modes fetch as many
+        jobs as they have free slots
+        @param activation: multiprocessing Event, the worker warms up then idles until it is set
+        @param preload: task modules imported during the warm up
+        @param mode: 'process' or 'threads:N', see executors
+        @param visibility: lease the jobs for visibility seconds and ack them once done (at-least-once delivery,
+        see queues.BatchQueueMixin.lease_many), None gets and marks them done as before
+        @param max_attempts: deliveries of a leased job before it goes to the dead letters
+        @param host: host name the worker gets its jobs as, a RoutedQueue serves it the jobs routed to that host
+        first (see routing), None for no locality
+        @param credits: jobs asked for beyond the free slots, so that the next ones are already here when a slot
+        frees up: an int, or 'auto' to cover the fetch round-trip at the measured job time (see Credits)
+        @param poll: seconds a fetch waits for jobs before the worker looks for a drain request again
+        """
         super(Worker, self).__init__()
         self.task_queue = task_queue
         self.result_queue = result_queue
         self.results_queue_type = self.check_queue_type(result_queue)
         self.wait_data = wait
         self.poison_pill = poison_pill
-        self.registered_functions = registered_functions or {}
+        self.registered_functions = registered_functions or _registered_functions
+        self.codec = get_codec(codec)
+        self.results_codec = get_codec(results_codec)
+        self.shm_threshold = shm_threshold
+        self.batch_size = max(int(batch_size), 1)
+        self.activation = activation
+        self.preload = preload
+        self.mode = mode
+        self.visibility = visibility
+        self.max_attempts = max_attempts
+        self.host = host
+        self.credits = credits
+        self.poll = poll
+        self.draining = Event()
+        self._pending = set()
+        self._held = {}  # jobs in flight without a lease, given back by a hard stop
+        self._early = []  # heap of (eta, seq, job) of the jobs got without a lease before their eta
+        self._early_ids = count()
+        self._credits = None
+        self._serving = False
+        self._main = None  # thread the signal handlers run on
+        self._deferring = False
+        self._deferred = None  # shutdown signal received during a round-trip
+        self._drain_requested = False
+        self._reporting = threading.Lock()
+        # memoized tasks need a results store
+        self.cache = TaskCache(result_queue, self.results_codec) if hasattr(result_queue, 'claim') else None
+        _, self.concurrency = parse_mode(mode)
+        if credits != 'auto' and int(credits or 0) < 0:
+            raise ValueError("'credits' must be 'auto' or a non-negative number")
 
     @property
     def pid(self):
-        return os.getpid()
+        # the parent knows the worker by its Popen, the worker itself has none
+        return os.getpid() if self._popen is None else self._popen.pid
+
+    def drain(self):
+        """
+        Called from the parent: ask the worker to finish the jobs it holds and exit
+        """
+        self.draining.set()
 
     def shudown(self, signum, func=None):
+        if signum == signal.SIGTERM and self._serving:
+            # a plain flag: the handler may run while the main thread holds the lock of the draining event
+            self._drain_requested = True
+            return
         if signum in (signal.SIGTERM, signal.SIGUSR1, signal.SIGINT):
+            if self._deferring:
+                self._deferred = signum
+                return
             raise self.ShutdownSignaException("Called Worker Shutdown [Signal {} -- Func {}], exit".format(signum,
                                                                                                            func))
 
+    @contextmanager
+    def _round_trip(self):
+        """
+        The shutdown signals received by the main thread in the block take effect at its end
+        """
+        if threading.current_thread() is not self._main or self._deferring:
+            yield
+            return
+        self._deferring = True
+        try:
+            yield
+        finally:
+            # also when the block raised (Empty...): the shutdown takes over
+            self._deferring = False
+            if self._deferred is not None:
+                self.shudown(self._deferred)
+
+    @property
+    def stopping(self):
+        return self._drain_requested or self._deferred is not None or self.draining.is_set()
+
     @property
     def stats(self):
         proc = psutil.Process(self.pid)
@@ -50,29 +209,78 @@ class Worker(Process):
             return STD_QUEUE
 
     def _decode(self, job):
-
-        def _hook(data, _registered):
-            if isinstance(data, list):
-                return [Task.from_dict(d, _registered) for d in data]
-            else:
-                return [Task.from_dict(data, _registered)]
-
         if isinstance(job, list) and all([isinstance(j, Task) for j in job]):
-            return job
+            tasks = job
         elif isinstance(job, Task):
-            return [job]
+            tasks = [job]
+        else:
+            tasks = Task.decode(job, self.codec, self.registered_functions)
+        return [t.resolve(self.registered_functions) for t in tasks]
+
+    def _postpone(self, job):
+        """
+        A job fetched before the eta of its tasks runs as a whole at the last of them, without sleeping here and
+        keeping its priority and tenant: a leased job goes back to the queue entry it came from (nacked with the
+        delay, no attempt spent), a job got without a lease waits in the worker, nothing could put it back there
+        @return: True if the job was postponed
+        """
+        now = time.time()
+        etas = [t.eta for t in job if t.eta is not None and t.eta > now]
+        if not etas:
+            return False
+        if job.lease is not None:
+            self.task_queue.nack_many([job.lease], max(etas) - now, spend=False)
         else:
-            return json.loads(job, object_hook=functools.partial(_hook, _registered=self.registered_functions))
+            heappush(self._early, (max(etas), next(self._early_ids), job))
+            self._held[id(job)] = job
+        return True
 
-    def _encode(self, result):
-        return json.dumps(result)
+    def _due(self):
+        """
+        @return: the postponed jobs due now, still held (not given back by a hard stop)
+        """
+        now, due = time.time(), []
+        while self._early and self._early[0][0] <= now:
+            job = heappop(self._early)[2]
+            if id(job) in self._held:
+                due.append(job)
+        return due
 
-    def _enqueue(self, outdict):
+    def _fetch_timeout(self, due):
+        if due:
+            return 0
+        if self._early:
+            return max(min(self.poll, self._early[0][0] - time.time()), 0)
+        return self.poll
+
+    def _encode(self, result, threshold=None):
+        shared = share(result, threshold)
+        return self.results_codec.dumps(shared.as_dict if isinstance(shared, SharedPayload) else result)
+
+    def _enqueue(self, outdict, inline=()):
+        """
+        @param inline: ids of the results never written to shared memory: graph inputs, read by several tasks
+        """
         if self.results_queue_type == SHARED_DICT:
-            for k in outdict.keys():
-                self.result_queue[k] = self._encode(outdict[k])
+            if outdict:
+                self.result_queue.update({k: self._encode(v, None if k in inline else self.shm_threshold)
+                                          for k, v in outdict.items()})
         else:
-            self.result_queue.put(self._encode(outdict))
+            self.result_queue.put(self._encode(outdict, self.shm_threshold))
+
+    def _bind_inputs(self, jobs):
+        """
+        Graph tasks: their args refer to the results of the tasks they waited for, read in one round-trip
+        """
+        ids = set(i for tasks in jobs for t in tasks for i in t.inputs)
+        if not ids or self.results_queue_type != SHARED_DICT:
+            return
+        found = self.result_queue.get_many(list(ids))
+        inputs = {k: resolve(self.results_codec.loads(v), release=False) for k, v in found.items()}
+        for tasks in jobs:
+            for t in tasks:
+                if t.inputs:
+                    t.args = bind_results(t.args, inputs)
 
     @staticmethod
     def is_iterable(data):
@@ -83,27 +291,278 @@ class Worker(Process):
             log.info('{} is not iterable'.format(data))
             return False
 
+    def _fetch(self, max_jobs, timeout=None):
+        """
+        Pull up to max_jobs jobs in a single round-trip.
+        Jobs after the poison pill are still executed, extra pills are given back to the other workers, all of
+        them when this worker was already stopping
+        @param timeout: seconds to wait for a job, poll by default
+        @return: (list of (lease, job, attempt, source), stop), leases are None without visibility timeout, sources
+        with it
+        """
+        route = {} if self.host is None else dict(host=self.host)
+        timeout = self.poll if timeout is None else timeout
+        try:
+            if self.visibility is None:
+                got = self.task_queue.get_many(max_jobs, timeout, **route)
+                leased = [(None, j, 1, source) for j, source in zip(got, sources_of(got))]
+            else:
+                leased = [(lease, j, attempt, None) for lease, j, attempt in
+                          self.task_queue.lease_many(max_jobs, timeout, visibility=self.visibility,
+                                                     max_attempts=self.max_attempts, **route)]
+        except Empty:
+            return [], False
+        pills = [(lease, source) for lease, j, _, source in leased if j == self.poison_pill]
+        if not pills:
+            return leased, False
+
+        # the extra pills go back unthrottled: a full queue must not refuse or block a stop
+        extra = len(pills) - (0 if self.stopping else 1)
+        if self.visibility is not None:
+            if extra:
+                self.task_queue.nack_many([lease for lease, _ in pills[:extra]], spend=False)
+            self.task_queue.ack_many([lease for lease, _ in pills[extra:]])
+        else:
+            if extra:
+                self._requeue([self.poison_pill] * extra, [source for _, source in pills[:extra]], 1)
+            if pills[extra:]:
+                self._task_done([Job(source=source) for _, source in pills[extra:]])
+        return [record for record in leased if record[1] != self.poison_pill], True
+
+    def warm_up(self):
+        """
+        Everything paid before the first task: task modules and the connections to the queue servers
+        """
+        for module in self.preload:
+            import_module(module)
+        self.task_queue.qsize()
+        if self.results_queue_type == SHARED_DICT:
+            len(self.result_queue)
+        else:
+            self.result_queue.qsize()
+
     def run(self):
 
-        signal.signal(signal.SIGTERM, self.shudown)
-        signal.signal(signal.SIGUSR1, self.shudown)
-        signal.signal(signal.SIGINT, self.shudown)
+        self._main = threading.current_thread()
+        for signum in (signal.SIGTERM, signal.SIGUSR1, signal.SIGINT):
+            signal.signal(signum, self.shudown)
+            # restart the interrupted reads: a round-trip cut by a signal would lose its reply
+            signal.siginterrupt(signum, False)
 
         proc_name = 'Consumer - ' + self.name
 
-        for job in iter(self.task_queue.get, self.poison_pill):
+        try:
+            self.warm_up()
+            if self.activation is not None:
+                self.activation.wait()
+        except self.ShutdownSignaException:
+            sys.exit(0)
+
+        executor = get_executor(self.mode, self._execute, self._complete, self.batch_size)
+        self._credits = Credits(self.credits, self.concurrency)
+        self._serving = True
+        stop = hard = False
+        while not stop and not self.stopping:
             try:
-                tasks = self._decode(job)
-                outdict = {t.id: t() for t in tasks}
-                self._enqueue(outdict)
-                self.task_queue.task_done()
+                asked = executor.free(self._credits.extra)
+                if self.stopping:
+                    break
+                with self._round_trip():
+                    batch = self._due()
+                    leased, stop, wanted = [], False, asked - len(batch)
+                    if wanted > 0:
+                        t0 = time.time()
+                        leased, stop = self._fetch(wanted, self._fetch_timeout(batch))
+                        self._credits.fetched(time.time() - t0, wanted, len(leased))
+                    for lease, job, attempt, source in leased:
+                        try:
+                            job = Job(self._decode(job), lease, attempt, source)
+                            if not self._postpone(job):
+                                batch.append(job)
+                        except Exception as e:
+                            log.error('{}: Encountered an error -- {}'.format(proc_name, str(e)))
+                            if lease is not None:
+                                self.task_queue.nack_many([lease])
+                            else:
+                                self._task_done([Job(source=source)])  # would fail again, not given back
+                    self._pending.update(j.lease for j in batch if j.lease is not None)
+                    self._held.update((id(j), j) for j in batch if j.lease is None)
+                self._bind_inputs(batch)
+                executor.submit_many(batch)
             except Empty:
                 pass
             except StopIteration:
                 break
             except self.ShutdownSignaException:
+                hard = True
                 break
             except Exception as e:
                 log.error('{}: Encountered an error -- {}'.format(proc_name, str(e)))
 
+        if not hard:
+            try:
+                executor.shutdown()
+            except self.ShutdownSignaException:
+                pass
+        self._give_back()
         sys.exit(0)
+
+    def _give_back(self):
+        """
+        Jobs that did not complete go back to the queue now: leases are nacked rather than left to their
+        visibility timeout, the jobs got without a lease are requeued
+        """
+        with self._reporting:
+            leases, held = list(self._pending), list(self._held.values())
+            self._pending.clear()
+            self._held.clear()
+        try:
+            if leases:
+                self.task_queue.nack_many(leases)
+            if held:
+                self._requeue([Task.encode_many(tasks, self.codec) for tasks in held], [j.source for j in held])
+        except Exception as e:
+            log.error('Consumer - {}: unable to give back {} jobs -- {}'.format(self.name, len(leases) + len(held),
+                                                                              str(e)))
+
+    def _execute(self, tasks):
+        """
+        @return: results by task id, None if the job failed
+        """
+        t0 = time.time()
+        try:
+            return {t.id: self.cache.call(t) if self.cache is not None and is_cached(t) else t() for t in tasks}
+        except self.ShutdownSignaException:
+            raise
+        except Exception as e:
+            log.error('Consumer - {}: Encountered an error -- {}'.format(self.name, str(e)))
+            self._fail(tasks)
+        finally:
+            if self._credits is not None:
+                self._credits.executed(time.time() - t0)
+
+    def _fail(self, job):
+        """
+        Report a failed job that is not retried: got without a lease (it would fail again, it is not given back),
+        or leased for its last attempt (nacked, the queue puts it in the dead letters). The graph tasks waiting for
+        its tasks go to the dead letters too. A leased job with attempts left is delivered again, args included
+        """
+        last = job.lease is None or (self.max_attempts and job.attempt >= self.max_attempts)
+        if not last:
+            return
+        try:
+            with self._round_trip(), self._reporting:
+                if job.lease is None:
+                    if self._held.pop(id(job), None) is None:
+                        return  # a hard stop gave it back already
+                    self._task_done([job])
+                else:
+                    if job.lease not in self._pending:
+                        return
+                    self.task_queue.nack_many([job.lease])
+                    self._pending.discard(job.lease)
+                failed = [t.id for t in job if t.downstream]
+                if failed:
+                    self.task_queue.task_failed_many(failed)
+        except Exception as e:
+            log.error('Consumer - {}: unable to report a failed job -- {}'.format(self.name, str(e)))
+            return
+        if job.lease is None:
+            for t in job:
+                t.release_payloads()
+
+    def _task_done(self, jobs, done_ids=()):
+        """
+        Report jobs got without a lease done, to the queue they came from when the task queue spreads its gets
+        """
+        sources = [j.source for j in jobs]
+        if any(source is not None for source in sources):
+            self.task_queue.task_done_many(len(jobs), done_ids, sources=sources)
+        else:
+            self.task_queue.task_done_many(len(jobs), done_ids)
+
+    def _requeue(self, items, sources, priority=None):
+        """
+        Give items got without a lease back, unthrottled, to the queue they came from, see _task_done
+        """
+        if any(source is not None for source in sources):
+            self.task_queue.requeue_many(items, priority, sources=sources)
+        else:
+            self.task_queue.requeue_many(items, priority)
+
+    def _complete(self, jobs, results):
+        """
+        Report executed jobs: results, queue accounting, shared memory args
+        """
+        with self._round_trip(), self._reporting:
+            # a hard stop may have given some of them back already
+            jobs = [j for j in jobs if (j.lease in self._pending if j.lease is not None else
+                                        self._held.pop(id(j), None) is not None)]
+            if not jobs:
+                return
+            done = [t.id for tasks in jobs for t in tasks if t.downstream]
+            self._enqueue(results, set(done))
+            leases = [j.lease for j in jobs if j.lease is not None]
+            if leases:
+                self.task_queue.ack_many(leases, done)
+                self._pending.difference_update(leases)
+                done = []
+            if len(leases) < len(jobs):
+                self._task_done([j for j in jobs if j.lease is None], done)
+        for tasks in jobs:
+            for t in tasks:
+                t.release_payloads()
+
+
+class WarmPool(object):
+    """
+    Reserve of started Workers, warmed up (connected, task modules imported) and idle until activated:
+    a scale-up only sets an event instead of paying the process start and the server handshakes
+    """
+
+    def __init__(self, task_queue, result_queue, reserve=2, **worker_options):
+        """
+        @param reserve: idle workers kept ready
+        @param worker_options: Worker keyword arguments
+        """
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.reserve = reserve
+        self.worker_options = worker_options
+        self.idle = deque()
+
+    def _start(self, activation=None):
+        worker = Worker(self.task_queue, self.result_queue, activation=activation, **self.worker_options)
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def fill(self):
+        """
+        Top the reserve up, to be called off the scaling path
+        """
+        self.idle = deque(w for w in self.idle if w.is_alive())
+        while len(self.idle) < self.reserve:
+            self.idle.append(self._start(Event()))
+
+    def activate(self, count):
+        """
+        @return: count running workers, taken from the reserve first then cold started
+        """
+        started = []
+        while self.idle and len(started) < count:
+            worker = self.idle.popleft()
+            if worker.is_alive():
+                worker.activation.set()
+                started.append(worker)
+        while len(started) < count:
+            started.append(self._start())
+        return started
+
+    def close(self):
+        for worker in self.idle:
+            worker.terminate()
+        self.idle.clear()
+
+    def __repr__(self):
+        return "< WarmPool -- idle: {} reserve: {} >".format(len(self.idle), self.reserve)